@@ -0,0 +1,6 @@
+import fire
+
+from second.benchmark.suite import compare, run
+
+if __name__ == '__main__':
+    fire.Fire({"run": run, "compare": compare})
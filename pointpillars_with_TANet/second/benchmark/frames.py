@@ -0,0 +1,57 @@
+"""fixed frame sets for the benchmark suite.
+
+a frame is (info, points), info has the calib / image keys that
+InferenceContext.get_inference_input_dict reads. synthetic frames are
+seeded, so every config (and every run) sees the same point clouds.
+"""
+import pickle
+
+import numpy as np
+
+from second.data.synthetic_kitti import (IMAGE_SHAPE, KITTI_P2, KITTI_R0_RECT,
+                                         KITTI_TR_VELO_TO_CAM)
+from second.pytorch.near_far import _read_points
+
+# covers the point_cloud_range of all car, ped_cycle and near/far configs.
+SYNTHETIC_RANGE = [0, -40, -3, 70.4, 40, 1]
+
+
+def synthetic_info(image_idx):
+    return {
+        "image_idx": image_idx,
+        "img_path": "",
+        "img_shape": np.array(IMAGE_SHAPE, dtype=np.int32),
+        "calib/P2": KITTI_P2.astype(np.float32),
+        "calib/R0_rect": KITTI_R0_RECT.astype(np.float32),
+        "calib/Tr_velo_to_cam": KITTI_TR_VELO_TO_CAM.astype(np.float32),
+    }
+
+
+def synthetic_frames(num_frames=10,
+                     num_points=20000,
+                     num_point_features=4,
+                     seed=0):
+    """points uniform in SYNTHETIC_RANGE. a uniform cloud fills more
+    voxels than a real scan of the same size, so voxelization and vfe
+    times are an upper bound.
+    """
+    rng = np.random.default_rng(seed)
+    low, high = SYNTHETIC_RANGE[:3], SYNTHETIC_RANGE[3:]
+    frames = []
+    for i in range(num_frames):
+        xyz = rng.uniform(low, high, size=[num_points, 3])
+        features = rng.uniform(size=[num_points, num_point_features - 3])
+        points = np.concatenate([xyz, features], axis=1).astype(np.float32)
+        frames.append((synthetic_info(i), points))
+    return frames
+
+
+def recorded_frames(info_path, root_path, num_frames=10,
+                    num_point_features=4):
+    """the first num_frames frames of a kitti info file (reduced clouds,
+    see create_data.py).
+    """
+    with open(info_path, "rb") as f:
+        kitti_infos = pickle.load(f)
+    return [(info, _read_points(info, root_path, num_point_features))
+            for info in kitti_infos[:num_frames]]
@@ -0,0 +1,358 @@
+"""latency of preprocess, forward and postprocess over a config matrix.
+
+every config is built (random weights unless a checkpoint is given) and
+runs the same fixed frame set: warmup passes over all frames (numba
+compilation, allocator and cudnn warm-up) are dropped, then repeats
+passes are timed per frame with a profiler.StageProfiler:
+    preprocess: voxelization, anchors mask, conversion to tensors.
+    forward: VoxelNet.network_forward (vfe, scatter, rpn).
+    postprocess: decode, nms, projection and kitti annos.
+    total: the three above.
+with detail the VoxelNet stages (vfe, scatter, rpn, decode, nms, ...)
+are reported as well.
+
+results go to a markdown table (console and md_path), a csv and a json
+baseline. a run given baseline_path is compared to it, stages slower
+than the baseline by more than tolerance are regressions.
+
+usage:
+    python -m second.benchmark run \
+        --configs=configs/tanet/car/near_far/*.proto --json_path=base.json
+    python -m second.benchmark run --configs=configs/pointpillars/car \
+        --baseline_path=base.json --tolerance=0.1
+    python -m second.benchmark compare --json_path=new.json \
+        --baseline_path=base.json
+"""
+import glob
+import json
+import pathlib
+import platform
+import sys
+
+import numpy as np
+import torch
+
+import torchplus
+from second.benchmark.frames import recorded_frames, synthetic_frames
+from second.pytorch.inference import TorchInferenceContext
+from second.pytorch import profiler as stage_profiler
+from second.pytorch.train import comput_kitti_output, example_convert_to_torch
+
+STAGES = ["preprocess", "forward", "postprocess", "total"]
+STATS = ["mean", "p50", "p90", "p99"]
+FRAME_SETS = ["synthetic", "recorded"]
+
+
+def config_paths(configs):
+    """configs: a config, a directory (every *.proto below it), a glob
+    or a list of those.
+    """
+    if isinstance(configs, (list, tuple)):
+        return [p for c in configs for p in config_paths(c)]
+    path = pathlib.Path(configs)
+    if path.is_dir():
+        return sorted(str(p) for p in path.rglob("*.proto"))
+    return sorted(glob.glob(str(configs)))
+
+
+def config_name(config_path):
+    return str(pathlib.Path(config_path).with_suffix(""))
+
+
+def build_context(config_path, ckpt_path=None, device="cpu", precision=None):
+    """
+    Args:
+        ckpt_path: None (random weights), a .tckpt or a model_dir (latest
+            checkpoint). "{name}" is replaced by the config file stem.
+    """
+    ctx = TorchInferenceContext(device=torch.device(device),
+                                precision=precision)
+    ctx.build(config_path)
+    if ckpt_path is not None:
+        ckpt_path = pathlib.Path(
+            str(ckpt_path).format(name=pathlib.Path(config_path).stem))
+        if ckpt_path.is_dir():
+            torchplus.train.restore_latest_checkpoints(
+                str(ckpt_path), [ctx.net])
+        else:
+            ctx.restore(ckpt_path)
+    return ctx
+
+
+def _postprocess(net, ctx, example, preds_dict):
+    input_cfg = ctx.config.eval_input_reader
+    model_cfg = ctx.config.model.second
+    if "anchors_mask" in preds_dict:
+        example = {**example, "anchors_mask": preds_dict["anchors_mask"]}
+    if "Refine_loc_preds" in preds_dict:
+        predictions_dicts = net.predict_refine(example, preds_dict)
+    else:
+        predictions_dicts = net.predict_coarse(example, preds_dict)
+    return comput_kitti_output(predictions_dicts, example["image_shape"],
+                               model_cfg.lidar_input,
+                               model_cfg.post_center_limit_range,
+                               list(input_cfg.class_names), None)
+
+
+def benchmark_config(ctx, frames, warmup=2, repeats=5, detail=False):
+    """
+    Returns:
+        dict: stage -> {"count", "mean", "p50", "p90", "p99"} in ms per
+            frame.
+    """
+    net = ctx.net
+    device = ctx.device
+    profiler = stage_profiler.StageProfiler(device)
+    if detail:
+        net.set_profiler(profiler)
+    net.clear_time_metrics()
+    with torch.no_grad():
+        for i in range(warmup + repeats):
+            if i == warmup:
+                profiler.reset()
+            for info, points in frames:
+                with profiler.stage("total"):
+                    with profiler.stage("preprocess"):
+                        example = ctx.get_inference_input_dict(info, points)
+                        example = example_convert_to_torch(
+                            example, torch.float32, device)
+                    with profiler.stage("forward"):
+                        preds_dict = net.network_forward(example)
+                    with profiler.stage("postprocess"):
+                        _postprocess(net, ctx, example, preds_dict)
+                profiler.step()
+    net.set_profiler(None)
+    return profiler.summary()
+
+
+def environment(device="cpu"):
+    device = torch.device(device)
+    env = {
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "num_threads": torch.get_num_threads(),
+        "device": str(device),
+    }
+    if device.type == "cuda":
+        env["device_name"] = torch.cuda.get_device_name(device)
+    return env
+
+
+def run(configs,
+        ckpt_path=None,
+        frames="synthetic",
+        num_frames=10,
+        num_points=20000,
+        warmup=2,
+        repeats=5,
+        device="cpu",
+        num_threads=None,
+        precision=None,
+        detail=False,
+        seed=0,
+        kitti_root_path=None,
+        csv_path=None,
+        md_path=None,
+        json_path=None,
+        baseline_path=None,
+        tolerance=0.1,
+        stat="p50",
+        fail_on_regression=False):
+    """benchmark every config, see the module docstring.
+    Args:
+        configs: config file, directory, glob or list of those.
+        ckpt_path: see build_context.
+        frames: "synthetic" (seeded uniform clouds of num_points points)
+            or "recorded" (eval_input_reader frames of every config).
+        kitti_root_path: recorded frames from kitti_infos_val.pkl of
+            this root (e.g. create_data.py create_synthetic_kitti)
+            instead of the eval_input_reader paths.
+        num_threads: torch.set_num_threads, None keeps the default.
+        baseline_path: json of an earlier run to compare to.
+        fail_on_regression: exit with status 1 if a stage regressed.
+    Returns:
+        dict: the json baseline of this run.
+    """
+    if frames not in FRAME_SETS:
+        raise ValueError("unknown frame set {}, available: {}".format(
+            frames, ", ".join(FRAME_SETS)))
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    paths = config_paths(configs)
+    if len(paths) == 0:
+        raise ValueError("no config matches {}".format(configs))
+    frame_cache = {}
+    results = {}
+    for config_path in paths:
+        print("benchmark", config_path)
+        torch.manual_seed(seed)
+        ctx = build_context(config_path, ckpt_path, device, precision)
+        input_cfg = ctx.config.eval_input_reader
+        num_point_features = ctx.config.model.second.num_point_features
+        if frames == "synthetic":
+            key = (num_point_features, )
+        elif kitti_root_path is not None:
+            key = (str(pathlib.Path(kitti_root_path) / "kitti_infos_val.pkl"),
+                   kitti_root_path, num_point_features)
+        else:
+            key = (input_cfg.kitti_info_path, input_cfg.kitti_root_path,
+                   num_point_features)
+        if frames == "recorded":
+            ctx.root_path = key[1]
+        if key not in frame_cache:
+            if frames == "synthetic":
+                frame_cache[key] = synthetic_frames(
+                    num_frames, num_points, num_point_features, seed)
+            else:
+                frame_cache[key] = recorded_frames(*key[:2], num_frames,
+                                                   num_point_features)
+        results[config_name(config_path)] = benchmark_config(
+            ctx, frame_cache[key], warmup, repeats, detail)
+    baseline = {
+        "environment": environment(device),
+        "settings": {
+            "frames": frames,
+            "num_frames": num_frames,
+            "num_points": num_points if frames == "synthetic" else None,
+            "warmup": warmup,
+            "repeats": repeats,
+            "precision": precision,
+            "ckpt_path": ckpt_path,
+            "seed": seed,
+            "kitti_root_path": kitti_root_path,
+        },
+        "results": results,
+    }
+    table = results_table_md(results, stat)
+    print(table)
+    if md_path is not None:
+        with open(md_path, "w") as f:
+            f.write(table + "\n")
+    if csv_path is not None:
+        write_csv(results, csv_path)
+    if json_path is not None:
+        with open(json_path, "w") as f:
+            json.dump(baseline, f, indent=2)
+    if baseline_path is not None:
+        rows = _compare_to_file(baseline, baseline_path, tolerance, stat)
+        if fail_on_regression and any(row[-1] == "regression"
+                                      for row in rows):
+            sys.exit(1)
+    return baseline
+
+
+def _stages(results):
+    names = set(n for summary in results.values() for n in summary)
+    order = STAGES + stage_profiler.STAGES
+    return [n for n in order if n in names] + sorted(names - set(order))
+
+
+def results_table_md(results, stat="p50"):
+    stages = _stages(results)
+    lines = [
+        "| config | " + " | ".join("{} ms ({})".format(n, stat)
+                                   for n in stages) + " | fps |",
+        "|---|" + "---:|" * (len(stages) + 1),
+    ]
+    for name, summary in results.items():
+        cells = [
+            "{:.2f}".format(summary[n][stat]) if n in summary else "-"
+            for n in stages
+        ]
+        fps = 1000 / summary["total"]["mean"]
+        lines.append("| {} | {} | {:.1f} |".format(name, " | ".join(cells),
+                                                   fps))
+    return "\n".join(lines)
+
+
+def write_csv(results, path):
+    """one row per (config, stage), times in ms.
+    """
+    with open(path, "w") as f:
+        f.write(",".join(["config", "stage", "count"] +
+                         [s + "_ms" for s in STATS]) + "\n")
+        for name, summary in results.items():
+            for stage, s in summary.items():
+                f.write(",".join([name, stage, str(s["count"])] +
+                                 ["{:.4f}".format(s[k])
+                                  for k in STATS]) + "\n")
+
+
+def compare_results(results, baseline_results, tolerance=0.1, stat="p50"):
+    """
+    Returns:
+        list of (config, stage, baseline ms, ms, ratio, status), status
+        is "regression" (ratio > 1 + tolerance), "improvement"
+        (ratio < 1 - tolerance), "ok", "new" or "missing".
+    """
+    rows = []
+    for name in list(baseline_results) + [
+            n for n in results if n not in baseline_results
+    ]:
+        base = baseline_results.get(name, {})
+        cur = results.get(name, {})
+        for stage in _stages({"base": base, "cur": cur}):
+            if stage not in base:
+                rows.append((name, stage, None, cur[stage][stat], None, "new"))
+                continue
+            if stage not in cur:
+                rows.append((name, stage, base[stage][stat], None, None,
+                             "missing"))
+                continue
+            base_ms, ms = base[stage][stat], cur[stage][stat]
+            ratio = ms / base_ms if base_ms > 0 else np.inf
+            status = "ok"
+            if ratio > 1 + tolerance:
+                status = "regression"
+            elif ratio < 1 - tolerance:
+                status = "improvement"
+            rows.append((name, stage, base_ms, ms, ratio, status))
+    return rows
+
+
+def comparison_table_md(rows, stat="p50"):
+    def fmt(val, spec):
+        return "-" if val is None else spec.format(val)
+
+    lines = [
+        "| config | stage | baseline ms ({0}) | ms ({0}) | ratio | status |"
+        .format(stat),
+        "|---|---|---:|---:|---:|---|",
+    ]
+    for name, stage, base_ms, ms, ratio, status in rows:
+        lines.append("| {} | {} | {} | {} | {} | {} |".format(
+            name, stage, fmt(base_ms, "{:.2f}"), fmt(ms, "{:.2f}"),
+            fmt(ratio, "{:.3f}"), status))
+    return "\n".join(lines)
+
+
+def _compare_to_file(baseline, baseline_path, tolerance, stat):
+    with open(baseline_path, "r") as f:
+        reference = json.load(f)
+    for key, val in reference["environment"].items():
+        if baseline["environment"].get(key) != val:
+            print("warning: {} differs from the baseline: {} vs {}".format(
+                key, baseline["environment"].get(key), val))
+    if reference["settings"] != baseline["settings"]:
+        print("warning: settings differ from the baseline")
+    rows = compare_results(baseline["results"], reference["results"],
+                           tolerance, stat)
+    print(comparison_table_md(rows, stat))
+    num_regressions = sum(row[-1] == "regression" for row in rows)
+    print("{} regressions (tolerance {:.0%})".format(num_regressions,
+                                                     tolerance))
+    return rows
+
+
+def compare(json_path, baseline_path, tolerance=0.1, stat="p50",
+            fail_on_regression=False):
+    """compare two json baselines written by run.
+    """
+    with open(json_path, "r") as f:
+        baseline = json.load(f)
+    rows = _compare_to_file(baseline, baseline_path, tolerance, stat)
+    if fail_on_regression and any(row[-1] == "regression" for row in rows):
+        sys.exit(1)
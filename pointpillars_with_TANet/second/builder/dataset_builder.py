@@ -24,6 +24,7 @@ that wraps the build function.
 
 from second.protos import input_reader_pb2
 from second.data.dataset import KittiDataset
+from second.data.eval_cache import CachedKittiDataset
 from second.data.preprocess import prep_pointcloud
 import numpy as np
 from second.builder import dbsampler_builder
@@ -34,11 +35,14 @@ def build(input_reader_config,
           model_config,
           training,
           voxel_generator,
-          target_assigner=None):
+          target_assigner=None,
+          cache_dir=None):
     """Builds a tensor dictionary based on the InputReader config.
 
     Args:
         input_reader_config: A input_reader_pb2.InputReader object.
+        cache_dir: eval examples (training=False) are read from the
+            preprocessed eval cache in this directory, see eval_cache.py.
 
     Returns:
         A tensor dict based on the input_reader_config.
@@ -107,5 +111,9 @@ def build(input_reader_config,
         target_assigner=target_assigner,
         feature_map_size=feature_map_size,
         prep_func=prep_func)
+    if cache_dir is not None:
+        if training:
+            raise ValueError("only eval examples can be cached")
+        dataset = CachedKittiDataset(dataset, cache_dir)
 
     return dataset
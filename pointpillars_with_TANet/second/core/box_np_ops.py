@@ -4,7 +4,6 @@ import numpy as np
 from second.utils.buildtools.pybind11_build import load_pb11
 
 from second.core.geometry import points_in_convex_polygon_3d_jit
-from second.core.non_max_suppression.nms_gpu import rotate_iou_gpu_eval
 
 try:
     from second.core import box_ops_cc
@@ -1,3 +1,11 @@
-from second.core.non_max_suppression.nms_cpu import nms_jit, soft_nms_jit
-from second.core.non_max_suppression.nms_gpu import (nms_gpu, rotate_iou_gpu,
-                                                       rotate_nms_gpu)
+from second.core.non_max_suppression.nms_parallel import (
+    nms_cpu_parallel, rotate_iou_cpu, rotate_nms_cpu_parallel)
+
+try:
+    from second.core.non_max_suppression.nms_cpu import nms_jit, soft_nms_jit
+    from second.core.non_max_suppression.nms_gpu import (
+        nms_gpu, rotate_iou_gpu, rotate_nms_gpu)
+except Exception:
+    # no cuda: the pybind nms extension can't be built and the numba.cuda
+    # kernels can't be compiled, nms_parallel still works.
+    pass
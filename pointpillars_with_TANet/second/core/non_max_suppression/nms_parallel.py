@@ -0,0 +1,369 @@
+"""numba parallel cpu kernels for axis-aligned and rotated nms.
+
+the rotated overlap is a port of the numba.cuda device functions in
+nms_gpu.py (float32 buffers, same corner order and polygon clipping) and
+suppression uses the rule of the gpu kernels: a box is removed if its
+iou with a kept, higher scored box is strictly greater than the
+threshold, axis-aligned areas use the +1 convention of iou_device.
+divisions follow the numpy (and cuda) error model: degenerate inputs
+give inf / nan like the gpu kernels instead of raising.
+importing this module needs neither cuda nor the pybind nms build.
+"""
+import math
+
+import numba
+import numpy as np
+
+# float32 scratch layout of one worker, see _inter.
+_SCRATCH_SIZE = 64
+
+
+@numba.njit(error_model="numpy")
+def trangle_area(a, b, c):
+    return (
+        (a[0] - c[0]) * (b[1] - c[1]) - (a[1] - c[1]) * (b[0] - c[0])) / 2.0
+
+
+@numba.njit(error_model="numpy")
+def area(int_pts, num_of_inter):
+    area_val = 0.0
+    for i in range(num_of_inter - 2):
+        area_val += abs(
+            trangle_area(int_pts[:2], int_pts[2 * i + 2:2 * i + 4],
+                         int_pts[2 * i + 4:2 * i + 6]))
+    return area_val
+
+
+@numba.njit(error_model="numpy")
+def sort_vertex_in_convex_polygon(int_pts, num_of_inter, center, v, vs):
+    if num_of_inter > 0:
+        center[:] = 0.0
+        for i in range(num_of_inter):
+            center[0] += int_pts[2 * i]
+            center[1] += int_pts[2 * i + 1]
+        center[0] /= num_of_inter
+        center[1] /= num_of_inter
+        for i in range(num_of_inter):
+            v[0] = int_pts[2 * i] - center[0]
+            v[1] = int_pts[2 * i + 1] - center[1]
+            d = math.sqrt(v[0] * v[0] + v[1] * v[1])
+            # a vertex on the center (e.g. identical boxes, where only
+            # one corner passes point_in_quadrilateral) has no angle.
+            # the polygon is degenerate, its area is 0 in any order.
+            if d > 0:
+                v[0] = v[0] / d
+                v[1] = v[1] / d
+            if v[1] < 0:
+                v[0] = -2 - v[0]
+            vs[i] = v[0]
+        j = 0
+        temp = 0
+        for i in range(1, num_of_inter):
+            if vs[i - 1] > vs[i]:
+                temp = vs[i]
+                tx = int_pts[2 * i]
+                ty = int_pts[2 * i + 1]
+                j = i
+                while j > 0 and vs[j - 1] > temp:
+                    vs[j] = vs[j - 1]
+                    int_pts[j * 2] = int_pts[j * 2 - 2]
+                    int_pts[j * 2 + 1] = int_pts[j * 2 - 1]
+                    j -= 1
+
+                vs[j] = temp
+                int_pts[j * 2] = tx
+                int_pts[j * 2 + 1] = ty
+
+
+@numba.njit(error_model="numpy")
+def line_segment_intersection(pts1, pts2, i, j, temp_pts):
+    A0 = pts1[2 * i]
+    A1 = pts1[2 * i + 1]
+    B0 = pts1[2 * ((i + 1) % 4)]
+    B1 = pts1[2 * ((i + 1) % 4) + 1]
+    C0 = pts2[2 * j]
+    C1 = pts2[2 * j + 1]
+    D0 = pts2[2 * ((j + 1) % 4)]
+    D1 = pts2[2 * ((j + 1) % 4) + 1]
+    BA0 = B0 - A0
+    BA1 = B1 - A1
+    DA0 = D0 - A0
+    CA0 = C0 - A0
+    DA1 = D1 - A1
+    CA1 = C1 - A1
+    acd = DA1 * CA0 > CA1 * DA0
+    bcd = (D1 - B1) * (C0 - B0) > (C1 - B1) * (D0 - B0)
+    if acd != bcd:
+        abc = CA1 * BA0 > BA1 * CA0
+        abd = DA1 * BA0 > BA1 * DA0
+        if abc != abd:
+            DC0 = D0 - C0
+            DC1 = D1 - C1
+            ABBA = A0 * B1 - B0 * A1
+            CDDC = C0 * D1 - D0 * C1
+            DH = BA1 * DC0 - BA0 * DC1
+            Dx = ABBA * DC0 - BA0 * CDDC
+            Dy = ABBA * DC1 - BA1 * CDDC
+            temp_pts[0] = Dx / DH
+            temp_pts[1] = Dy / DH
+            return True
+    return False
+
+
+@numba.njit(error_model="numpy")
+def point_in_quadrilateral(pt_x, pt_y, corners):
+    ab0 = corners[2] - corners[0]
+    ab1 = corners[3] - corners[1]
+
+    ad0 = corners[6] - corners[0]
+    ad1 = corners[7] - corners[1]
+
+    ap0 = pt_x - corners[0]
+    ap1 = pt_y - corners[1]
+
+    abab = ab0 * ab0 + ab1 * ab1
+    abap = ab0 * ap0 + ab1 * ap1
+    adad = ad0 * ad0 + ad1 * ad1
+    adap = ad0 * ap0 + ad1 * ap1
+
+    return abab >= abap and abap >= 0 and adad >= adap and adap >= 0
+
+
+@numba.njit(error_model="numpy")
+def quadrilateral_intersection(pts1, pts2, int_pts, temp_pts):
+    num_of_inter = 0
+    for i in range(4):
+        if point_in_quadrilateral(pts1[2 * i], pts1[2 * i + 1], pts2):
+            int_pts[num_of_inter * 2] = pts1[2 * i]
+            int_pts[num_of_inter * 2 + 1] = pts1[2 * i + 1]
+            num_of_inter += 1
+        if point_in_quadrilateral(pts2[2 * i], pts2[2 * i + 1], pts1):
+            int_pts[num_of_inter * 2] = pts2[2 * i]
+            int_pts[num_of_inter * 2 + 1] = pts2[2 * i + 1]
+            num_of_inter += 1
+    for i in range(4):
+        for j in range(4):
+            has_pts = line_segment_intersection(pts1, pts2, i, j, temp_pts)
+            if has_pts:
+                int_pts[num_of_inter * 2] = temp_pts[0]
+                int_pts[num_of_inter * 2 + 1] = temp_pts[1]
+                num_of_inter += 1
+
+    return num_of_inter
+
+
+@numba.njit(error_model="numpy")
+def rbbox_to_corners(corners, rbbox, corners_x, corners_y):
+    # generate clockwise corners and rotate it clockwise
+    angle = rbbox[4]
+    a_cos = math.cos(angle)
+    a_sin = math.sin(angle)
+    center_x = rbbox[0]
+    center_y = rbbox[1]
+    x_d = rbbox[2]
+    y_d = rbbox[3]
+    corners_x[0] = -x_d / 2
+    corners_x[1] = -x_d / 2
+    corners_x[2] = x_d / 2
+    corners_x[3] = x_d / 2
+    corners_y[0] = -y_d / 2
+    corners_y[1] = y_d / 2
+    corners_y[2] = y_d / 2
+    corners_y[3] = -y_d / 2
+    for i in range(4):
+        corners[2 * i] = a_cos * corners_x[i] + a_sin * corners_y[i] + center_x
+        corners[2 * i +
+                1] = -a_sin * corners_x[i] + a_cos * corners_y[i] + center_y
+
+
+@numba.njit(error_model="numpy")
+def inter(rbbox1, rbbox2, scratch):
+    corners1 = scratch[0:8]
+    corners2 = scratch[8:16]
+    intersection_corners = scratch[16:32]
+    temp_pts = scratch[32:34]
+    rbbox_to_corners(corners1, rbbox1, scratch[34:38], scratch[38:42])
+    rbbox_to_corners(corners2, rbbox2, scratch[34:38], scratch[38:42])
+
+    num_intersection = quadrilateral_intersection(
+        corners1, corners2, intersection_corners, temp_pts)
+    sort_vertex_in_convex_polygon(intersection_corners, num_intersection,
+                                  scratch[42:44], scratch[44:46],
+                                  scratch[46:62])
+    return area(intersection_corners, num_intersection)
+
+
+@numba.njit(error_model="numpy")
+def rotate_iou(rbox1, rbox2, scratch, criterion=-1):
+    """same as devRotateIoUEval, criterion -1 is devRotateIoU.
+    """
+    area1 = rbox1[2] * rbox1[3]
+    area2 = rbox2[2] * rbox2[3]
+    area_inter = inter(rbox1, rbox2, scratch)
+    if criterion == -1:
+        return area_inter / (area1 + area2 - area_inter)
+    elif criterion == 0:
+        return area_inter / area1
+    elif criterion == 1:
+        return area_inter / area2
+    else:
+        return area_inter
+
+
+@numba.njit(error_model="numpy")
+def iou(a, b):
+    left = max(a[0], b[0])
+    right = min(a[2], b[2])
+    top = max(a[1], b[1])
+    bottom = min(a[3], b[3])
+    width = max(right - left + 1, 0.)
+    height = max(bottom - top + 1, 0.)
+    interS = width * height
+    Sa = (a[2] - a[0] + 1) * (a[3] - a[1] + 1)
+    Sb = (b[2] - b[0] + 1) * (b[3] - b[1] + 1)
+    return interS / (Sa + Sb - interS)
+
+
+@numba.njit(parallel=True, error_model="numpy")
+def _nms_sorted(boxes, thresh, max_keep):
+    num_boxes = boxes.shape[0]
+    num_chunks = numba.get_num_threads()
+    suppressed = np.zeros(num_boxes, dtype=np.uint8)
+    keep = np.zeros(num_boxes, dtype=np.int64)
+    num_keep = 0
+    for i in range(num_boxes):
+        if suppressed[i]:
+            continue
+        keep[num_keep] = i
+        num_keep += 1
+        if num_keep == max_keep:
+            break
+        # strided chunks, every box j is only written by one worker.
+        for c in numba.prange(num_chunks):
+            for j in range(i + 1 + c, num_boxes, num_chunks):
+                if suppressed[j] == 0 and iou(boxes[i], boxes[j]) > thresh:
+                    suppressed[j] = 1
+    return keep[:num_keep]
+
+
+@numba.njit(parallel=True, error_model="numpy")
+def _rotate_nms_sorted(boxes, thresh, max_keep):
+    num_boxes = boxes.shape[0]
+    num_chunks = numba.get_num_threads()
+    suppressed = np.zeros(num_boxes, dtype=np.uint8)
+    keep = np.zeros(num_boxes, dtype=np.int64)
+    # boxes whose circumscribed circles don't touch have zero overlap.
+    radius = np.sqrt(boxes[:, 2]**2 + boxes[:, 3]**2) / 2
+    num_keep = 0
+    for i in range(num_boxes):
+        if suppressed[i]:
+            continue
+        keep[num_keep] = i
+        num_keep += 1
+        if num_keep == max_keep:
+            break
+        for c in numba.prange(num_chunks):
+            scratch = np.zeros(_SCRATCH_SIZE, dtype=np.float32)
+            for j in range(i + 1 + c, num_boxes, num_chunks):
+                if suppressed[j] == 1:
+                    continue
+                dx = boxes[i, 0] - boxes[j, 0]
+                dy = boxes[i, 1] - boxes[j, 1]
+                r = radius[i] + radius[j]
+                if dx * dx + dy * dy > r * r:
+                    continue
+                if rotate_iou(boxes[i], boxes[j], scratch) > thresh:
+                    suppressed[j] = 1
+    return keep[:num_keep]
+
+
+def nms_cpu_parallel(dets, thresh, max_keep=None):
+    """cpu version of nms_gpu.
+    Args:
+        dets: [N, 5] float array of [x1, y1, x2, y2, score].
+        thresh: iou threshold.
+        max_keep: stop after max_keep boxes, None for all.
+    Returns:
+        keep: int64 indices into dets, highest score first.
+    """
+    dets = np.ascontiguousarray(dets, dtype=np.float32)
+    # same (unstable) sort as the gpu kernels.
+    order = dets[:, 4].argsort()[::-1].astype(np.int32)
+    keep = _nms_sorted(dets[order], np.float32(thresh),
+                       -1 if max_keep is None else max_keep)
+    return order[keep].astype(np.int64)
+
+
+def rotate_nms_cpu_parallel(dets, thresh, max_keep=None):
+    """cpu version of rotate_nms_gpu.
+    Args:
+        dets: [N, 6] float array of [x, y, w, l, angle, score].
+        thresh: iou threshold.
+        max_keep: stop after max_keep boxes, None for all.
+    Returns:
+        keep: int64 indices into dets, highest score first.
+    """
+    dets = np.ascontiguousarray(dets, dtype=np.float32)
+    order = dets[:, 5].argsort()[::-1].astype(np.int32)
+    keep = _rotate_nms_sorted(dets[order], np.float32(thresh),
+                              -1 if max_keep is None else max_keep)
+    return order[keep].astype(np.int64)
+
+
+@numba.njit(error_model="numpy")
+def _rotated_standup(boxes):
+    """axis-aligned bounds [x1, y1, x2, y2] of rotated boxes.
+    """
+    standup = np.empty((boxes.shape[0], 4), dtype=np.float32)
+    for i in range(boxes.shape[0]):
+        a_cos = abs(math.cos(boxes[i, 4]))
+        a_sin = abs(math.sin(boxes[i, 4]))
+        half_x = (a_cos * boxes[i, 2] + a_sin * boxes[i, 3]) / 2
+        half_y = (a_sin * boxes[i, 2] + a_cos * boxes[i, 3]) / 2
+        standup[i, 0] = boxes[i, 0] - half_x
+        standup[i, 1] = boxes[i, 1] - half_y
+        standup[i, 2] = boxes[i, 0] + half_x
+        standup[i, 3] = boxes[i, 1] + half_y
+    return standup
+
+
+@numba.njit(parallel=True, error_model="numpy")
+def _rotate_iou_kernel(boxes, query_boxes, iou, criterion, prefilter):
+    standup = _rotated_standup(boxes)
+    query_standup = _rotated_standup(query_boxes)
+    # float32 corners may stick out of the exact bounds a little.
+    eps = np.float32(1e-3)
+    for n in numba.prange(boxes.shape[0]):
+        scratch = np.zeros(_SCRATCH_SIZE, dtype=np.float32)
+        for k in range(query_boxes.shape[0]):
+            # pairs with disjoint axis-aligned bounds don't intersect.
+            if prefilter and (
+                    standup[n, 0] > query_standup[k, 2] + eps
+                    or query_standup[k, 0] > standup[n, 2] + eps
+                    or standup[n, 1] > query_standup[k, 3] + eps
+                    or query_standup[k, 1] > standup[n, 3] + eps):
+                continue
+            iou[n, k] = rotate_iou(query_boxes[k], boxes[n], scratch,
+                                   criterion)
+
+
+def rotate_iou_cpu(boxes, query_boxes, criterion=-1, prefilter=True):
+    """cpu version of rotate_iou_gpu / rotate_iou_gpu_eval.
+    Args:
+        boxes: [N, 5] float array of [x, y, w, l, angle].
+        query_boxes: [K, 5] float array.
+        criterion: -1 for iou, 0 / 1 for intersection over the area
+            of the query box / box, otherwise intersection area.
+        prefilter: skip pairs with disjoint axis-aligned bounds (their
+            overlap is 0).
+    Returns:
+        iou: [N, K] array with the dtype of boxes.
+    """
+    box_dtype = boxes.dtype
+    boxes = np.ascontiguousarray(boxes, dtype=np.float32)
+    query_boxes = np.ascontiguousarray(query_boxes, dtype=np.float32)
+    iou = np.zeros((boxes.shape[0], query_boxes.shape[0]), dtype=np.float32)
+    if iou.size == 0:
+        return iou
+    _rotate_iou_kernel(boxes, query_boxes, iou, criterion, prefilter)
+    return iou.astype(box_dtype)
@@ -9,6 +9,7 @@ from skimage import io as imgio
 from second.core import box_np_ops
 from second.core.point_cloud.point_cloud_ops import bound_points_jit
 from second.data import kitti_common as kitti
+from second.data import synthetic_kitti
 from second.utils.progress_bar import list_bar as prog_bar
 """
 Note: tqdm has problem in my system(win10), so use my progress bar
@@ -62,11 +63,13 @@ def _calculate_num_points_in_gt(data_path, infos, relative_path, remove_outside=
 def create_kitti_info_file(data_path,
                            save_path=None,
                            create_trainval=False,
-                           relative_path=True):
-    train_img_ids = _read_imageset_file("./data/ImageSets/train.txt")
-    val_img_ids = _read_imageset_file("./data/ImageSets/val.txt")
-    trainval_img_ids = _read_imageset_file("./data/ImageSets/trainval.txt")
-    test_img_ids = _read_imageset_file("./data/ImageSets/test.txt")
+                           relative_path=True,
+                           imageset_path="./data/ImageSets"):
+    imageset_path = pathlib.Path(imageset_path)
+    train_img_ids = _read_imageset_file(str(imageset_path / "train.txt"))
+    val_img_ids = _read_imageset_file(str(imageset_path / "val.txt"))
+    trainval_img_ids = _read_imageset_file(str(imageset_path / "trainval.txt"))
+    test_img_ids = _read_imageset_file(str(imageset_path / "test.txt"))
 
     print("Generate info. this may take several minutes.")
     if save_path is None:
@@ -299,5 +302,23 @@ def create_groundtruth_database(data_path,
         pickle.dump(all_db_infos, f)
 
 
+def create_synthetic_kitti(data_path,
+                           num_train=32,
+                           num_val=16,
+                           num_test=8,
+                           seed=0):
+    """write a procedural kitti tree (see data/synthetic_kitti.py) with
+    its own ImageSets, then the infos, reduced point clouds and gt
+    database of it. point the kitti_info_path / kitti_root_path of a
+    config (or kitti_info_path of the database sampler) there to train,
+    evaluate or benchmark offline.
+    """
+    imageset_path = synthetic_kitti.write_dataset(data_path, num_train,
+                                                  num_val, num_test, seed)
+    create_kitti_info_file(data_path, imageset_path=imageset_path)
+    create_reduced_point_cloud(data_path)
+    create_groundtruth_database(data_path)
+
+
 if __name__ == '__main__':
     fire.Fire()
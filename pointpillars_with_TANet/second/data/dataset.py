@@ -32,6 +32,7 @@ class KittiDataset(Dataset):
         with open(info_path, 'rb') as f:
             infos = pickle.load(f)
         #self._kitti_infos = kitti.filter_infos_by_used_classes(infos, class_names)
+        self._info_path = info_path
         self._root_path = root_path
         self._kitti_infos = infos
         self._num_point_features = num_point_features
@@ -51,6 +52,7 @@ class KittiDataset(Dataset):
             "matched_thresholds": matched_thresholds,
             "unmatched_thresholds": unmatched_thresholds,
         }
+        self._anchor_cache = anchor_cache
         self._prep_func = partial(prep_func, anchor_cache=anchor_cache)
 
     def __len__(self):
@@ -60,6 +62,26 @@ class KittiDataset(Dataset):
     def kitti_infos(self):
         return self._kitti_infos
 
+    @property
+    def info_path(self):
+        return self._info_path
+
+    @property
+    def root_path(self):
+        return self._root_path
+
+    @property
+    def num_point_features(self):
+        return self._num_point_features
+
+    @property
+    def anchor_cache(self):
+        return self._anchor_cache
+
+    @property
+    def prep_func(self):
+        return self._prep_func
+
     def __getitem__(self, idx):
         return _read_and_prep_v9(
             info=self._kitti_infos[idx],
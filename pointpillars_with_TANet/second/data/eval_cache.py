@@ -0,0 +1,227 @@
+"""cache of the preprocessed examples of an eval split.
+
+eval examples are deterministic (no augmentation, shuffle_points off),
+the voxels, coordinates, num_points and anchors mask of a frame only
+depend on the voxel generator, the anchors and the frame. they are
+written once to packed memmapped files in cache_dir/<key>, key is a hash
+of the voxel / anchor settings and of the info file:
+    points.bin: float32 [num_points.sum(), num_point_features], the
+        points of the voxels without the padding.
+    coordinates.bin: int32 [num_voxels, 3]
+    num_points.bin: int32 [num_voxels]
+    anchors_mask.bin: int32 indices of the anchors in the anchors mask.
+    index.npz: voxels, points and mask indices per frame.
+every later eval reads its examples from them, without reading the
+point clouds, voxelization or the anchors mask.
+
+usage:
+    eval_dataset = input_reader_builder.build(
+        eval_input_cfg, model_cfg, training=False,
+        voxel_generator=voxel_generator, target_assigner=target_assigner,
+        cache_dir="/data/eval_cache")
+"""
+import hashlib
+import pathlib
+import shutil
+from functools import partial
+
+import numba
+import numpy as np
+
+from second.data.dataset import Dataset
+from second.data.preprocess import _read_and_prep_v9
+
+# bump if the cached examples change.
+CACHE_VERSION = 1
+CACHE_FILES = {
+    "points": np.float32,
+    "coordinates": np.int32,
+    "num_points": np.int32,
+    "anchors_mask": np.int32,
+}
+
+
+def _file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+@numba.jit(nopython=True)
+def _unpack_voxels(points, num_points, voxels):
+    """voxels[i, :num_points[i]] = next num_points[i] points.
+    """
+    start = 0
+    for i in range(num_points.shape[0]):
+        end = start + num_points[i]
+        voxels[i, :num_points[i]] = points[start:end]
+        start = end
+
+
+def cache_key(dataset):
+    """hash of everything an eval example of dataset depends on.
+    Args:
+        dataset: KittiDataset built with training=False.
+    """
+    prep_kwargs = dataset.prep_func.keywords
+    voxel_generator = prep_kwargs["voxel_generator"]
+    sha1 = hashlib.sha1()
+    for value in [
+            CACHE_VERSION,
+            str(pathlib.Path(dataset.root_path).resolve()),
+            dataset.num_point_features,
+            voxel_generator.max_num_points_per_voxel,
+            prep_kwargs["max_voxels"],
+            prep_kwargs["anchor_area_threshold"],
+            prep_kwargs["remove_outside_points"],
+            _file_hash(dataset.info_path),
+    ]:
+        sha1.update(repr(value).encode())
+    for array in [
+            voxel_generator.voxel_size, voxel_generator.point_cloud_range,
+            dataset.anchor_cache["anchors"]
+    ]:
+        sha1.update(np.ascontiguousarray(array).tobytes())
+    return sha1.hexdigest()[:16]
+
+
+def write_cache(dataset, path):
+    """preprocess every frame of dataset (shuffle_points off) into path.
+    """
+    prep_kwargs = dataset.prep_func.keywords
+    if prep_kwargs["training"] or prep_kwargs["generate_bev"]:
+        raise ValueError(
+            "only eval examples without bev maps can be cached")
+    prep_func = partial(dataset.prep_func, shuffle_points=False)
+    max_num_points = prep_kwargs["voxel_generator"].max_num_points_per_voxel
+    path = pathlib.Path(path)
+    tmp_path = path.parent / (path.name + ".tmp")
+    if tmp_path.exists():
+        shutil.rmtree(str(tmp_path))
+    tmp_path.mkdir(parents=True)
+    files = {
+        name: open(str(tmp_path / (name + ".bin")), "wb")
+        for name in CACHE_FILES
+    }
+    num_voxels = np.zeros(len(dataset), dtype=np.int64)
+    num_frame_points = np.zeros(len(dataset), dtype=np.int64)
+    num_mask = np.zeros(len(dataset), dtype=np.int64)
+    has_mask = True
+    try:
+        for i, info in enumerate(dataset.kitti_infos):
+            example = _read_and_prep_v9(info, dataset.root_path,
+                                        dataset.num_point_features,
+                                        prep_func)
+            voxels = example["voxels"]
+            points_mask = (np.arange(max_num_points) <
+                           example["num_points"][:, np.newaxis])
+            num_voxels[i] = len(voxels)
+            num_frame_points[i] = points_mask.sum()
+            columns = {
+                "points": voxels[points_mask],
+                "coordinates": example["coordinates"],
+                "num_points": example["num_points"],
+            }
+            if "anchors_mask" in example:
+                columns["anchors_mask"] = np.flatnonzero(
+                    example["anchors_mask"])
+                num_mask[i] = len(columns["anchors_mask"])
+            else:
+                has_mask = False
+            for name, column in columns.items():
+                files[name].write(
+                    np.ascontiguousarray(column,
+                                         dtype=CACHE_FILES[name]).tobytes())
+    finally:
+        for f in files.values():
+            f.close()
+    np.savez(str(tmp_path / "index.npz"),
+             num_voxels=num_voxels,
+             num_frame_points=num_frame_points,
+             num_mask=num_mask,
+             has_mask=has_mask,
+             max_num_points=max_num_points,
+             num_point_features=dataset.num_point_features)
+    if path.exists():
+        shutil.rmtree(str(path))
+    tmp_path.rename(path)
+
+
+class CachedKittiDataset(Dataset):
+    """a KittiDataset (training=False) read from its eval cache, the cache
+    is written on construction if it doesn't exist.
+    """
+
+    def __init__(self, dataset, cache_dir):
+        self._dataset = dataset
+        self._path = pathlib.Path(cache_dir) / cache_key(dataset)
+        if not (self._path / "index.npz").exists():
+            print("write eval cache", self._path)
+            write_cache(dataset, self._path)
+        index = np.load(str(self._path / "index.npz"))
+        assert len(index["num_voxels"]) == len(dataset)
+        self._max_num_points = int(index["max_num_points"])
+        self._num_point_features = int(index["num_point_features"])
+        self._has_mask = bool(index["has_mask"])
+        self._voxel_offsets = np.concatenate(
+            [[0], np.cumsum(index["num_voxels"])])
+        self._mask_offsets = np.concatenate(
+            [[0], np.cumsum(index["num_mask"])])
+        self._files = {
+            name: self._memmap(name, dtype)
+            for name, dtype in CACHE_FILES.items()
+        }
+        self._files["points"] = self._files["points"].reshape(
+            [-1, self._num_point_features])
+        self._files["coordinates"] = self._files["coordinates"].reshape(
+            [-1, 3])
+        self._point_offsets = np.concatenate(
+            [[0], np.cumsum(index["num_frame_points"])])
+
+    def _memmap(self, name, dtype):
+        path = self._path / (name + ".bin")
+        if path.stat().st_size == 0:
+            return np.zeros([0], dtype=dtype)
+        return np.memmap(str(path), dtype=dtype, mode="r")
+
+    def __len__(self):
+        return len(self._dataset)
+
+    @property
+    def kitti_infos(self):
+        return self._dataset.kitti_infos
+
+    @property
+    def path(self):
+        return self._path
+
+    def __getitem__(self, idx):
+        info = self.kitti_infos[idx]
+        v0, v1 = self._voxel_offsets[idx:idx + 2]
+        p0, p1 = self._point_offsets[idx:idx + 2]
+        num_points = np.array(self._files["num_points"][v0:v1])
+        voxels = np.zeros(
+            [v1 - v0, self._max_num_points, self._num_point_features],
+            dtype=np.float32)
+        _unpack_voxels(np.asarray(self._files["points"][p0:p1]), num_points,
+                       voxels)
+        example = {
+            "voxels": voxels,
+            "num_points": num_points,
+            "coordinates": np.array(self._files["coordinates"][v0:v1]),
+            "num_voxels": np.array([v1 - v0], dtype=np.int64),
+            "rect": info["calib/R0_rect"].astype(np.float32),
+            "Trv2c": info["calib/Tr_velo_to_cam"].astype(np.float32),
+            "P2": info["calib/P2"].astype(np.float32),
+            "anchors": self._dataset.anchor_cache["anchors"],
+        }
+        if self._has_mask:
+            m0, m1 = self._mask_offsets[idx:idx + 2]
+            anchors_mask = np.zeros(len(example["anchors"]), dtype=np.uint8)
+            anchors_mask[self._files["anchors_mask"][m0:m1]] = 1
+            example["anchors_mask"] = anchors_mask
+        example["image_idx"] = info["image_idx"]
+        example["image_shape"] = np.array(info["img_shape"], dtype=np.int32)
+        return example
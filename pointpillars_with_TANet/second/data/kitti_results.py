@@ -0,0 +1,250 @@
+"""detections of an eval split as concatenated columns.
+
+a KittiResults holds every field of the kitti result annos of all frames
+in one array per field, frame i owns the rows offsets[i]:offsets[i + 1].
+names are stored as codes into a vocabulary. it is saved to / loaded
+from one uncompressed npz (no pickle, no text parsing), and can be
+passed wherever a list of dt annos is expected: indexing gives the anno
+of a frame (views of the columns), slicing a KittiResults of the frames.
+the kitti eval (utils/eval.py) reads the columns directly.
+
+usage:
+    results = KittiResults.from_annos(dt_annos)
+    results.save("result.npz")
+    dt_annos = load_detections("result.npz")
+    python ./data/kitti_results.py convert --src=label_dir \
+        --dst=result.npz
+"""
+import pathlib
+import pickle
+import re
+
+import fire
+import numpy as np
+
+from second.data import kitti_common as kitti
+
+# result anno fields and their widths, name is stored as codes.
+RESULT_FIELDS = {
+    "truncated": 1,
+    "occluded": 1,
+    "alpha": 1,
+    "bbox": 4,
+    "dimensions": 3,
+    "location": 3,
+    "rotation_y": 1,
+    "score": 1,
+}
+
+
+def _label_image_ids(label_folder, image_ids=None):
+    """the frames kitti.get_label_annos reads.
+    """
+    if image_ids is None:
+        prog = re.compile(r'^\d{6}.txt$')
+        return sorted(
+            int(p.stem) for p in pathlib.Path(label_folder).glob("*.txt")
+            if prog.match(p.name))
+    if not isinstance(image_ids, list):
+        return list(range(image_ids))
+    return image_ids
+
+
+class KittiResults:
+    """detections of an eval split, see the module docstring.
+    """
+
+    def __init__(self, offsets, image_idx, name_vocab, columns):
+        """
+        Args:
+            offsets: [num_frames + 1] int64, first row of every frame.
+            image_idx: [num_frames] image index of every frame, -1 if
+                unknown.
+            name_vocab: [num_names] str array.
+            columns: dict of "name" (codes into name_vocab) and every
+                RESULT_FIELDS field, [num_dt] or [num_dt, width].
+        """
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.image_idx = np.asarray(image_idx, dtype=np.int64)
+        self.name_vocab = np.asarray(name_vocab).astype(str)
+        self.columns = columns
+        assert len(self.image_idx) + 1 == len(self.offsets)
+
+    @classmethod
+    def from_annos(cls, annos, image_ids=None):
+        """
+        Args:
+            annos: list of kitti result annos, one per frame.
+            image_ids: image index of every frame. taken from the annos'
+                image_idx if None (-1 for frames without detections).
+        """
+        num_dt = np.array([len(a["name"]) for a in annos], dtype=np.int64)
+        if image_ids is None:
+            image_ids = [
+                a["image_idx"][0] if len(a.get("image_idx", [])) > 0 else -1
+                for a in annos
+            ]
+        assert len(image_ids) == len(annos)
+        names = np.concatenate(
+            [np.asarray(a["name"]).astype(str) for a in annos] +
+            [np.zeros([0], dtype=str)])
+        name_vocab, name_codes = np.unique(names, return_inverse=True)
+        columns = {"name": name_codes.astype(np.int32)}
+        # the dtypes of a concatenation of the annos, so the kitti eval
+        # gives the same result for both.
+        for key, width in RESULT_FIELDS.items():
+            shape = [-1] if width == 1 else [-1, width]
+            columns[key] = np.concatenate(
+                [np.asarray(a[key]).reshape(shape) for a in annos] +
+                [np.zeros([0] + shape[1:])])
+        return cls(np.concatenate([[0], np.cumsum(num_dt)]), image_ids,
+                   name_vocab, columns)
+
+    @classmethod
+    def from_label_dir(cls, label_folder, image_ids=None):
+        """kitti label files of label_folder, see kitti.get_label_annos.
+        """
+        image_ids = _label_image_ids(label_folder, image_ids)
+        annos = kitti.get_label_annos(label_folder, image_ids)
+        return cls.from_annos(annos, image_ids)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(str(path)) as f:
+            columns = {
+                key: f[key]
+                for key in ["name"] + list(RESULT_FIELDS.keys())
+            }
+            return cls(f["offsets"], f["image_idx"], f["name_vocab"],
+                       columns)
+
+    def save(self, path):
+        np.savez(str(path),
+                 offsets=self.offsets,
+                 image_idx=self.image_idx,
+                 name_vocab=self.name_vocab,
+                 **self.columns)
+
+    @property
+    def num_dt(self):
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.image_idx)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            assert step == 1, "only contiguous frames"
+            stop = max(start, stop)
+            row0, row1 = self.offsets[start], self.offsets[stop]
+            return KittiResults(
+                self.offsets[start:stop + 1] - row0,
+                self.image_idx[start:stop], self.name_vocab,
+                {k: c[row0:row1] for k, c in self.columns.items()})
+        if idx < 0:
+            idx += len(self)
+        row0, row1 = self.offsets[idx], self.offsets[idx + 1]
+        anno = {
+            key: column[row0:row1]
+            for key, column in self.columns.items()
+        }
+        anno["name"] = self.name_vocab[anno["name"]]
+        anno["image_idx"] = np.full([row1 - row0],
+                                    self.image_idx[idx],
+                                    dtype=np.int64)
+        return anno
+
+    def column(self, key):
+        """a field of all detections, names decoded.
+        """
+        if key == "name":
+            return self.name_vocab[self.columns["name"]]
+        return self.columns[key]
+
+    def to_annos(self):
+        """list of kitti result annos, the arrays are copies.
+        """
+        return [{k: v.copy() for k, v in anno.items()} for anno in self]
+
+    def write_label_dir(self, label_folder):
+        """one kitti label file per frame (frames with a known image_idx),
+        read back by kitti.get_label_annos.
+        """
+        label_folder = pathlib.Path(label_folder)
+        label_folder.mkdir(parents=True, exist_ok=True)
+        # lhw->hwl(label file format)
+        values = np.concatenate([
+            self.columns["alpha"][:, np.newaxis],
+            self.columns["bbox"],
+            self.columns["dimensions"][:, [1, 2, 0]],
+            self.columns["location"],
+            self.columns["rotation_y"][:, np.newaxis],
+            self.columns["score"][:, np.newaxis],
+        ], axis=1).tolist()
+        line_format = "{} {:.4f} {} " + " ".join(["{:.4f}"] * 13)
+        lines = [
+            line_format.format(name, truncated, occluded, *row)
+            for name, truncated, occluded, row in zip(
+                self.column("name"), self.columns["truncated"].tolist(),
+                self.columns["occluded"].astype(np.int64).tolist(), values)
+        ]
+        for i, img_idx in enumerate(self.image_idx):
+            if img_idx < 0:
+                continue
+            path = label_folder / (kitti.get_image_index_str(img_idx) +
+                                   ".txt")
+            with open(path, "w") as f:
+                f.write("\n".join(lines[self.offsets[i]:self.offsets[i + 1]]))
+
+
+def load_detections(path, image_ids=None):
+    """detections of a results npz, a pickled list of annos (result.pkl)
+    or a kitti label directory.
+    Args:
+        image_ids: the frames to read of a label directory.
+    """
+    path = pathlib.Path(path)
+    if path.is_dir():
+        return kitti.get_label_annos(path, image_ids)
+    if path.suffix == ".npz":
+        return KittiResults.load(path)
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def convert(src, dst, info_path=None):
+    """convert detections between a results npz, a pickled list of annos
+    (.pkl) and a kitti label directory (any other dst).
+    Args:
+        info_path: kitti infos, the frames (and their order) to read of a
+            label directory. every label file if None.
+    """
+    image_ids = None
+    if info_path is not None:
+        with open(info_path, "rb") as f:
+            image_ids = [info["image_idx"] for info in pickle.load(f)]
+    if pathlib.Path(src).is_dir():
+        results = KittiResults.from_label_dir(src, image_ids)
+    else:
+        results = load_detections(src)
+        if not isinstance(results, KittiResults):
+            results = KittiResults.from_annos(results, image_ids)
+    dst = pathlib.Path(dst)
+    if dst.suffix == ".npz":
+        results.save(dst)
+    elif dst.suffix == ".pkl":
+        with open(dst, "wb") as f:
+            pickle.dump(results.to_annos(), f)
+    else:
+        results.write_label_dir(dst)
+    print("{} frames, {} detections written to {}".format(
+        len(results), results.offsets[-1], dst))
+
+
+if __name__ == '__main__':
+    fire.Fire()
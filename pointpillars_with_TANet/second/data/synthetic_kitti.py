@@ -0,0 +1,322 @@
+"""procedural kitti object dataset for offline runs.
+
+every frame has a ground plane scanned by 64 lidar rings, labeled Car,
+Pedestrian and Cyclist boxes and unlabeled clutter (poles, walls,
+bushes). objects are sampled on the faces visible from the sensor with a
+density falling off with the squared distance, they don't occlude each
+other in the point cloud. labels get 2d boxes, truncation and occlusion
+levels from the projection into the image, so difficulty works as on
+kitti. the tree matches the kitti object layout:
+    training/{calib,image_2,label_2,velodyne,velodyne_reduced}
+    testing/{calib,image_2,velodyne,velodyne_reduced}
+    ImageSets/{train,val,trainval,test}.txt
+images are black, only their shape is used.
+"""
+import pathlib
+
+import numpy as np
+from skimage import io as imgio
+
+from second.core import box_np_ops
+
+# calibration of kitti training frame 000000.
+KITTI_P0 = np.array([[721.5377, 0.0, 609.5593, 0.0],
+                     [0.0, 721.5377, 172.854, 0.0], [0.0, 0.0, 1.0, 0.0],
+                     [0.0, 0.0, 0.0, 1.0]])
+KITTI_P1 = np.array([[721.5377, 0.0, 609.5593, -387.5744],
+                     [0.0, 721.5377, 172.854, 0.0], [0.0, 0.0, 1.0, 0.0],
+                     [0.0, 0.0, 0.0, 1.0]])
+KITTI_P2 = np.array([[721.5377, 0.0, 609.5593, 44.85728],
+                     [0.0, 721.5377, 172.854, 0.2163791],
+                     [0.0, 0.0, 1.0, 0.002745884], [0.0, 0.0, 0.0, 1.0]])
+KITTI_P3 = np.array([[721.5377, 0.0, 609.5593, -339.5242],
+                     [0.0, 721.5377, 172.854, 2.199936],
+                     [0.0, 0.0, 1.0, 0.002729905], [0.0, 0.0, 0.0, 1.0]])
+KITTI_R0_RECT = np.array([[0.9999239, 0.00983776, -0.007445048, 0.0],
+                          [-0.009869795, 0.9999421, -0.004278459, 0.0],
+                          [0.007402527, 0.004351614, 0.9999631, 0.0],
+                          [0.0, 0.0, 0.0, 1.0]])
+KITTI_TR_VELO_TO_CAM = np.array(
+    [[0.007533745, -0.9999714, -0.000616602, -0.004069766],
+     [0.01480249, 0.0007280733, -0.9998902, -0.07631618],
+     [0.9998621, 0.00752379, 0.01480755, -0.2717806], [0.0, 0.0, 0.0, 1.0]])
+KITTI_TR_IMU_TO_VELO = np.array(
+    [[0.9999976, 0.0007553071, -0.002035826, -0.8086759],
+     [-0.0007854027, 0.9998898, -0.01482298, 0.3195559],
+     [0.002024406, 0.01482454, 0.9998881, -0.7997231], [0.0, 0.0, 0.0, 1.0]])
+IMAGE_SHAPE = (375, 1242)
+
+LIDAR_HEIGHT = 1.73
+# (probability, mean wlh, wlh std) of the labeled classes.
+OBJECT_CLASSES = {
+    "Car": (0.7, [1.6, 3.9, 1.56], [0.1, 0.4, 0.1]),
+    "Pedestrian": (0.15, [0.6, 0.8, 1.73], [0.08, 0.1, 0.1]),
+    "Cyclist": (0.15, [0.6, 1.76, 1.73], [0.08, 0.15, 0.1]),
+}
+# (min wlh, max wlh) of the unlabeled clutter.
+CLUTTER_CLASSES = {
+    "pole": ([0.2, 0.2, 2.5], [0.4, 0.4, 5.0]),
+    "wall": ([0.5, 5.0, 1.5], [2.0, 20.0, 5.0]),
+    "bush": ([0.8, 0.8, 0.4], [2.5, 2.5, 1.5]),
+}
+RING_ELEVATIONS = np.deg2rad(np.linspace(-24.8, 2.0, 64))
+
+
+def _visible_surface_points(box, density, rng, inset=0.03, max_points=4000):
+    """points on the faces of a lidar box [x, y, z, w, l, h, r] (z at the
+    bottom) that face the sensor at the origin.
+    """
+    w, l, h = box[3:6]
+    # (normal axis, sign, face extents along the two other axes)
+    faces = [(0, -1, l, h), (0, 1, l, h), (1, -1, w, h), (1, 1, w, h),
+             (2, 1, w, l)]
+    half = np.array([w / 2, l / 2, h / 2]) - inset
+    center = np.array([0, 0, h / 2])
+    rot = box_np_ops.rotation_3d_in_axis
+    points = []
+    for axis, sign, a, b in faces:
+        normal = np.zeros([3])
+        normal[axis] = sign
+        face_center = center + normal * half
+        normal_world = rot(normal[np.newaxis, np.newaxis], np.array([box[6]]),
+                           axis=2)[0, 0]
+        face_world = rot(face_center[np.newaxis, np.newaxis],
+                         np.array([box[6]]), axis=2)[0, 0] + box[:3]
+        if normal_world @ face_world >= 0:
+            continue
+        dist = max(np.linalg.norm(face_world), 1.0)
+        num = min(rng.poisson(density * a * b / dist**2), max_points)
+        if num == 0:
+            continue
+        local = rng.uniform(-half, half, size=[num, 3]) + center
+        local[:, axis] = face_center[axis]
+        points.append(
+            rot(local[np.newaxis], np.array([box[6]]), axis=2)[0] + box[:3])
+    if len(points) == 0:
+        return np.zeros([0, 3])
+    return np.concatenate(points, axis=0)
+
+
+def _ground_points(max_range, azimuth_resolution, rng):
+    elevations = RING_ELEVATIONS[RING_ELEVATIONS < 0]
+    ranges = LIDAR_HEIGHT / np.tan(-elevations)
+    ranges = ranges[ranges < max_range]
+    azimuths = np.arange(-np.pi, np.pi, np.deg2rad(azimuth_resolution))
+    r, a = np.meshgrid(ranges, azimuths, indexing="ij")
+    r = r.reshape(-1) * (1 + rng.normal(scale=0.005, size=r.size))
+    a = a.reshape(-1)
+    z = -LIDAR_HEIGHT + rng.normal(scale=0.02, size=r.size)
+    return np.stack([r * np.cos(a), r * np.sin(a), z], axis=1)
+
+
+def _in_footprints(points, boxes):
+    """mask of the points inside the bird's eye view of any box.
+    """
+    mask = np.zeros([len(points)], dtype=bool)
+    for box in boxes:
+        d = points[:, :2] - box[:2]
+        c, s = np.cos(box[6]), np.sin(box[6])
+        # inverse of rotation_3d_in_axis(axis=2).
+        local_x = d[:, 0] * c - d[:, 1] * s
+        local_y = d[:, 0] * s + d[:, 1] * c
+        mask |= (np.abs(local_x) <= box[3] / 2) & (np.abs(local_y) <=
+                                                    box[4] / 2)
+    return mask
+
+
+def _place_boxes(sizes, low, high, rng, placed, max_tries=50):
+    """rejection sampling of non overlapping (bird's eye circles) boxes on
+    the ground.
+    Returns:
+        boxes: [M, 7] lidar boxes.
+        kept: indices of the placed sizes.
+    """
+    boxes = []
+    kept = []
+    for i, size in enumerate(sizes):
+        radius = np.linalg.norm(size[:2]) / 2
+        for _ in range(max_tries):
+            xy = rng.uniform(low, high)
+            if abs(xy[1]) > xy[0] * np.tan(np.deg2rad(45)) + 10:
+                continue
+            if all(np.linalg.norm(xy - p[:2]) > radius + p[2] + 0.3
+                   for p in placed):
+                placed.append([xy[0], xy[1], radius])
+                boxes.append([
+                    xy[0], xy[1], -LIDAR_HEIGHT, *size,
+                    rng.uniform(-np.pi, np.pi)
+                ])
+                kept.append(i)
+                break
+    return np.array(boxes, dtype=np.float64).reshape([-1, 7]), kept
+
+
+def sample_scene(rng,
+                 num_objects=(4, 15),
+                 num_clutter=(5, 20),
+                 density=20000.0,
+                 max_range=80.0,
+                 azimuth_resolution=0.35,
+                 num_noise_points=200):
+    """
+    Returns:
+        points: [N, 4] float32 velodyne points (x, y, z, reflectance).
+        gt_boxes: [M, 7] lidar boxes of the labeled objects.
+        gt_names: [M] class names.
+    """
+    names = list(OBJECT_CLASSES.keys())
+    probs = [OBJECT_CLASSES[n][0] for n in names]
+    gt_names = rng.choice(names, size=rng.integers(*num_objects), p=probs)
+    sizes = [
+        np.abs(rng.normal(OBJECT_CLASSES[n][1], OBJECT_CLASSES[n][2]))
+        for n in gt_names
+    ]
+    placed = []
+    gt_boxes, kept = _place_boxes(sizes, [4.0, -35.0], [65.0, 35.0], rng,
+                                  placed)
+    gt_names = gt_names[kept]
+    clutter_names = rng.choice(list(CLUTTER_CLASSES.keys()),
+                               size=rng.integers(*num_clutter))
+    clutter_sizes = [
+        rng.uniform(*CLUTTER_CLASSES[n]) for n in clutter_names
+    ]
+    clutter_boxes, _ = _place_boxes(clutter_sizes, [2.0, -40.0], [75.0, 40.0],
+                                 rng, placed)
+
+    object_points = [
+        _visible_surface_points(box, density, rng)
+        for box in np.concatenate([gt_boxes, clutter_boxes])
+    ]
+    ground = _ground_points(max_range, azimuth_resolution, rng)
+    # the ground below an object is hidden by it.
+    ground = ground[~_in_footprints(
+        ground, np.concatenate([gt_boxes, clutter_boxes]))]
+    noise = rng.uniform([-max_range, -max_range, -LIDAR_HEIGHT],
+                        [max_range, max_range, 3.0],
+                        size=[num_noise_points, 3])
+    xyz = np.concatenate(object_points + [ground, noise], axis=0)
+    reflectance = np.concatenate([
+        rng.uniform(0.0, 0.9, size=sum(len(p) for p in object_points)),
+        rng.uniform(0.0, 0.3, size=len(ground)),
+        rng.uniform(0.0, 1.0, size=num_noise_points),
+    ])
+    points = np.concatenate([xyz, reflectance[:, np.newaxis]], axis=1)
+    return points.astype(np.float32), gt_boxes, gt_names
+
+
+def _occlusion_levels(bbox, depth):
+    """0, 1 or 2 from the part of every 2d box covered by nearer boxes.
+    """
+    levels = np.zeros([len(bbox)], dtype=np.int32)
+    areas = (bbox[:, 2] - bbox[:, 0]) * (bbox[:, 3] - bbox[:, 1])
+    for i in range(len(bbox)):
+        nearer = bbox[depth < depth[i]]
+        if len(nearer) == 0:
+            continue
+        iw = np.minimum(nearer[:, 2], bbox[i, 2]) - np.maximum(
+            nearer[:, 0], bbox[i, 0])
+        ih = np.minimum(nearer[:, 3], bbox[i, 3]) - np.maximum(
+            nearer[:, 1], bbox[i, 1])
+        covered = (np.maximum(iw, 0) * np.maximum(ih, 0)).sum() / areas[i]
+        levels[i] = 0 if covered < 0.15 else (1 if covered < 0.6 else 2)
+    return levels
+
+
+def label_lines(gt_boxes, gt_names, rect=KITTI_R0_RECT,
+                Trv2c=KITTI_TR_VELO_TO_CAM, P2=KITTI_P2,
+                image_shape=IMAGE_SHAPE):
+    """kitti label_2 lines of the boxes visible in the image.
+    """
+    if len(gt_boxes) == 0:
+        return []
+    boxes_camera = box_np_ops.box_lidar_to_camera(gt_boxes, rect, Trv2c)
+    bbox = box_np_ops.box3d_to_bbox(boxes_camera, rect, Trv2c, P2)
+    clipped = bbox.copy()
+    clipped[:, :2] = np.maximum(clipped[:, :2], 0)
+    clipped[:, 2:] = np.minimum(clipped[:, 2:], image_shape[::-1])
+    area = (bbox[:, 2] - bbox[:, 0]) * (bbox[:, 3] - bbox[:, 1])
+    clipped_area = np.maximum(clipped[:, 2] - clipped[:, 0], 0) * np.maximum(
+        clipped[:, 3] - clipped[:, 1], 0)
+    # boxes behind the camera project to garbage, drop them too.
+    visible = (clipped_area > 0) & (boxes_camera[:, 2] > 1.0)
+    truncated = 1 - clipped_area / np.maximum(area, 1e-6)
+    occluded = _occlusion_levels(clipped, boxes_camera[:, 2])
+    alpha = -np.arctan2(-gt_boxes[:, 1], gt_boxes[:, 0]) + boxes_camera[:, 6]
+    lines = []
+    for i in np.where(visible)[0]:
+        l, h, w = boxes_camera[i, 3:6]
+        lines.append(
+            "{} {:.2f} {} {:.2f} {:.2f} {:.2f} {:.2f} {:.2f} {:.2f} {:.2f} "
+            "{:.2f} {:.2f} {:.2f} {:.2f} {:.2f}".format(
+                gt_names[i], truncated[i], occluded[i], alpha[i],
+                *clipped[i], h, w, l, *boxes_camera[i, :3],
+                boxes_camera[i, 6]))
+    return lines
+
+
+def calib_lines():
+    def fmt(name, mat):
+        return name + ": " + " ".join("{:.12e}".format(v)
+                                      for v in mat.reshape(-1))
+
+    return [
+        fmt("P0", KITTI_P0[:3]),
+        fmt("P1", KITTI_P1[:3]),
+        fmt("P2", KITTI_P2[:3]),
+        fmt("P3", KITTI_P3[:3]),
+        fmt("R0_rect", KITTI_R0_RECT[:3, :3]),
+        fmt("Tr_velo_to_cam", KITTI_TR_VELO_TO_CAM[:3]),
+        fmt("Tr_imu_to_velo", KITTI_TR_IMU_TO_VELO[:3]),
+    ]
+
+
+def write_dataset(data_path, num_train=32, num_val=16, num_test=8, seed=0,
+                  **scene_kwargs):
+    """write the kitti tree of a synthetic dataset. train and val frames
+    are training/ 0 .. num_train + num_val - 1, test frames testing/
+    0 .. num_test - 1.
+    Args:
+        scene_kwargs: see sample_scene.
+    """
+    root = pathlib.Path(data_path)
+    rng = np.random.default_rng(seed)
+    image = np.zeros([*IMAGE_SHAPE, 3], dtype=np.uint8)
+    splits = {
+        "training": range(num_train + num_val),
+        "testing": range(num_test),
+    }
+    for split, image_ids in splits.items():
+        folders = ["calib", "image_2", "velodyne", "velodyne_reduced"]
+        if split == "training":
+            folders.append("label_2")
+        for folder in folders:
+            (root / split / folder).mkdir(parents=True, exist_ok=True)
+        for idx in image_ids:
+            name = "{:06d}".format(idx)
+            points, gt_boxes, gt_names = sample_scene(rng, **scene_kwargs)
+            with open(root / split / "velodyne" / (name + ".bin"), "w") as f:
+                points.tofile(f)
+            with open(root / split / "calib" / (name + ".txt"), "w") as f:
+                f.write("\n".join(calib_lines()) + "\n")
+            imgio.imsave(str(root / split / "image_2" / (name + ".png")),
+                         image, check_contrast=False)
+            if split == "training":
+                with open(root / split / "label_2" / (name + ".txt"),
+                          "w") as f:
+                    f.write("".join(
+                        line + "\n"
+                        for line in label_lines(gt_boxes, gt_names)))
+    imageset_path = root / "ImageSets"
+    imageset_path.mkdir(parents=True, exist_ok=True)
+    train_ids = list(range(num_train))
+    val_ids = list(range(num_train, num_train + num_val))
+    imagesets = {
+        "train": train_ids,
+        "val": val_ids,
+        "trainval": train_ids + val_ids,
+        "test": list(range(num_test)),
+    }
+    for name, image_ids in imagesets.items():
+        with open(imageset_path / (name + ".txt"), "w") as f:
+            f.write("".join("{:06d}\n".format(i) for i in image_ids))
+    return imageset_path
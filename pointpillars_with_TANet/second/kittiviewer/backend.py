@@ -20,10 +20,11 @@ from second.core.region_similarity import (
     DistanceSimilarity, NearestIouSimilarity, RotateIouSimilarity)
 from second.core.sample_ops import DataBaseSamplerV2
 from second.core.target_assigner import TargetAssigner
-from second.data import kitti_common as kitti
+from second.data.kitti_results import load_detections
 from second.protos import pipeline_pb2
 from second.utils.eval import get_coco_eval_result, get_official_eval_result
-from second.pytorch.inference import TorchInferenceContext
+from second.pytorch.inference import (INFERENCE_CONTEXTS,
+                                      build_inference_context)
 from second.utils.progress_bar import list_bar
 
 app = Flask("second")
@@ -92,11 +93,7 @@ def read_detection():
     if BACKEND.kitti_infos is None:
         return error_response("kitti info is not loaded")
 
-    if Path(det_path).is_file():
-        with open(det_path, "rb") as f:
-            dt_annos = pickle.load(f)
-    else:
-        dt_annos = kitti.get_label_annos(det_path)
+    dt_annos = load_detections(det_path)
     BACKEND.dt_annos = dt_annos
     response = jsonify(results=[response])
     response.headers['Access-Control-Allow-Headers'] = '*'
@@ -224,6 +221,8 @@ def build_network():
     instance = request.json
     cfg_path = Path(instance["config_path"])
     ckpt_path = Path(instance["checkpoint_path"])
+    # "torch": cuda + .tckpt, "cpu": directory from pytorch/export.py
+    backend = instance.get("backend", "torch")
     response = {"status": "normal"}
     if BACKEND.root_path is None:
         return error_response("root path is not set")
@@ -233,7 +232,16 @@ def build_network():
         return error_response("config file not exist.")
     if not ckpt_path.exists():
         return error_response("ckpt file not exist.")
-    BACKEND.inference_ctx = TorchInferenceContext()
+    if backend not in INFERENCE_CONTEXTS:
+        return error_response("unknown inference backend {}.".format(backend))
+    # inference_by_idx shows the refine annos of PSA / RefineDet.
+    ctx_kwargs = {"refine_only": True}
+    if backend == "torch":
+        ctx_kwargs["precision"] = instance.get("precision")
+    if backend == "cpu":
+        ctx_kwargs["intra_op_threads"] = instance.get("intra_op_threads")
+        ctx_kwargs["inter_op_threads"] = instance.get("inter_op_threads")
+    BACKEND.inference_ctx = build_inference_context(backend, **ctx_kwargs)
     BACKEND.inference_ctx.build(str(cfg_path))
     BACKEND.inference_ctx.restore(str(ckpt_path))
     response = jsonify(results=[response])
@@ -40,6 +40,7 @@ from second.core.region_similarity import (
 from second.core.sample_ops import DataBaseSamplerV2
 from second.core.target_assigner import TargetAssigner
 from second.data import kitti_common as kitti
+from second.data.kitti_results import load_detections
 from second.kittiviewer.glwidget import KittiGLViewWidget
 from second.protos import pipeline_pb2
 from second.utils import bbox_plot
@@ -836,11 +837,7 @@ class KittiViewer(QMainWindow):
 
     def on_loadDetPressed(self):
         det_path = self.w_det_path.text()
-        if Path(det_path).is_file():
-            with open(det_path, "rb") as f:
-                dt_annos = pickle.load(f)
-        else:
-            dt_annos = kitti.get_label_annos(det_path)
+        dt_annos = load_detections(det_path)
         if len(dt_annos) == 0:
             self.warning("detection path contain nothing.")
             return
@@ -50,11 +50,13 @@ def build(input_reader_config,
           model_config,
           training,
           voxel_generator,
-          target_assigner=None) -> DatasetWrapper:
+          target_assigner=None,
+          cache_dir=None) -> DatasetWrapper:
     """Builds a tensor dictionary based on the InputReader config.
 
     Args:
         input_reader_config: A input_reader_pb2.InputReader object.
+        cache_dir: see dataset_builder.build.
 
     Returns:
         A tensor dict based on the input_reader_config.
@@ -67,6 +69,7 @@ def build(input_reader_config,
         raise ValueError('input_reader_config not of type '
                          'input_reader_pb2.InputReader.')
     dataset = dataset_builder.build(input_reader_config, model_config,
-                                    training, voxel_generator, target_assigner)
+                                    training, voxel_generator, target_assigner,
+                                    cache_dir)
     dataset = DatasetWrapper(dataset)
     return dataset
@@ -9,9 +9,18 @@ from torch import stack as tstack
 import torchplus
 from torchplus.tools import torch_to_np_dtype
 from second.core.box_np_ops import iou_jit
-from second.core.non_max_suppression.nms_gpu import (nms_gpu, rotate_iou_gpu,
-                                                       rotate_nms_gpu)
-from second.core.non_max_suppression.nms_cpu import rotate_nms_cc
+from second.core.non_max_suppression.nms_parallel import (
+    nms_cpu_parallel, rotate_nms_cpu_parallel)
+
+# "torch": iou matrix and greedy suppression on the device of the boxes.
+# "legacy": nms_gpu / rotate_nms_cc, need numba.cuda and the pybind build.
+# "cpu": numba parallel kernels with the same suppression rule.
+# "auto": legacy for cuda tensors, cpu otherwise. torch is opt-in, it
+# skips the host round trip on cuda but is much slower than the numba
+# kernels on cpu.
+NMS_BACKENDS = ["auto", "torch", "legacy", "cpu"]
+# rotated overlaps are computed in chunks of box pairs to bound memory.
+ROTATE_IOU_CHUNK = 65536
 
 
 def second_box_encode(boxes, anchors, encode_angle_to_vector=False, smooth_dim=False):
@@ -392,6 +401,32 @@ def box_lidar_to_camera(data, r_rect, velo2cam):
     return torch.cat([xyz, l, h, w, r], dim=-1)
 
 
+def batched_box_lidar_to_camera(data, r_rect, velo2cam):
+    """box_lidar_to_camera with one calibration per box.
+    Args:
+        data: [N, 7] lidar boxes.
+        r_rect, velo2cam: [N, 4, 4]
+    """
+    xyz_lidar = data[..., 0:3]
+    w, l, h = data[..., 3:4], data[..., 4:5], data[..., 5:6]
+    r = data[..., 6:7]
+    points = torch.cat([xyz_lidar, torch.ones_like(w)], dim=-1)
+    xyz = torch.einsum('nj,nij->ni', points, r_rect @ velo2cam)[..., :3]
+    return torch.cat([xyz, l, h, w, r], dim=-1)
+
+
+def batched_project_to_image(points_3d, proj_mat):
+    """project_to_image with one projection matrix per point set.
+    Args:
+        points_3d: [N, K, 3]
+        proj_mat: [N, 4, 4]
+    """
+    points_4 = torch.cat(
+        [points_3d, torch.zeros_like(points_3d[..., :1])], dim=-1)
+    point_2d = torch.einsum('nkj,nij->nki', points_4, proj_mat)
+    return point_2d[..., :2] / point_2d[..., 2:3]
+
+
 def multiclass_nms(nms_func,
                    boxes,
                    scores,
@@ -441,53 +476,237 @@ def multiclass_nms(nms_func,
             selected_per_class.append(None)
     return selected_per_class
 
-def nms(bboxes,
-        scores,
-        pre_max_size=None,
-        post_max_size=None,
-        iou_threshold=0.5):
+def _cross_2d(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
+def _points_in_quadrilateral(quads, points):
+    """same test as point_in_quadrilateral of the gpu kernel.
+    Args:
+        quads: [P, 4, 2] corners in polygon order.
+        points: [P, K, 2]
+    Returns:
+        [P, K] bool
+    """
+    origin = quads[:, 0:1]
+    ab = quads[:, 1:2] - origin
+    ad = quads[:, 3:4] - origin
+    ap = points - origin
+    abab = (ab * ab).sum(-1)
+    abap = (ab * ap).sum(-1)
+    adad = (ad * ad).sum(-1)
+    adap = (ad * ap).sum(-1)
+    return (abab >= abap) & (abap >= 0) & (adad >= adap) & (adap >= 0)
+
+
+def _edge_intersections(quads1, quads2):
+    """intersections of every edge of quads1 with every edge of quads2.
+    Returns:
+        points: [P, 16, 2]
+        valid: [P, 16] bool
+    """
+    a = quads1[:, :, None]
+    ba = quads1.roll(-1, dims=1)[:, :, None] - a
+    c = quads2[:, None]
+    dc = quads2.roll(-1, dims=1)[:, None] - c
+    ca = c - a
+    denom = _cross_2d(ba, dc)
+    nonzero = denom != 0
+    denom = torch.where(nonzero, denom, torch.ones_like(denom))
+    t = _cross_2d(ca, dc) / denom
+    u = _cross_2d(ca, ba) / denom
+    valid = nonzero & (t > 0) & (t < 1) & (u > 0) & (u < 1)
+    points = a + t.unsqueeze(-1) * ba
+    num_pairs = quads1.shape[0]
+    return points.view(num_pairs, 16, 2), valid.view(num_pairs, 16)
+
+
+def quadrilateral_intersection_area(quads1, quads2):
+    """area of the intersection of convex quadrilaterals, vectorized
+    over pairs. the clipped polygon is built like the gpu kernel:
+    corners inside the other box plus edge intersections, sorted by
+    angle around their mean.
+    Args:
+        quads1, quads2: [P, 4, 2] corners in polygon order.
+    Returns:
+        [P] intersection areas.
+    """
+    edge_points, edge_valid = _edge_intersections(quads1, quads2)
+    points = torch.cat([quads1, quads2, edge_points], dim=1)
+    valid = torch.cat([
+        _points_in_quadrilateral(quads2, quads1),
+        _points_in_quadrilateral(quads1, quads2), edge_valid
+    ], dim=1)
+    num_valid = valid.sum(dim=1)
+    weights = valid.type_as(points).unsqueeze(-1)
+    center = (points * weights).sum(dim=1) / num_valid.clamp(
+        min=1).type_as(points).unsqueeze(-1)
+    rel = points - center.unsqueeze(1)
+    # pseudo angle of sort_vertex_in_convex_polygon, cheaper than atan2.
+    norm = rel.norm(dim=-1).clamp(min=1e-12)
+    angles = rel[..., 0] / norm
+    angles = torch.where(rel[..., 1] < 0, -2 - angles, angles)
+    angles = torch.where(valid, angles, torch.full_like(angles, math.inf))
+    order = angles.argsort(dim=1)
+    rel = torch.gather(rel, 1, order.unsqueeze(-1).expand_as(rel))
+    valid = torch.gather(valid, 1, order)
+    # invalid points (sorted last) collapse onto the first point, they
+    # add zero area to the shoelace sum.
+    rel = torch.where(valid.unsqueeze(-1), rel, rel[:, :1].expand_as(rel))
+    area = _cross_2d(rel, rel.roll(-1, dims=1)).sum(dim=1).abs() / 2
+    return torch.where(num_valid >= 3, area, torch.zeros_like(area))
+
+
+def rotate_iou_pairs(rbboxes1, rbboxes2):
+    """bev iou of rbboxes1[i] and rbboxes2[i].
+    Args:
+        rbboxes1, rbboxes2: [P, 5] of [x, y, w, l, angle].
+    Returns:
+        [P] iou
+    """
+    corners1 = center_to_corner_box2d(rbboxes1[:, :2], rbboxes1[:, 2:4],
+                                      rbboxes1[:, 4])
+    corners2 = center_to_corner_box2d(rbboxes2[:, :2], rbboxes2[:, 2:4],
+                                      rbboxes2[:, 4])
+    inter = quadrilateral_intersection_area(corners1, corners2)
+    area1 = rbboxes1[:, 2] * rbboxes1[:, 3]
+    area2 = rbboxes2[:, 2] * rbboxes2[:, 3]
+    return inter / (area1 + area2 - inter).clamp(min=1e-8)
+
+
+def _standup_overlap_mask(standup):
+    """[N, N] bool, i < j and the standup boxes overlap.
+    """
+    x1, y1, x2, y2 = standup.unbind(dim=1)
+    overlap = (x1[:, None] < x2[None, :]) & (x1[None, :] < x2[:, None])
+    overlap &= (y1[:, None] < y2[None, :]) & (y1[None, :] < y2[:, None])
+    return torch.triu(overlap, diagonal=1)
+
+
+def _suppression_matrix(boxes, iou_threshold, rotate):
+    """[N, N] bool, True if box j (j > i) is suppressed by box i.
+    boxes are sorted by score.
+    """
+    if rotate:
+        corners = center_to_corner_box2d(boxes[:, :2], boxes[:, 2:4],
+                                         boxes[:, 4])
+        suppress = _standup_overlap_mask(corner_to_standup_nd(corners))
+        i, j = torch.nonzero(suppress, as_tuple=True)
+        for start in range(0, i.shape[0], ROTATE_IOU_CHUNK):
+            ci = i[start:start + ROTATE_IOU_CHUNK]
+            cj = j[start:start + ROTATE_IOU_CHUNK]
+            suppress[ci, cj] = rotate_iou_pairs(boxes[ci],
+                                                boxes[cj]) > iou_threshold
+        return suppress
+    # same +1 area convention as nms_gpu.
+    x1, y1, x2, y2 = boxes.unbind(dim=1)
+    w = (torch.min(x2[:, None], x2[None, :]) -
+         torch.max(x1[:, None], x1[None, :]) + 1).clamp_(min=0)
+    h = (torch.min(y2[:, None], y2[None, :]) -
+         torch.max(y1[:, None], y1[None, :]) + 1).clamp_(min=0)
+    inter = w.mul_(h)
+    area = (x2 - x1 + 1) * (y2 - y1 + 1)
+    iou = inter / (area[:, None] + area[None, :] - inter)
+    return torch.triu(iou > iou_threshold, diagonal=1)
+
+
+def greedy_keep(suppress):
+    """greedy nms on a suppression matrix of score sorted boxes.
+    box j is kept iff no kept box i < j suppresses it. the system is
+    triangular, so the jacobi iteration below reaches its unique fixed
+    point (the greedy result) after at most "longest suppression chain"
+    steps, usually a handful of matrix-vector products.
+    Returns:
+        [N] bool keep mask.
+    """
+    suppress = suppress.type(torch.float32)
+    keep = torch.ones(
+        suppress.shape[0], dtype=torch.bool, device=suppress.device)
+    for _ in range(suppress.shape[0]):
+        new_keep = (keep.type(torch.float32) @ suppress) == 0
+        if torch.equal(new_keep, keep):
+            break
+        keep = new_keep
+    return keep
+
+
+def _nms_torch(dets, iou_threshold, post_max_size, rotate):
+    order = torch.argsort(dets[:, -1], descending=True)
+    boxes = dets[order, :-1].float()
+    keep = greedy_keep(_suppression_matrix(boxes, iou_threshold, rotate))
+    return order[keep][:post_max_size]
+
+
+def resolve_nms_backend(backend, device):
+    if backend not in NMS_BACKENDS:
+        raise ValueError("unknown nms backend {}, available: {}".format(
+            backend, ", ".join(NMS_BACKENDS)))
+    if backend == "auto":
+        return "legacy" if device.type == "cuda" else "cpu"
+    return backend
+
+
+def _nms_numpy(dets_np, iou_threshold, post_max_size, rotate, backend):
+    if backend == "cpu":
+        kernel = rotate_nms_cpu_parallel if rotate else nms_cpu_parallel
+        return kernel(dets_np, iou_threshold, max_keep=post_max_size)
+    # imported lazily, cuda and the pybind extension are optional.
+    if rotate:
+        from second.core.non_max_suppression.nms_cpu import rotate_nms_cc
+        ret = rotate_nms_cc(dets_np, iou_threshold)
+    else:
+        from second.core.non_max_suppression.nms_gpu import nms_gpu
+        ret = nms_gpu(dets_np, iou_threshold)
+    return np.array(ret, dtype=np.int64)
+
+
+def _nms(boxes, scores, pre_max_size, post_max_size, iou_threshold, rotate,
+         backend):
     if pre_max_size is not None:
         num_keeped_scores = scores.shape[0]
         pre_max_size = min(num_keeped_scores, pre_max_size)
         scores, indices = torch.topk(scores, k=pre_max_size)
-        bboxes = bboxes[indices]
-    dets = torch.cat([bboxes, scores.unsqueeze(-1)], dim=1)
-    dets_np = dets.data.cpu().numpy()
-    if len(dets_np) == 0:
-        keep = np.array([], dtype=np.int64)
+        boxes = boxes[indices]
+    dets = torch.cat([boxes, scores.unsqueeze(-1)], dim=1)
+    backend = resolve_nms_backend(backend, dets.device)
+    if dets.shape[0] == 0:
+        return None
+    if backend == "torch":
+        keep = _nms_torch(dets, iou_threshold, post_max_size, rotate)
     else:
-        ret = np.array(nms_gpu(dets_np, iou_threshold), dtype=np.int64)
-        keep = ret[:post_max_size]
+        dets_np = dets.data.cpu().numpy()
+        ret = _nms_numpy(dets_np, iou_threshold, post_max_size, rotate,
+                         backend)
+        keep = torch.from_numpy(ret[:post_max_size]).long().to(dets.device)
     if keep.shape[0] == 0:
         return None
     if pre_max_size is not None:
-        keep = torch.from_numpy(keep).long().cuda()
         return indices[keep]
     else:
-        return torch.from_numpy(keep).long().cuda()
+        return keep
+
+
+def nms(bboxes,
+        scores,
+        pre_max_size=None,
+        post_max_size=None,
+        iou_threshold=0.5,
+        backend="auto"):
+    """axis-aligned nms, bboxes: [N, 4] of [x1, y1, x2, y2].
+    the keep indices stay on the device of bboxes.
+    """
+    return _nms(bboxes, scores, pre_max_size, post_max_size, iou_threshold,
+                False, backend)
 
 
 def rotate_nms(rbboxes,
                scores,
                pre_max_size=None,
                post_max_size=None,
-               iou_threshold=0.5):
-    if pre_max_size is not None:
-        num_keeped_scores = scores.shape[0]
-        pre_max_size = min(num_keeped_scores, pre_max_size)
-        scores, indices = torch.topk(scores, k=pre_max_size)
-        rbboxes = rbboxes[indices]
-    dets = torch.cat([rbboxes, scores.unsqueeze(-1)], dim=1)
-    dets_np = dets.data.cpu().numpy()
-    if len(dets_np) == 0:
-        keep = np.array([], dtype=np.int64)
-    else:
-        ret = np.array(rotate_nms_cc(dets_np, iou_threshold), dtype=np.int64)
-        keep = ret[:post_max_size]
-    if keep.shape[0] == 0:
-        return None
-    if pre_max_size is not None:
-        keep = torch.from_numpy(keep).long().cuda()
-        return indices[keep]
-    else:
-        return torch.from_numpy(keep).long().cuda()
+               iou_threshold=0.5,
+               backend="auto"):
+    """rotated nms, rbboxes: [N, 5] of [x, y, w, l, angle].
+    the keep indices stay on the device of rbboxes.
+    """
+    return _nms(rbboxes, scores, pre_max_size, post_max_size, iou_threshold,
+                True, backend)
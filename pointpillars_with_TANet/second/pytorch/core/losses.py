@@ -120,7 +120,7 @@ class WeightedL2LocalizationLoss(Loss):
     super().__init__()
     if code_weights is not None:
       self._code_weights = np.array(code_weights, dtype=np.float32)
-      self._code_weights = Variable(torch.from_numpy(self._code_weights).cuda())
+      self._code_weights = Variable(torch.from_numpy(self._code_weights))
     else:
       self._code_weights = None
 
@@ -160,7 +160,7 @@ class WeightedSmoothL1LocalizationLoss(Loss):
     self._sigma = sigma
     if code_weights is not None:
       self._code_weights = np.array(code_weights, dtype=np.float32)
-      self._code_weights = Variable(torch.from_numpy(self._code_weights).cuda())
+      self._code_weights = Variable(torch.from_numpy(self._code_weights))
     else:
       self._code_weights = None
     self._codewise = codewise
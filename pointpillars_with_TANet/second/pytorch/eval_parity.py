@@ -0,0 +1,149 @@
+"""parity of the cpu rotated iou of the kitti eval against the gpu one.
+
+a recorded result set (result.pkl of dt annos, result.npz or a
+directory of kitti label files) is evaluated against the gt annos of an
+info file with every available iou backend. the bev and 3d overlap
+matrices and the official APs must be identical to the reference
+backend ("gpu" if a cuda device is available). the cpu kernel without the axis-aligned
+prefilter is compared as well, so the check is meaningful on cpu-only
+hosts. frames whose detections are exact duplicates of the gt boxes are
+added to the recorded ones.
+
+usage:
+    python ./pytorch/eval_parity.py check --result_path=result.pkl \
+        --info_path=kitti_infos_val.pkl --class_names=[Car]
+"""
+import pickle
+import time
+
+import fire
+import numpy as np
+from numba import cuda
+
+from second.core.non_max_suppression.nms_parallel import rotate_iou_cpu
+from second.data.kitti_results import load_detections
+from second.utils.eval import calculate_iou_partly, get_official_eval_result
+
+
+def _load_annos(result_path, info_path, num_frames=None):
+    with open(info_path, "rb") as f:
+        kitti_infos = pickle.load(f)
+    gt_annos = [info["annos"] for info in kitti_infos]
+    image_ids = [info["image_idx"] for info in kitti_infos]
+    dt_annos = load_detections(result_path, image_ids)
+    if num_frames is not None:
+        gt_annos = gt_annos[:num_frames]
+        dt_annos = dt_annos[:num_frames]
+    return gt_annos, dt_annos
+
+
+def _duplicate_frames(gt_annos, num_frames=3):
+    """gt annos of the first frames with boxes and dt annos that repeat
+    every gt box exactly. the first gt box is replaced by a box of which
+    only one corner passes point_in_quadrilateral against itself.
+    """
+    gt_frames, dt_frames = [], []
+    for anno in [a for a in gt_annos if len(a["name"]) > 0][:num_frames]:
+        gt = {k: v.copy() for k, v in anno.items()}
+        if len(gt_frames) == 0:
+            gt["location"][0, [0, 2]] = [0.9566196, 0.4077631]
+            gt["dimensions"][0, [0, 2]] = [2.3086958, 3.4210815]
+            gt["rotation_y"][0] = 2.4007568
+        dt = {
+            k: gt[k].copy()
+            for k in [
+                "name", "truncated", "occluded", "alpha", "bbox",
+                "dimensions", "location", "rotation_y"
+            ]
+        }
+        dt["score"] = np.linspace(1.0, 0.5, len(dt["name"]))
+        gt_frames.append(gt)
+        dt_frames.append(dt)
+    return gt_frames, dt_frames
+
+
+def _bev_boxes(annos):
+    loc = np.concatenate([a["location"][:, [0, 2]] for a in annos], 0)
+    dims = np.concatenate([a["dimensions"][:, [0, 2]] for a in annos], 0)
+    rots = np.concatenate([a["rotation_y"] for a in annos], 0)
+    return np.concatenate([loc, dims, rots[..., np.newaxis]], axis=1)
+
+
+def check(result_path,
+          info_path,
+          class_names=("Car", "Pedestrian", "Cyclist"),
+          num_frames=None,
+          reference=None,
+          duplicates=True):
+    """
+    Args:
+        reference: "gpu" if a cuda device is available, else "cpu".
+        duplicates: add the frames of _duplicate_frames.
+    Returns:
+        dict: backend -> {"overlaps_identical", "ap_identical",
+            "eval_s"}.
+    """
+    gt_annos, dt_annos = _load_annos(result_path, info_path, num_frames)
+    if duplicates:
+        gt_frames, dt_frames = _duplicate_frames(gt_annos)
+        gt_annos = gt_annos + gt_frames
+        dt_annos = list(dt_annos) + dt_frames
+    class_names = list(class_names)
+    backends = ["cpu"]
+    if cuda.is_available():
+        backends.append("gpu")
+    else:
+        print("no cuda device, gpu backend skipped")
+    if reference is None:
+        reference = backends[-1]
+    # jit compilation of the iou kernels isn't part of the eval time.
+    for metric in [1, 2]:
+        calculate_iou_partly(dt_annos[:1], gt_annos[:1], metric, 1,
+                             iou_backend="cpu")
+    overlaps = {}
+    aps = {}
+    report = {}
+    for backend in backends:
+        t = time.perf_counter()
+        _, *ap = get_official_eval_result(gt_annos,
+                                          dt_annos,
+                                          class_names,
+                                          return_data=True,
+                                          iou_backend=backend)
+        report[backend] = {"eval_s": time.perf_counter() - t}
+        aps[backend] = ap
+        overlaps[backend] = [
+            calculate_iou_partly(dt_annos, gt_annos, metric,
+                                 iou_backend=backend)[1]
+            for metric in [1, 2]
+        ]
+    for backend in backends:
+        report[backend]["overlaps_identical"] = all(
+            np.array_equal(a, b) for parts, ref_parts in zip(
+                overlaps[backend], overlaps[reference])
+            for a, b in zip(parts, ref_parts))
+        report[backend]["ap_identical"] = all(
+            (a is None and b is None) or np.array_equal(a, b)
+            for a, b in zip(aps[backend], aps[reference]))
+    dt_boxes = _bev_boxes(dt_annos)
+    gt_boxes = _bev_boxes(gt_annos)
+    t = time.perf_counter()
+    dense = rotate_iou_cpu(dt_boxes, gt_boxes, prefilter=False)
+    dense_s = time.perf_counter() - t
+    t = time.perf_counter()
+    prefiltered = rotate_iou_cpu(dt_boxes, gt_boxes)
+    prefiltered_s = time.perf_counter() - t
+    print("{} frames, {} dt, {} gt boxes, reference {}".format(
+        len(gt_annos), len(dt_boxes), len(gt_boxes), reference))
+    for backend, r in report.items():
+        print("  {:<6}overlaps identical: {}  AP identical: {}  "
+              "eval {:.2f} s".format(backend, r["overlaps_identical"],
+                                     r["ap_identical"], r["eval_s"]))
+    print("  cpu prefilter, all dt x gt bev pairs: identical {}  "
+          "{:.3f} s vs {:.3f} s without".format(
+              np.array_equal(dense, prefiltered), prefiltered_s, dense_s))
+    return report
+
+
+if __name__ == '__main__':
+    fire.Fire()
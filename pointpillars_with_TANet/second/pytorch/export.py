@@ -0,0 +1,275 @@
+"""export the VFE and RPN of a trained VoxelNet for CPU inference.
+
+the exported directory contains a traced VFE and RPN (TorchScript
+``*.pt`` or ONNX ``*.onnx``) plus ``export.json`` which stores the
+backend and the rpn output names. the scatter and the postprocess
+(decode, nms, projection) still run in VoxelNet, so exported modules
+are plugged back into a cpu VoxelNet by ``load_exported``.
+
+usage:
+    python ./pytorch/export.py export --config_path=... \
+        --ckpt_path=.../voxelnet-xxx.tckpt --output_dir=... \
+        --backend=onnxruntime
+"""
+import json
+import pathlib
+
+import fire
+import numpy as np
+import torch
+from google.protobuf import text_format
+from torch import nn
+
+import torchplus
+from second.builder import target_assigner_builder, voxel_builder
+from second.protos import pipeline_pb2
+from second.pytorch.builder import box_coder_builder, second_builder
+
+BACKENDS = ["torchscript", "onnxruntime"]
+EXPORT_INFO_NAME = "export.json"
+_ARTIFACT_SUFFIX = {"torchscript": ".pt", "onnxruntime": ".onnx"}
+
+
+class VFEExportWrapper(nn.Module):
+    def __init__(self, vfe):
+        super().__init__()
+        self.vfe = vfe
+
+    def forward(self, voxels, num_points, coordinates):
+        return self.vfe(voxels, num_points, coordinates)
+
+
+class RPNExportWrapper(nn.Module):
+    """rpn returns a dict, exporters need a flat tuple.
+    """
+    def __init__(self, rpn, output_names):
+        super().__init__()
+        self.rpn = rpn
+        self.output_names = list(output_names)
+
+    def forward(self, spatial_features):
+        preds_dict = self.rpn(spatial_features)
+        return tuple(preds_dict[name] for name in self.output_names)
+
+
+class ExportedVFE(nn.Module):
+    """drop-in replacement of voxel_feature_extractor backed by an
+    exported artifact.
+    """
+    def __init__(self, runner, backend):
+        super().__init__()
+        self._runner = runner
+        self._backend = backend
+
+    def forward(self, features, num_voxels, coors):
+        if self._backend == "torchscript":
+            return self._runner(features, num_voxels, coors)
+        feed = {
+            "voxels": features.cpu().numpy(),
+            "num_points": num_voxels.cpu().numpy(),
+            "coordinates": coors.cpu().numpy(),
+        }
+        ret = self._runner.run(None, feed)[0]
+        return torch.from_numpy(ret).to(features.device)
+
+
+class ExportedRPN(nn.Module):
+    """drop-in replacement of rpn backed by an exported artifact.
+    """
+    def __init__(self, runner, backend, output_names):
+        super().__init__()
+        self._runner = runner
+        self._backend = backend
+        self.output_names = list(output_names)
+
+    def forward(self, x, bev=None):
+        if self._backend == "torchscript":
+            outputs = self._runner(x)
+        else:
+            feed = {"spatial_features": x.cpu().numpy()}
+            outputs = [
+                torch.from_numpy(ret).to(x.device)
+                for ret in self._runner.run(None, feed)
+            ]
+        return dict(zip(self.output_names, outputs))
+
+
+def set_torch_threads(intra_op_threads=None, inter_op_threads=None):
+    if intra_op_threads is not None:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads is not None:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError:
+            # can only be set once, before any inter-op parallel work.
+            print("inter-op threads already initialized, keep {}".format(
+                torch.get_num_interop_threads()))
+
+
+def _ort_session(path, intra_op_threads=None, inter_op_threads=None):
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.graph_optimization_level = (
+        ort.GraphOptimizationLevel.ORT_ENABLE_ALL)
+    if intra_op_threads is not None:
+        options.intra_op_num_threads = intra_op_threads
+    if inter_op_threads is not None:
+        options.inter_op_num_threads = inter_op_threads
+        if inter_op_threads > 1:
+            options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    return ort.InferenceSession(
+        str(path), options, providers=["CPUExecutionProvider"])
+
+
+def load_exported(export_dir, intra_op_threads=None, inter_op_threads=None):
+    """load exported vfe and rpn.
+    Returns:
+        vfe: ExportedVFE
+        rpn: ExportedRPN
+        export_info: dict stored in export.json
+    """
+    export_dir = pathlib.Path(export_dir)
+    with open(export_dir / EXPORT_INFO_NAME, "r") as f:
+        export_info = json.load(f)
+    backend = export_info["backend"]
+    suffix = _ARTIFACT_SUFFIX[backend]
+    vfe_path = export_dir / ("vfe" + suffix)
+    rpn_path = export_dir / ("rpn" + suffix)
+    if backend == "torchscript":
+        set_torch_threads(intra_op_threads, inter_op_threads)
+        vfe_runner = torch.jit.load(str(vfe_path), map_location="cpu")
+        rpn_runner = torch.jit.load(str(rpn_path), map_location="cpu")
+    else:
+        vfe_runner = _ort_session(vfe_path, intra_op_threads,
+                                  inter_op_threads)
+        rpn_runner = _ort_session(rpn_path, intra_op_threads,
+                                  inter_op_threads)
+    vfe = ExportedVFE(vfe_runner, backend)
+    rpn = ExportedRPN(rpn_runner, backend, export_info["rpn_output_names"])
+    return vfe, rpn, export_info
+
+
+def _dummy_vfe_inputs(model_cfg, voxel_generator, num_voxels):
+    max_num_points = voxel_generator.max_num_points_per_voxel
+    grid_size = voxel_generator.grid_size
+    num_point_features = model_cfg.num_point_features
+    # random points inside the point cloud range, one voxel per pillar.
+    pc_range = voxel_generator.point_cloud_range
+    voxels = np.random.uniform(
+        pc_range[:3], pc_range[3:],
+        size=[num_voxels, max_num_points, 3]).astype(np.float32)
+    voxels = np.concatenate([
+        voxels,
+        np.zeros([num_voxels, max_num_points, num_point_features - 3],
+                 dtype=np.float32)
+    ], axis=-1)
+    num_points = np.random.randint(
+        1, max_num_points + 1, size=[num_voxels]).astype(np.int32)
+    coors = np.zeros([num_voxels, 4], dtype=np.int32)
+    flat = np.random.choice(
+        grid_size[0] * grid_size[1], num_voxels, replace=False)
+    coors[:, 2] = flat // grid_size[0]
+    coors[:, 3] = flat % grid_size[0]
+    return (torch.from_numpy(voxels), torch.from_numpy(num_points),
+            torch.from_numpy(coors))
+
+
+def export_net(net,
+               model_cfg,
+               voxel_generator,
+               output_dir,
+               backend="torchscript",
+               num_voxels=4000,
+               opset_version=11,
+               **export_info):
+    """trace vfe and rpn of a built cpu net and write them to output_dir.
+    extra keyword arguments are stored in export.json.
+    """
+    assert backend in BACKENDS, "backend must be one of {}".format(BACKENDS)
+    output_dir = pathlib.Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    voxels, num_points, coors = _dummy_vfe_inputs(model_cfg, voxel_generator,
+                                                  num_voxels)
+    vfe = VFEExportWrapper(net.voxel_feature_extractor).eval()
+    with torch.no_grad():
+        voxel_features = vfe(voxels, num_points, coors)
+        spatial_features = net.middle_feature_extractor(
+            voxel_features, coors, 1)
+        output_names = list(net.rpn(spatial_features).keys())
+    rpn = RPNExportWrapper(net.rpn, output_names).eval()
+
+    suffix = _ARTIFACT_SUFFIX[backend]
+    vfe_path = output_dir / ("vfe" + suffix)
+    rpn_path = output_dir / ("rpn" + suffix)
+    with torch.no_grad():
+        if backend == "torchscript":
+            torch.jit.trace(vfe, (voxels, num_points, coors),
+                            check_trace=False).save(str(vfe_path))
+            torch.jit.trace(rpn, (spatial_features, ),
+                            check_trace=False).save(str(rpn_path))
+        else:
+            torch.onnx.export(
+                vfe, (voxels, num_points, coors),
+                str(vfe_path),
+                input_names=["voxels", "num_points", "coordinates"],
+                output_names=["voxel_features"],
+                dynamic_axes={
+                    "voxels": {0: "num_voxels"},
+                    "num_points": {0: "num_voxels"},
+                    "coordinates": {0: "num_voxels"},
+                    "voxel_features": {0: "num_voxels"},
+                },
+                opset_version=opset_version)
+            torch.onnx.export(
+                rpn, (spatial_features, ),
+                str(rpn_path),
+                input_names=["spatial_features"],
+                output_names=output_names,
+                opset_version=opset_version)
+    export_info = {
+        "backend": backend,
+        "rpn_output_names": output_names,
+        **export_info,
+    }
+    with open(output_dir / EXPORT_INFO_NAME, "w") as f:
+        json.dump(export_info, f, indent=2)
+    print("export {} model to {}".format(backend, output_dir))
+
+
+def export(config_path,
+           ckpt_path,
+           output_dir,
+           backend="torchscript",
+           num_voxels=4000,
+           opset_version=11):
+    """export vfe and rpn of a checkpoint to output_dir.
+    """
+    config = pipeline_pb2.TrainEvalPipelineConfig()
+    with open(config_path, "r") as f:
+        proto_str = f.read()
+        text_format.Merge(proto_str, config)
+    model_cfg = config.model.second
+
+    voxel_generator = voxel_builder.build(model_cfg.voxel_generator)
+    bv_range = voxel_generator.point_cloud_range[[0, 1, 3, 4]]
+    box_coder = box_coder_builder.build(model_cfg.box_coder)
+    target_assigner = target_assigner_builder.build(
+        model_cfg.target_assigner, bv_range, box_coder)
+    net = second_builder.build(model_cfg, voxel_generator, target_assigner)
+    net.eval()
+    torchplus.train.restore(ckpt_path, net)
+    net.cpu()
+    export_net(
+        net,
+        model_cfg,
+        voxel_generator,
+        output_dir,
+        backend=backend,
+        num_voxels=num_voxels,
+        opset_version=opset_version,
+        config_path=str(config_path),
+        ckpt_path=str(ckpt_path))
+
+
+if __name__ == '__main__':
+    fire.Fire()
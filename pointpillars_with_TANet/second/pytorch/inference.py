@@ -8,15 +8,23 @@ from second.core import box_np_ops
 from second.core.inference import InferenceContext
 from second.builder import target_assigner_builder, voxel_builder
 from second.pytorch.builder import box_coder_builder, second_builder
+from second.pytorch.export import load_exported
 from second.pytorch.models.voxelnet import VoxelNet
+from second.pytorch.precision import PrecisionPolicy
 from second.pytorch.train import predict_kitti_to_anno, example_convert_to_torch
 
 
 class TorchInferenceContext(InferenceContext):
-    def __init__(self):
+    def __init__(self, device=None, precision=None, refine_only=False):
         super().__init__()
         self.net = None
         self.anchor_cache = None
+        self.device = device or torch.device("cuda:0")
+        # None: derive from train_config.enable_mixed_precision
+        self.precision = precision
+        # PSA / RefineDet: inference returns the (coarse, refine) annos,
+        # only the refine annos if refine_only.
+        self.refine_only = refine_only
 
     def _build(self):
         config = self.config
@@ -38,11 +46,10 @@ class TorchInferenceContext(InferenceContext):
         out_size_factor = model_cfg.rpn.layer_strides[0] // model_cfg.rpn.upsample_strides[0]
         self.net = second_builder.build(model_cfg, voxel_generator,
                                           target_assigner)
-        self.net.cuda().eval()
-        if train_cfg.enable_mixed_precision:
-            self.net.half()
-            self.net.metrics_to_float()
-            self.net.convert_norm_to_float(self.net)
+        self.net.to(self.device).eval()
+        self.net.set_precision_policy(
+            PrecisionPolicy.from_config(train_cfg, self.device,
+                                        self.precision))
         feature_map_size = grid_size[:2] // out_size_factor
         feature_map_size = [*feature_map_size, 1][::-1]
         ret = target_assigner.generate_anchors(feature_map_size)
@@ -65,20 +72,66 @@ class TorchInferenceContext(InferenceContext):
         torchplus.train.restore(str(ckpt_path), self.net)
 
     def _inference(self, example):
-        train_cfg = self.config.train_config
         input_cfg = self.config.eval_input_reader
         model_cfg = self.config.model.second
-        example_torch = example_convert_to_torch(example)
-        if train_cfg.enable_mixed_precision:
-            float_dtype = torch.float16
-        else:
-            float_dtype = torch.float32
-
+        # inputs stay fp32, autocast handles the network precision.
+        example_torch = example_convert_to_torch(
+            example, torch.float32, device=self.device)
+        use_coarse_to_fine = model_cfg.rpn.module_class_name in [
+            "PSA", "RefineDet"
+        ]
         result_annos = predict_kitti_to_anno(
             self.net, example_torch, list(
                 input_cfg.class_names),
-            model_cfg.post_center_limit_range, model_cfg.lidar_input)
+            model_cfg.post_center_limit_range, model_cfg.lidar_input,
+            use_coarse_to_fine=use_coarse_to_fine)
+        if use_coarse_to_fine and self.refine_only:
+            # coarse, refine. refine is the final output.
+            result_annos = result_annos[1]
         return result_annos
 
     def _ctx(self):
         return None
+
+
+class CPUInferenceContext(TorchInferenceContext):
+    """run an exported (TorchScript or ONNX Runtime) VFE and RPN on cpu.
+    preprocess, scatter and postprocess are shared with
+    TorchInferenceContext. restore takes the directory written by
+    second/pytorch/export.py instead of a .tckpt.
+    """
+    def __init__(self,
+                 intra_op_threads=None,
+                 inter_op_threads=None,
+                 refine_only=False):
+        # exported graphs are fp32 (or int8), never autocast them.
+        super().__init__(device=torch.device("cpu"),
+                         precision="fp32",
+                         refine_only=refine_only)
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.export_info = None
+
+    def _restore(self, ckpt_path):
+        vfe, rpn, export_info = load_exported(
+            ckpt_path, self.intra_op_threads, self.inter_op_threads)
+        self.net.voxel_feature_extractor = vfe
+        self.net.rpn = rpn
+        self.export_info = export_info
+
+    def _inference(self, example):
+        with torch.no_grad():
+            return super()._inference(example)
+
+
+INFERENCE_CONTEXTS = {
+    "torch": TorchInferenceContext,
+    "cpu": CPUInferenceContext,
+}
+
+
+def build_inference_context(backend="torch", **kwargs):
+    if backend not in INFERENCE_CONTEXTS:
+        raise ValueError("unknown inference backend {}, available: {}".format(
+            backend, ", ".join(INFERENCE_CONTEXTS.keys())))
+    return INFERENCE_CONTEXTS[backend](**kwargs)
@@ -0,0 +1,218 @@
+"""vectorized kitti output conversion against the per-box loop.
+
+random prediction dicts (num_dets boxes per frame, some outside the image
+or center_limit_range) go through comput_kitti_output / kitti_result_lines
+and through the original per-box loops. annos and label lines must be
+identical, the table reports the mean time per frame.
+
+usage:
+    python ./pytorch/kitti_output_benchmark.py benchmark --num_dets=300
+"""
+import time
+
+import fire
+import numpy as np
+import torch
+
+import second.data.kitti_common as kitti
+from second.pytorch.train import (comput_kitti_output, kitti_anno_arrays,
+                                  kitti_result_lines, unique_scores)
+
+CLASS_NAMES = ["Car", "Pedestrian", "Cyclist"]
+CENTER_LIMIT_RANGE = [0, -39.68, -5, 69.12, 39.68, 5]
+
+
+def _comput_kitti_output_loop(predictions_dicts, batch_image_shape,
+                              lidar_input, center_limit_range, class_names):
+    """comput_kitti_output before vectorization (without global_set).
+    """
+    annos = []
+    for i, preds_dict in enumerate(predictions_dicts):
+        image_shape = batch_image_shape[i]
+        img_idx = preds_dict["image_idx"]
+        if preds_dict["bbox"] is not None:
+            box_2d_preds = preds_dict["bbox"].detach().cpu().numpy()
+            box_preds = preds_dict["box3d_camera"].detach().cpu().numpy()
+            scores = preds_dict["scores"].detach().cpu().numpy()
+            box_preds_lidar = preds_dict["box3d_lidar"].detach().cpu().numpy()
+            label_preds = preds_dict["label_preds"].detach().cpu().numpy()
+            anno = kitti.get_start_result_anno()
+            num_example = 0
+            for box, box_lidar, bbox, score, label in zip(
+                    box_preds, box_preds_lidar, box_2d_preds, scores,
+                    label_preds):
+                if not lidar_input:
+                    if bbox[0] > image_shape[1] or bbox[1] > image_shape[0]:
+                        continue
+                    if bbox[2] < 0 or bbox[3] < 0:
+                        continue
+                if center_limit_range is not None:
+                    limit_range = np.array(center_limit_range)
+                    if np.any(box_lidar[:3] < limit_range[:3]) or np.any(
+                            box_lidar[:3] > limit_range[3:]):
+                        continue
+                bbox[2:] = np.minimum(bbox[2:], image_shape[::-1])
+                bbox[:2] = np.maximum(bbox[:2], [0, 0])
+                anno["name"].append(class_names[int(label)])
+                anno["truncated"].append(0.0)
+                anno["occluded"].append(0)
+                anno["alpha"].append(
+                    -np.arctan2(-box_lidar[1], box_lidar[0]) + box[6])
+                anno["bbox"].append(bbox)
+                anno["dimensions"].append(box[3:6])
+                anno["location"].append(box[:3])
+                anno["rotation_y"].append(box[6])
+                anno["score"].append(score)
+                num_example += 1
+            if num_example != 0:
+                anno = {n: np.stack(v) for n, v in anno.items()}
+                annos.append(anno)
+            else:
+                annos.append(kitti.empty_result_anno())
+        else:
+            annos.append(kitti.empty_result_anno())
+        num_example = annos[-1]["name"].shape[0]
+        annos[-1]["image_idx"] = np.array([img_idx] * num_example,
+                                          dtype=np.int64)
+    return annos
+
+
+def _kitti_result_lines_loop(anno):
+    """label lines as _predict_kitti_to_file wrote them before.
+    """
+    lines = []
+    for i in range(len(anno["name"])):
+        dims = anno["dimensions"][i]
+        result_dict = {
+            "name": anno["name"][i],
+            "alpha": anno["alpha"][i],
+            "bbox": anno["bbox"][i],
+            "location": anno["location"][i],
+            "dimensions": dims[[1, 2, 0]],
+            "rotation_y": anno["rotation_y"][i],
+            "score": anno["score"][i],
+        }
+        lines.append(kitti.kitti_result_line(result_dict))
+    return lines
+
+
+def _random_predictions(num_dets, batch_size, rng, empty_prob=0.05):
+    batch_image_shape = np.array([[375, 1242]] * batch_size, dtype=np.int32)
+    predictions_dicts = []
+    for i in range(batch_size):
+        if rng.uniform() < empty_prob:
+            predictions_dicts.append({
+                "bbox": None,
+                "box3d_camera": None,
+                "box3d_lidar": None,
+                "scores": None,
+                "label_preds": None,
+                "image_idx": i,
+            })
+            continue
+        lidar = np.concatenate([
+            rng.uniform([-5, -45, -3], [75, 45, 1], size=[num_dets, 3]),
+            rng.uniform(0.5, 4, size=[num_dets, 3]),
+            rng.uniform(-np.pi, np.pi, size=[num_dets, 1]),
+        ], axis=1)
+        camera = lidar[:, [1, 2, 0, 3, 5, 4, 6]] * [-1, -1, 1, 1, 1, 1, 1]
+        xy = rng.uniform([-200, -100], [1400, 450], size=[num_dets, 2])
+        bbox = np.concatenate(
+            [xy, xy + rng.uniform(5, 300, size=[num_dets, 2])], axis=1)
+        predictions_dicts.append({
+            "bbox": torch.from_numpy(bbox.astype(np.float32)),
+            "box3d_camera": torch.from_numpy(camera.astype(np.float32)),
+            "box3d_lidar": torch.from_numpy(lidar.astype(np.float32)),
+            "scores": torch.from_numpy(
+                rng.uniform(0.05, 1, size=[num_dets]).astype(np.float32)),
+            "label_preds": torch.from_numpy(
+                rng.integers(0, len(CLASS_NAMES), size=[num_dets])),
+            "image_idx": i,
+        })
+    return predictions_dicts, batch_image_shape
+
+
+def _annos_equal(annos, ref_annos):
+    for anno, ref in zip(annos, ref_annos):
+        if anno.keys() != ref.keys():
+            return False
+        for key, val in ref.items():
+            if val.dtype != anno[key].dtype or not np.array_equal(
+                    val, anno[key]):
+                return False
+    return True
+
+
+def benchmark(num_dets=300, num_frames=200, batch_size=1, seed=0):
+    """compare vectorized and per-box conversion on random predictions.
+    Returns:
+        dict: {"annos_identical", "lines_identical", "scores_unique",
+            "loop_ms", "vectorized_ms", "lines_loop_ms",
+            "lines_vectorized_ms"}, times per frame.
+    """
+    rng = np.random.default_rng(seed)
+    report = {
+        "annos_identical": True,
+        "lines_identical": True,
+        "scores_unique": True,
+    }
+    times = {
+        "loop_ms": 0.0,
+        "vectorized_ms": 0.0,
+        "lines_loop_ms": 0.0,
+        "lines_vectorized_ms": 0.0,
+    }
+    global_set = set()
+    num_scores = 0
+    num_batches = (num_frames + batch_size - 1) // batch_size
+    for _ in range(num_batches):
+        predictions_dicts, batch_image_shape = _random_predictions(
+            num_dets, batch_size, rng)
+        t = time.perf_counter()
+        ref_annos = _comput_kitti_output_loop(predictions_dicts,
+                                              batch_image_shape, False,
+                                              CENTER_LIMIT_RANGE, CLASS_NAMES)
+        times["loop_ms"] += time.perf_counter() - t
+        t = time.perf_counter()
+        annos = comput_kitti_output(predictions_dicts, batch_image_shape,
+                                    False, CENTER_LIMIT_RANGE, CLASS_NAMES,
+                                    None)
+        times["vectorized_ms"] += time.perf_counter() - t
+        report["annos_identical"] &= _annos_equal(annos, ref_annos)
+
+        for preds_dict, image_shape in zip(predictions_dicts,
+                                           batch_image_shape):
+            anno = kitti_anno_arrays(preds_dict, image_shape, False,
+                                     CENTER_LIMIT_RANGE, CLASS_NAMES)
+            if anno is None:
+                continue
+            t = time.perf_counter()
+            ref_lines = _kitti_result_lines_loop(anno)
+            times["lines_loop_ms"] += time.perf_counter() - t
+            t = time.perf_counter()
+            lines = kitti_result_lines(anno)
+            times["lines_vectorized_ms"] += time.perf_counter() - t
+            report["lines_identical"] &= lines == ref_lines
+            # coarse scores of a few digits collide across frames.
+            unique_scores(np.round(anno["score"], 2), global_set)
+            num_scores += len(anno["score"])
+    report["scores_unique"] = len(global_set) == num_scores
+    for key, val in times.items():
+        report[key] = val / (num_batches * batch_size) * 1000
+    print("{} detections per frame, {} frames".format(
+        num_dets, num_batches * batch_size))
+    print("{:<14}{:>12}{:>14}{:>10}{:>11}".format("", "loop ms",
+                                                  "vectorized ms", "speedup",
+                                                  "identical"))
+    for name, prefix, flag in [("annos", "", "annos_identical"),
+                               ("label lines", "lines_", "lines_identical")]:
+        loop_ms = report[prefix + "loop_ms"]
+        vec_ms = report[prefix + "vectorized_ms"]
+        print("{:<14}{:>12.3f}{:>14.3f}{:>10.2f}{:>11}".format(
+            name, loop_ms, vec_ms, loop_ms / vec_ms, str(report[flag])))
+    print("global_set scores unique:", report["scores_unique"])
+    return report
+
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -0,0 +1,215 @@
+"""peak memory of preprocessing and of every VoxelNet stage per config.
+
+for every config the network is built with random weights and run on
+synthetic point clouds (points uniform in point_cloud_range, which fills
+as many voxels as possible, so the numbers are an upper bound of a real
+frame). preprocessing buffers (points_to_voxel, anchors, anchors mask,
+targets) and network stages are measured with profiler.MemoryProfiler,
+preprocessing on cpu, the network on the chosen device. preprocessing
+columns are numpy buffers. network columns are the torch allocator, on
+cpu the "_numpy" columns hold the numpy buffers of the same stage, a
+separate peak that isn't added to the torch one.
+
+usage:
+    python ./pytorch/memory_benchmark.py memory_table \
+        --configs=configs/pointpillars/car/xyres_*.proto
+    python ./pytorch/memory_benchmark.py memory_table \
+        --configs=configs/tanet/car --device=cuda:0 --csv_path=mem.csv
+"""
+import pathlib
+
+import fire
+import numpy as np
+import torch
+from google.protobuf import text_format
+
+from second.benchmark.suite import config_paths
+from second.builder import target_assigner_builder, voxel_builder
+from second.core import box_np_ops
+from second.data.preprocess import merge_second_batch
+from second.protos import pipeline_pb2
+from second.pytorch.builder import box_coder_builder, second_builder
+from second.pytorch.profiler import MemoryProfiler
+from second.pytorch.train import example_convert_to_torch
+
+PREPROCESS_STAGES = ["points_to_voxel", "anchors", "anchors_mask", "targets"]
+NETWORK_STAGES = ["vfe", "scatter", "rpn", "postprocess", "forward"]
+
+
+def _random_points(point_cloud_range, num_points, num_point_features, rng):
+    points = rng.uniform(point_cloud_range[:3], point_cloud_range[3:],
+                         size=[num_points, 3])
+    features = rng.uniform(size=[num_points, num_point_features - 3])
+    return np.concatenate([points, features], axis=1).astype(np.float32)
+
+
+def _random_gt_boxes(point_cloud_range, num_boxes, rng):
+    xy = rng.uniform(point_cloud_range[:2], point_cloud_range[3:5],
+                     size=[num_boxes, 2])
+    z = np.full([num_boxes, 1], -1.0)
+    dims = np.array([1.6, 3.9, 1.56]) + rng.normal(
+        scale=0.1, size=[num_boxes, 3])
+    rot = rng.uniform(-np.pi, np.pi, size=[num_boxes, 1])
+    return np.concatenate([xy, z, dims, rot], axis=1).astype(np.float32)
+
+
+def config_memory(config_path,
+                  device=None,
+                  num_points=20000,
+                  num_frames=3,
+                  num_gt_boxes=10,
+                  seed=0):
+    """peak memory in bytes of one config.
+    Returns:
+        dict: "params" plus every preprocessing and network stage.
+    """
+    config = pipeline_pb2.TrainEvalPipelineConfig()
+    with open(config_path, "r") as f:
+        proto_str = f.read()
+        text_format.Merge(proto_str, config)
+    input_cfg = config.eval_input_reader
+    model_cfg = config.model.second
+    if device is None:
+        device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+    rng = np.random.default_rng(seed)
+
+    voxel_generator = voxel_builder.build(model_cfg.voxel_generator)
+    pc_range = voxel_generator.point_cloud_range
+    grid_size = voxel_generator.grid_size
+    voxel_size = voxel_generator.voxel_size
+    bv_range = pc_range[[0, 1, 3, 4]]
+    box_coder = box_coder_builder.build(model_cfg.box_coder)
+    target_assigner = target_assigner_builder.build(
+        model_cfg.target_assigner, bv_range, box_coder)
+    net = second_builder.build(model_cfg, voxel_generator, target_assigner)
+    net.to(device).eval()
+    out_size_factor = (model_cfg.rpn.layer_strides[0] //
+                       model_cfg.rpn.upsample_strides[0])
+    feature_map_size = grid_size[:2] // out_size_factor
+    feature_map_size = [*feature_map_size, 1][::-1]
+
+    prep_profiler = MemoryProfiler("cpu")
+    net_profiler = MemoryProfiler(device)
+    memory = {
+        "params": sum(t.numel() * t.element_size()
+                      for t in list(net.parameters()) + list(net.buffers()))
+    }
+
+    def generate_anchors():
+        ret = target_assigner.generate_anchors(feature_map_size)
+        anchors = ret["anchors"].reshape([-1, 7])
+        anchors_bv = box_np_ops.rbbox2d_to_near_bbox(
+            anchors[:, [0, 1, 3, 4, 6]])
+        return ret, anchors, anchors_bv
+
+    ret, anchors, anchors_bv = generate_anchors()
+    eye = np.eye(4, dtype=np.float32)
+    # the first frame compiles the numba kernels and isn't measured.
+    for i in range(num_frames + 1):
+        if i == 1:
+            prep_profiler.reset()
+            net_profiler.reset()
+            with prep_profiler.stage("anchors"):
+                ret, anchors, anchors_bv = generate_anchors()
+        points = _random_points(pc_range, num_points,
+                                model_cfg.num_point_features, rng)
+        with prep_profiler.stage("points_to_voxel"):
+            voxels, coordinates, num_points_per_voxel = (
+                voxel_generator.generate(points,
+                                         input_cfg.max_number_of_voxels))
+        with prep_profiler.stage("anchors_mask"):
+            dense_voxel_map = box_np_ops.sparse_sum_for_anchors_mask(
+                coordinates, tuple(grid_size[::-1][1:]))
+            dense_voxel_map = dense_voxel_map.cumsum(0)
+            dense_voxel_map = dense_voxel_map.cumsum(1)
+            anchors_area = box_np_ops.fused_get_anchors_area(
+                dense_voxel_map, anchors_bv, voxel_size, pc_range, grid_size)
+            anchors_mask = anchors_area > input_cfg.anchor_area_threshold
+        with prep_profiler.stage("targets"):
+            target_assigner.assign(
+                anchors,
+                _random_gt_boxes(pc_range, num_gt_boxes, rng),
+                anchors_mask,
+                gt_classes=np.ones([num_gt_boxes], dtype=np.int32),
+                matched_thresholds=ret["matched_thresholds"],
+                unmatched_thresholds=ret["unmatched_thresholds"])
+        example = merge_second_batch([{
+            "voxels": voxels,
+            "num_points": num_points_per_voxel,
+            "coordinates": coordinates,
+            "num_voxels": np.array([voxels.shape[0]], dtype=np.int64),
+            "anchors": anchors,
+            "anchors_mask": anchors_mask.astype(np.uint8),
+            "rect": eye,
+            "Trv2c": eye,
+            "P2": eye,
+            "image_shape": np.array([375, 1242], dtype=np.int32),
+            "image_idx": i,
+        }])
+        example = example_convert_to_torch(example, torch.float32, device)
+        net.set_profiler(net_profiler)
+        with torch.no_grad(), net_profiler.stage("forward"):
+            preds_dict = net.network_forward(example)
+            with net_profiler.stage("postprocess"):
+                if "Refine_loc_preds" in preds_dict:
+                    net.predict_refine(example, preds_dict)
+                else:
+                    net.predict_coarse(example, preds_dict)
+        net.set_profiler(None)
+        del example, preds_dict
+    memory.update(prep_profiler.numpy_peaks)
+    memory.update(net_profiler.peaks)
+    memory.update({
+        name + "_numpy": peak
+        for name, peak in net_profiler.numpy_peaks.items()
+    })
+    return memory
+
+
+def memory_table(configs="configs",
+                 device=None,
+                 num_points=20000,
+                 num_frames=3,
+                 csv_path=None):
+    """peak memory (MB) table of every config.
+    Args:
+        configs: config file, directory, glob or list of those.
+    """
+    results = {}
+    for config_path in config_paths(configs):
+        print("measure", config_path)
+        results[config_path] = config_memory(config_path, device, num_points,
+                                             num_frames)
+    columns = ["params"] + PREPROCESS_STAGES + NETWORK_STAGES + [
+        name + "_numpy" for name in NETWORK_STAGES
+    ]
+    extra = sorted({k for m in results.values() for k in m} - set(columns))
+    columns += extra
+    print(memory_table_str(results, columns))
+    if csv_path is not None:
+        with open(csv_path, "w") as f:
+            f.write(",".join(["config"] + [c + "_bytes"
+                                           for c in columns]) + "\n")
+            for config_path, memory in results.items():
+                f.write(",".join([config_path] + [
+                    str(memory.get(c, "")) for c in columns
+                ]) + "\n")
+    return results
+
+
+def memory_table_str(results, columns):
+    names = {p: str(pathlib.Path(p).with_suffix("")) for p in results}
+    width = max([len(n) for n in names.values()] + [6]) + 2
+    widths = [max(len(c) + 5, 10) for c in columns]
+    lines = [("{:<%d}" % width).format("config") + "".join(
+        ("{:>%d}" % w).format(c + " MB") for c, w in zip(columns, widths))]
+    for config_path, memory in results.items():
+        lines.append(("{:<%d}" % width).format(names[config_path]) + "".join(
+            ("{:>%d.2f}" % w).format(memory[c] / 2**20) if c in memory else
+            ("{:>%d}" % w).format("-") for c, w in zip(columns, widths)))
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    fire.Fire()
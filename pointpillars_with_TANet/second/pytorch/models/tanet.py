@@ -1,9 +1,11 @@
 import torch
 from torch import nn
-from second.pytorch.utils import get_paddings_indicator
+from second.pytorch.utils import (get_paddings_indicator, receptive_field,
+                                  union_fields)
 from torchplus.tools import change_default_args
 from torchplus.nn import Empty, GroupNorm, Sequential
 from second.pytorch.models.pointpillars import PFNLayer
+from second.pytorch.profiler import profile_stage
 import numpy as np
 
 import yaml
@@ -271,6 +273,7 @@ class PSA(nn.Module):
         :param name:
         """
         super(PSA, self).__init__()
+        self.profiler = None  # see VoxelNet.set_profiler
         self._num_anchor_per_loc = num_anchor_per_loc   ## 2
         self._use_direction_classifier = use_direction_classifier  # True
         self._use_bev = use_bev   # False
@@ -469,81 +472,116 @@ class PSA(nn.Module):
         if use_direction_classifier:
             self.refine_dir = nn.Conv2d(sum(num_upsample_filters),num_anchor_per_loc * 2, 1)
 
+    def receptive_field(self):
+        """(spacing, lo, hi) of the coarse and refine preds on the input
+        canvas, see second.pytorch.utils.receptive_field.
+        """
+        x1 = receptive_field(self.block1)
+        x2 = receptive_field(self.block2, x1)
+        x3 = receptive_field(self.block3, x2)
+        coarse = union_fields(
+            receptive_field(self.deconv1, x1),
+            receptive_field(self.deconv2, x2),
+            receptive_field(self.deconv3, x3))
+        fusion1 = union_fields(x1, receptive_field(self.block2_inc2x, x2),
+                               receptive_field(self.block3_inc4x, x3))
+        fusion2 = union_fields(receptive_field(self.block1_dec2x, x1), x2,
+                               receptive_field(self.block3_inc2x, x3))
+        fusion3 = union_fields(receptive_field(self.block1_dec4x, x1),
+                               receptive_field(self.block2_dec2x, x2), x3)
+        branches = [
+            receptive_field(self.refine_up1,
+                            receptive_field(self.RF3, fusion1)),
+            receptive_field(self.refine_up2,
+                            receptive_field(self.RF2, fusion2)),
+            receptive_field(self.refine_up3,
+                            receptive_field(self.RF1, fusion3)),
+        ]
+        refine = union_fields(*[
+            receptive_field(conv, union_fields(branch, coarse))
+            for conv, branch in zip(
+                [self.concat_conv1, self.concat_conv2, self.concat_conv3],
+                branches)
+        ])
+        return union_fields(coarse, refine)
+
     def forward(self, x, bev=None):
-        x1 = self.block1(x)
-        up1 = self.deconv1(x1)
-
-        x2 = self.block2(x1)
-        up2 = self.deconv2(x2)
-        x3 = self.block3(x2)
-        up3 = self.deconv3(x3)
-        coarse_feat = torch.cat([up1, up2, up3], dim=1)
-        box_preds = self.conv_box(coarse_feat)
-        cls_preds = self.conv_cls(coarse_feat)
-
-        # [N, C, y(H), x(W)]
-        box_preds = box_preds.permute(0, 2, 3, 1).contiguous()
-        cls_preds = cls_preds.permute(0, 2, 3, 1).contiguous()
-        ret_dict = {
-            "box_preds": box_preds,
-            "cls_preds": cls_preds,
-        }
-        if self._use_direction_classifier:
-            dir_cls_preds = self.conv_dir_cls(coarse_feat)
-            dir_cls_preds = dir_cls_preds.permute(0, 2, 3, 1).contiguous()
-            ret_dict["dir_cls_preds"] = dir_cls_preds
+        with profile_stage(self.profiler, "rpn_coarse"):
+            x1 = self.block1(x)
+            up1 = self.deconv1(x1)
+
+            x2 = self.block2(x1)
+            up2 = self.deconv2(x2)
+            x3 = self.block3(x2)
+            up3 = self.deconv3(x3)
+            coarse_feat = torch.cat([up1, up2, up3], dim=1)
+            box_preds = self.conv_box(coarse_feat)
+            cls_preds = self.conv_cls(coarse_feat)
+
+            # [N, C, y(H), x(W)]
+            box_preds = box_preds.permute(0, 2, 3, 1).contiguous()
+            cls_preds = cls_preds.permute(0, 2, 3, 1).contiguous()
+            ret_dict = {
+                "box_preds": box_preds,
+                "cls_preds": cls_preds,
+            }
+            if self._use_direction_classifier:
+                dir_cls_preds = self.conv_dir_cls(coarse_feat)
+                dir_cls_preds = dir_cls_preds.permute(0, 2, 3, 1).contiguous()
+                ret_dict["dir_cls_preds"] = dir_cls_preds
 
 
         ###############Refine:
-        blottle_conv = self.bottle_conv(coarse_feat)
+        with profile_stage(self.profiler, "rpn_refine"):
+            blottle_conv = self.bottle_conv(coarse_feat)
 
-        x1_dec2x = self.block1_dec2x(x1)
-        x1_dec4x = self.block1_dec4x(x1)
+            x1_dec2x = self.block1_dec2x(x1)
+            x1_dec4x = self.block1_dec4x(x1)
 
-        x2_dec2x = self.block2_dec2x(x2)
-        x2_inc2x = self.block2_inc2x(x2)
+            x2_dec2x = self.block2_dec2x(x2)
+            x2_inc2x = self.block2_inc2x(x2)
 
-        x3_inc2x = self.block3_inc2x(x3)
-        x3_inc4x = self.block3_inc4x(x3)
+            x3_inc2x = self.block3_inc2x(x3)
+            x3_inc4x = self.block3_inc4x(x3)
 
-        concat_block1 = torch.cat([x1,x2_inc2x,x3_inc4x], dim=1)
-        fusion_block1 = self.fusion_block1(concat_block1)
+            concat_block1 = torch.cat([x1,x2_inc2x,x3_inc4x], dim=1)
+            fusion_block1 = self.fusion_block1(concat_block1)
 
-        concat_block2 = torch.cat([x1_dec2x,x2,x3_inc2x], dim=1)
-        fusion_block2 = self.fusion_block2(concat_block2)
+            concat_block2 = torch.cat([x1_dec2x,x2,x3_inc2x], dim=1)
+            fusion_block2 = self.fusion_block2(concat_block2)
 
-        concat_block3 = torch.cat([x1_dec4x,x2_dec2x,x3], dim=1)
-        fusion_block3 = self.fusion_block3(concat_block3)
+            concat_block3 = torch.cat([x1_dec4x,x2_dec2x,x3], dim=1)
+            fusion_block3 = self.fusion_block3(concat_block3)
 
-        refine_up1 = self.RF3(fusion_block1)
-        refine_up1 = self.refine_up1(refine_up1)
-        refine_up2 = self.RF2(fusion_block2)
-        refine_up2 = self.refine_up2(refine_up2)
-        refine_up3 = self.RF1(fusion_block3)
-        refine_up3 = self.refine_up3(refine_up3)
+            refine_up1 = self.RF3(fusion_block1)
+            refine_up1 = self.refine_up1(refine_up1)
+            refine_up2 = self.RF2(fusion_block2)
+            refine_up2 = self.refine_up2(refine_up2)
+            refine_up3 = self.RF1(fusion_block3)
+            refine_up3 = self.refine_up3(refine_up3)
 
 
-        branch1_sum_wise = refine_up1 + blottle_conv
-        branch2_sum_wise = refine_up2 + blottle_conv
-        branch3_sum_wise = refine_up3 + blottle_conv
+            branch1_sum_wise = refine_up1 + blottle_conv
+            branch2_sum_wise = refine_up2 + blottle_conv
+            branch3_sum_wise = refine_up3 + blottle_conv
 
-        concat_conv1 = self.concat_conv1(branch1_sum_wise)
-        concat_conv2 = self.concat_conv2(branch2_sum_wise)
-        concat_conv3 = self.concat_conv3(branch3_sum_wise)
+            concat_conv1 = self.concat_conv1(branch1_sum_wise)
+            concat_conv2 = self.concat_conv2(branch2_sum_wise)
+            concat_conv3 = self.concat_conv3(branch3_sum_wise)
 
-        PSA_output = torch.cat([concat_conv1,concat_conv2,concat_conv3], dim=1)
+            PSA_output = torch.cat([concat_conv1,concat_conv2,concat_conv3], dim=1)
 
-        refine_cls_preds = self.refine_cls(PSA_output)
-        refine_loc_preds = self.refine_loc(PSA_output)
+            refine_cls_preds = self.refine_cls(PSA_output)
+            refine_loc_preds = self.refine_loc(PSA_output)
 
-        refine_loc_preds = refine_loc_preds.permute(0, 2, 3, 1).contiguous()
-        refine_cls_preds = refine_cls_preds.permute(0, 2, 3, 1).contiguous()
-        ret_dict["Refine_loc_preds"] =  refine_loc_preds
-        ret_dict["Refine_cls_preds"] =  refine_cls_preds
+            refine_loc_preds = refine_loc_preds.permute(0, 2, 3, 1).contiguous()
+            refine_cls_preds = refine_cls_preds.permute(0, 2, 3, 1).contiguous()
+            ret_dict["Refine_loc_preds"] =  refine_loc_preds
+            ret_dict["Refine_cls_preds"] =  refine_cls_preds
 
-        if self._use_direction_classifier:
-            refine_dir_preds = self.refine_dir(PSA_output)
-            refine_dir_preds = refine_dir_preds.permute(0, 2, 3, 1).contiguous()
-            ret_dict["Refine_dir_preds"] = refine_dir_preds
+            if self._use_direction_classifier:
+                refine_dir_preds = self.refine_dir(PSA_output)
+                refine_dir_preds = refine_dir_preds.permute(0, 2, 3, 1).contiguous()
+                ret_dict["Refine_dir_preds"] = refine_dir_preds
 
         return ret_dict
\ No newline at end of file
@@ -1,6 +1,7 @@
+import contextlib
 import time
 from enum import Enum
-from functools import reduce
+from functools import partial, reduce
 
 import numpy as np
 
@@ -21,11 +22,18 @@ from second.pytorch.core.losses import (WeightedSigmoidClassificationLoss,
 from second.pytorch.models.pointpillars import PillarFeatureNet, PointPillarsScatter
 from second.pytorch.models.tanet import PillarFeature_TANet, PSA
 from second.pytorch.models.loss_utils import create_refine_loss
-from second.pytorch.utils import get_paddings_indicator
+from second.pytorch.profiler import profile_stage
+from second.pytorch.utils import (get_paddings_indicator, receptive_field,
+                                  union_fields)
 
 
 USING_SCN = False  # default: not use SparseConv
 
+# kitti: camera boxes and image bboxes besides the lidar boxes.
+# lidar: lidar boxes, scores and labels only, no camera math.
+# candidates: the nms candidates before nms, see select_candidates.
+OUTPUT_FORMATS = ["kitti", "lidar", "candidates"]
+
 
 def _get_pos_neg_loss(cls_loss, labels):
     # cls_loss: [N, num_anchors, num_class]
@@ -460,6 +468,19 @@ class RPN(nn.Module):
             self.conv_dir_cls = nn.Conv2d(
                 sum(num_upsample_filters), num_anchor_per_loc * 2, 1)
 
+    def receptive_field(self):
+        """(spacing, lo, hi) of the preds on the input canvas, see
+        second.pytorch.utils.receptive_field. the bev branch isn't
+        included.
+        """
+        x1 = receptive_field(self.block1)
+        x2 = receptive_field(self.block2, x1)
+        x3 = receptive_field(self.block3, x2)
+        return union_fields(
+            receptive_field(self.deconv1, x1),
+            receptive_field(self.deconv2, x2),
+            receptive_field(self.deconv3, x3))
+
     def forward(self, x, bev=None):
         x = self.block1(x)
         up1 = self.deconv1(x)
@@ -538,6 +559,12 @@ class VoxelNet(nn.Module):
                  cls_loss_ftor=None,
                  voxel_size=(0.2, 0.2, 4),
                  pc_range=(0, -40, -3, 70.4, 40, 1),
+                 occupancy_crop=False,
+                 occupancy_crop_margin=None,
+                 nms_backend="auto",
+                 batched_postprocess=True,
+                 decode_after_select=True,
+                 output_format="kitti",
                  name='voxelnet'):
         super().__init__()
         self.name = name
@@ -548,6 +575,11 @@ class VoxelNet(nn.Module):
         self._nms_pre_max_size = nms_pre_max_size
         self._nms_post_max_size = nms_post_max_size
         self._nms_iou_threshold = nms_iou_threshold
+        self._nms_backend = nms_backend
+        self._batched_postprocess = batched_postprocess
+        self._decode_after_select = decode_after_select
+        self.set_output_format(output_format)
+        self._profiler = None
         self._use_sigmoid_score = use_sigmoid_score
         self._encode_background_as_zeros = encode_background_as_zeros
         self._use_sparse_rpn = use_sparse_rpn
@@ -556,6 +588,14 @@ class VoxelNet(nn.Module):
         self._total_forward_time = 0.0
         self._total_postprocess_time = 0.0
         self._total_inference_count = 0
+        self._precision_policy = None
+        self._occupancy_crop = occupancy_crop
+        self._occupancy_crop_margin = occupancy_crop_margin
+        # crop offsets must be aligned to the deepest rpn stride so the
+        # cropped feature maps stay on the full run's grid.
+        self._rpn_stride = int(np.prod(rpn_layer_strides))
+        self._rpn_out_size_factor = (
+            rpn_layer_strides[0] // rpn_upsample_strides[0])
         self._num_input_features = num_input_features
         self._box_coder = target_assigner.box_coder
         self._lidar_only = lidar_only
@@ -642,6 +682,9 @@ class VoxelNet(nn.Module):
             use_groupnorm=use_groupnorm,
             num_groups=num_groups,
             box_code_size=target_assigner.box_coder.code_size)
+        # dependence of the rpn outputs on the scatter canvas, computed
+        # before the rpn may be replaced by an exported graph.
+        self._rpn_field = self.rpn.receptive_field()
 
         self.rpn_acc = metrics.Accuracy(
             dim=-1, encode_background_as_zeros=encode_background_as_zeros)
@@ -664,34 +707,270 @@ class VoxelNet(nn.Module):
     def get_global_step(self):
         return int(self.global_step.cpu().numpy()[0])
 
+    @property
+    def precision_policy(self):
+        return self._precision_policy
+
+    def set_precision_policy(self, policy):
+        """run the network under policy.autocast(). None for plain fp32.
+        """
+        self._precision_policy = policy
+
+    def set_nms_backend(self, backend="auto"):
+        """one of box_torch_ops.NMS_BACKENDS. "auto" runs nms with the
+        legacy kernels for cuda predictions and with the numba kernels on
+        cpu, "torch" keeps cuda predictions on the device.
+        """
+        box_torch_ops.resolve_nms_backend(backend, torch.device("cpu"))
+        self._nms_backend = backend
+
+    def set_batched_postprocess(self, enabled=True):
+        """postprocess all samples of a batch together, see
+        compute_predict_batched. multiclass nms always runs per sample.
+        """
+        self._batched_postprocess = enabled
+
+    def set_decode_after_select(self, enabled=True):
+        """decode only the anchors that survive the score threshold and
+        nms_pre_max_size instead of every anchor. needs the batched
+        postprocess, results are bit-exact (decoding is elementwise).
+        """
+        self._decode_after_select = enabled
+
+    def set_output_format(self, output_format="kitti"):
+        """one of OUTPUT_FORMATS. with "lidar" the prediction dicts only
+        hold box3d_lidar, scores, label_preds and image_idx. with
+        "candidates" they hold the select_candidates output of a sample
+        (box3d_lidar, scores, label_preds, dir_labels, image_idx), needs
+        the batched postprocess.
+        """
+        assert output_format in OUTPUT_FORMATS, output_format
+        self._output_format = output_format
+
+    def set_nms_params(self,
+                       score_threshold=None,
+                       iou_threshold=None,
+                       pre_max_size=None,
+                       post_max_size=None):
+        """override the nms settings of the model config, None keeps one.
+        """
+        if score_threshold is not None:
+            self._nms_score_threshold = score_threshold
+        if iou_threshold is not None:
+            self._nms_iou_threshold = iou_threshold
+        if pre_max_size is not None:
+            self._nms_pre_max_size = pre_max_size
+        if post_max_size is not None:
+            self._nms_post_max_size = post_max_size
+
+    def set_profiler(self, profiler=None):
+        """attach a profiler.StageProfiler, None to detach.
+        """
+        self._profiler = profiler
+        if hasattr(self.rpn, "profiler"):
+            self.rpn.profiler = profiler
+
+    def _timestamp(self, device):
+        """perf_counter once the queued cuda work is done (eval only, a
+        sync per step would slow down training).
+        """
+        if not self.training and device.type == "cuda":
+            torch.cuda.synchronize(device)
+        return time.perf_counter()
+
+    def _use_batched_postprocess(self):
+        return self._batched_postprocess and not self._multiclass_nms
+
+    def decode_selected(self, batch_ids, anchor_ids, encodings, anchors):
+        """decode the chain anchors -> encodings[0] -> encodings[1] ...
+        for the selected anchors only.
+        Args:
+            batch_ids, anchor_ids: [M] indices into [B, N].
+            encodings: list of [B, N, code_size] box encodings.
+            anchors: [B, N, 7]
+        Returns:
+            [M, 7] decoded boxes.
+        """
+        boxes = anchors[batch_ids, anchor_ids]
+        for encoding in encodings:
+            boxes = self._box_coder.decode_torch(
+                encoding[batch_ids, anchor_ids], boxes)
+        return boxes
+
+    def set_occupancy_crop(self, enabled=True, margin=None):
+        """run the rpn only on the bounding rectangle of occupied pillars.
+        only used in eval with PointPillarsScatter. margin (in pillars)
+        extends the rectangle, None for occupancy_crop_context: every
+        anchor over an occupied pillar then gets exactly the full-canvas
+        output. a smaller margin is faster, outputs near the crop border
+        are approximate.
+        """
+        self._occupancy_crop = enabled
+        self._occupancy_crop_margin = margin
+
+    @property
+    def occupancy_crop_context(self):
+        """smallest margin (in pillars, aligned to the rpn stride) that
+        covers the rpn receptive field.
+        """
+        spacing, lo, hi = self._rpn_field
+        context = max(spacing - 1 - lo, hi)
+        stride = self._rpn_stride
+        return (context + stride - 1) // stride * stride
+
+    def _use_occupancy_crop(self):
+        return (self._occupancy_crop and not self.training
+                and not self._use_sparse_rpn and not self._use_bev
+                and isinstance(self.middle_feature_extractor,
+                               PointPillarsScatter))
+
+    def occupancy_crop(self, coors):
+        """bounding rectangle of occupied pillars of the whole batch.
+        Returns:
+            crop: [y0, y1, x0, x1] on the scatter canvas, extended by the
+                crop margin and aligned to the rpn stride.
+            keep: [y0, y1, x0, x1] on the rpn output map, the anchors
+                kept: every anchor over an occupied pillar and every
+                anchor whose receptive field lies inside the crop (or
+                outside the canvas), whose outputs equal the full run.
+        """
+        stride = self._rpn_stride
+        margin = self._occupancy_crop_margin
+        if margin is None:
+            margin = self.occupancy_crop_context
+        factor = self._rpn_out_size_factor
+        spacing, lo, hi = self._rpn_field
+        ny = self.middle_feature_extractor.ny
+        nx = self.middle_feature_extractor.nx
+        if coors.shape[0] == 0:
+            crop = [0, min(stride, ny), 0, min(stride, nx)]
+            return crop, [c // factor for c in crop]
+        coors_min = coors[:, 2:].min(dim=0)[0].tolist()
+        coors_max = coors[:, 2:].max(dim=0)[0].tolist()
+        crop = []
+        keep = []
+        for cmin, cmax, size in zip(coors_min, coors_max, [ny, nx]):
+            start = max(cmin - margin, 0) // stride * stride
+            end = min((cmax + 1 + margin + stride - 1) // stride * stride,
+                      size)
+            crop += [start, end]
+            exact_start = 0
+            if start > 0:
+                exact_start = -((lo - start) // spacing)
+            exact_end = size // factor
+            if end < size:
+                exact_end = (end - 1 - hi) // spacing + 1
+            keep += [
+                max(min(exact_start, cmin // factor), start // factor),
+                min(max(exact_end, cmax // factor + 1), end // factor)
+            ]
+        return crop, keep
+
+    def uncrop_preds(self, preds_dict, crop):
+        """paste cropped rpn outputs into full-canvas outputs. anchors
+        outside the crop get zero regression and a very low score.
+        """
+        factor = self._rpn_out_size_factor
+        y0, y1, x0, x1 = [c // factor for c in crop]
+        height = self.middle_feature_extractor.ny // factor
+        width = self.middle_feature_extractor.nx // factor
+        ret = {}
+        for name, preds in preds_dict.items():
+            fill = 0.0
+            if name in ["cls_preds", "Refine_cls_preds"]:
+                fill = -1e4
+            full = preds.new_full(
+                [preds.shape[0], height, width, preds.shape[-1]], fill)
+            full[:, y0:y1, x0:x1] = preds
+            ret[name] = full
+        return ret
+
+    def crop_anchors_mask(self, example, keep):
+        """anchors_mask of the full canvas restricted to keep, see
+        occupancy_crop.
+        """
+        factor = self._rpn_out_size_factor
+        y0, y1, x0, x1 = keep
+        height = self.middle_feature_extractor.ny // factor
+        width = self.middle_feature_extractor.nx // factor
+        num_anchor_per_loc = self.target_assigner.num_anchors_per_location
+        batch_size = example["anchors"].shape[0]
+        device = example["anchors"].device
+        inside = torch.zeros([height, width, num_anchor_per_loc],
+                             dtype=torch.uint8,
+                             device=device)
+        inside[y0:y1, x0:x1] = 1
+        inside = inside.view(1, -1)
+        if "anchors_mask" in example:
+            anchors_mask = example["anchors_mask"].view(batch_size, -1)
+            return anchors_mask * inside.type_as(anchors_mask)
+        return inside.repeat(batch_size, 1)
+
+    def network_forward(self, example):
+        """VFE -> middle feature extractor -> RPN, returns rpn preds dict.
+        preds are always returned in fp32 so decoding and nms don't
+        depend on the precision policy.
+        """
+        voxels = example["voxels"]
+        num_points = example["num_points"]
+        coors = example["coordinates"]
+        batch_size_dev = example["anchors"].shape[0]
+        policy = self._precision_policy
+        crop = None
+        autocast = contextlib.nullcontext()
+        if policy is not None:
+            autocast = policy.autocast()
+        with autocast:
+            # features: [num_voxels, max_num_points_per_voxel, 7]
+            # num_points: [num_voxels]
+            # coors: [num_voxels, 4]
+            with profile_stage(self._profiler, "vfe"):
+                voxel_features = self.voxel_feature_extractor(
+                    voxels, num_points, coors)
+            if self._use_sparse_rpn:
+                with profile_stage(self._profiler, "rpn"):
+                    preds_dict = self.sparse_rpn(voxel_features, coors,
+                                                 batch_size_dev)
+            else:
+                with profile_stage(self._profiler, "scatter"):
+                    spatial_features = self.middle_feature_extractor(
+                        voxel_features, coors, batch_size_dev)
+                    if self._use_occupancy_crop():
+                        crop, keep = self.occupancy_crop(coors)
+                        y0, y1, x0, x1 = crop
+                        spatial_features = spatial_features[:, :, y0:y1, x0:
+                                                            x1].contiguous()
+                with profile_stage(self._profiler, "rpn"):
+                    if self._use_bev:
+                        preds_dict = self.rpn(spatial_features,
+                                              example["bev_map"])
+                    else:
+                        preds_dict = self.rpn(spatial_features)
+        if policy is not None and policy.enabled:
+            preds_dict = {k: v.float() for k, v in preds_dict.items()}
+        if crop is not None:
+            preds_dict = self.uncrop_preds(preds_dict, crop)
+            # predict_* read the mask from example, see forward.
+            preds_dict["anchors_mask"] = self.crop_anchors_mask(
+                example, keep)
+        return preds_dict
+
     def forward(self, example,  refine_weight=2):
         """module's forward should always accept dict and return loss.
         """
         #print('refine_weight:', refine_weight)
         voxels = example["voxels"]
-        num_points = example["num_points"]
-        coors = example["coordinates"]
         batch_anchors = example["anchors"]
         batch_size_dev = batch_anchors.shape[0]
-        t = time.time()
-        # features: [num_voxels, max_num_points_per_voxel, 7]
-        # num_points: [num_voxels]
-        # coors: [num_voxels, 4]
-        voxel_features = self.voxel_feature_extractor(voxels, num_points, coors)
-        if self._use_sparse_rpn:
-            preds_dict = self.sparse_rpn(voxel_features, coors, batch_size_dev)
-        else:
-            spatial_features = self.middle_feature_extractor(
-                voxel_features, coors, batch_size_dev)
-            if self._use_bev:
-                preds_dict = self.rpn(spatial_features, example["bev_map"])
-            else:
-                preds_dict = self.rpn(spatial_features)
+        t = self._timestamp(example["anchors"].device)
+        preds_dict = self.network_forward(example)
+        if "anchors_mask" in preds_dict:
+            example = {**example, "anchors_mask": preds_dict["anchors_mask"]}
         # preds_dict["voxel_features"] = voxel_features
         # preds_dict["spatial_features"] = spatial_features
         box_preds = preds_dict["box_preds"]
         cls_preds = preds_dict["cls_preds"]
-        self._total_forward_time += time.time() - t
+        self._total_forward_time += self._timestamp(example["anchors"].device) - t
         if self.training:
             labels = example['labels']
             reg_targets = example['reg_targets']
@@ -859,6 +1138,13 @@ class VoxelNet(nn.Module):
     def compute_predict(self, batch_box_preds, batch_cls_preds,
                         batch_dir_preds, batch_rect, batch_Trv2c,
                         batch_P2, batch_imgidx, batch_anchors_mask, num_class_with_bg):
+        if self._use_batched_postprocess():
+            return self.compute_predict_batched(
+                batch_box_preds, batch_cls_preds, batch_dir_preds,
+                batch_rect, batch_Trv2c, batch_P2, batch_imgidx,
+                batch_anchors_mask, num_class_with_bg)
+        assert self._output_format != "candidates", (
+            "candidates need the batched postprocess")
         predictions_dicts = []
         for box_preds, cls_preds, dir_preds, rect, Trv2c, P2, img_idx, a_mask in zip(
                 batch_box_preds, batch_cls_preds, batch_dir_preds, batch_rect,
@@ -887,6 +1173,7 @@ class VoxelNet(nn.Module):
                 nms_func = box_torch_ops.rotate_nms
             else:
                 nms_func = box_torch_ops.nms
+            nms_func = partial(nms_func, backend=self._nms_backend)
             selected_boxes = None
             selected_labels = None
             selected_scores = None
@@ -902,16 +1189,17 @@ class VoxelNet(nn.Module):
                     boxes_for_nms = box_torch_ops.corner_to_standup_nd(
                         box_preds_corners)
                 boxes_for_mcnms = boxes_for_nms.unsqueeze(1)
-                selected_per_class = box_torch_ops.multiclass_nms(
-                    nms_func=nms_func,
-                    boxes=boxes_for_mcnms,
-                    scores=total_scores,
-                    num_class=self._num_class,
-                    pre_max_size=self._nms_pre_max_size,
-                    post_max_size=self._nms_post_max_size,
-                    iou_threshold=self._nms_iou_threshold,
-                    score_thresh=self._nms_score_threshold,
-                )
+                with profile_stage(self._profiler, "nms"):
+                    selected_per_class = box_torch_ops.multiclass_nms(
+                        nms_func=nms_func,
+                        boxes=boxes_for_mcnms,
+                        scores=total_scores,
+                        num_class=self._num_class,
+                        pre_max_size=self._nms_pre_max_size,
+                        post_max_size=self._nms_post_max_size,
+                        iou_threshold=self._nms_iou_threshold,
+                        score_thresh=self._nms_score_threshold,
+                    )
                 selected_boxes, selected_labels, selected_scores = [], [], []
                 selected_dir_labels = []
                 for i, selected in enumerate(selected_per_class):
@@ -919,7 +1207,10 @@ class VoxelNet(nn.Module):
                         num_dets = selected.shape[0]
                         selected_boxes.append(box_preds[selected])
                         selected_labels.append(
-                            torch.full([num_dets], i, dtype=torch.int64))
+                            torch.full([num_dets],
+                                       i,
+                                       dtype=torch.int64,
+                                       device=box_preds.device))
                         if self._use_direction_classifier:
                             selected_dir_labels.append(dir_labels[selected])
                         selected_scores.append(total_scores[selected, i])
@@ -967,13 +1258,14 @@ class VoxelNet(nn.Module):
                         boxes_for_nms = box_torch_ops.corner_to_standup_nd(
                             box_preds_corners)
                     # the nms in 3d detection just remove overlap boxes.
-                    selected = nms_func(
-                        boxes_for_nms,
-                        top_scores,
-                        pre_max_size=self._nms_pre_max_size,
-                        post_max_size=self._nms_post_max_size,
-                        iou_threshold=self._nms_iou_threshold,
-                    )
+                    with profile_stage(self._profiler, "nms"):
+                        selected = nms_func(
+                            boxes_for_nms,
+                            top_scores,
+                            pre_max_size=self._nms_pre_max_size,
+                            post_max_size=self._nms_post_max_size,
+                            iou_threshold=self._nms_iou_threshold,
+                        )
                 else:
                     selected = None
                 if selected is not None:
@@ -1000,25 +1292,34 @@ class VoxelNet(nn.Module):
                 final_box_preds = box_preds
                 final_scores = scores
                 final_labels = label_preds
-                final_box_preds_camera = box_torch_ops.box_lidar_to_camera(
-                    final_box_preds, rect, Trv2c)
-                locs = final_box_preds_camera[:, :3]
-                dims = final_box_preds_camera[:, 3:6]
-                angles = final_box_preds_camera[:, 6]
-                camera_box_origin = [0.5, 1.0, 0.5]
-                box_corners = box_torch_ops.center_to_corner_box3d(
-                    locs, dims, angles, camera_box_origin, axis=1)
-                box_corners_in_image = box_torch_ops.project_to_image(
-                    box_corners, P2)
-                # box_corners_in_image: [N, 8, 2]
-                minxy = torch.min(box_corners_in_image, dim=1)[0]
-                maxxy = torch.max(box_corners_in_image, dim=1)[0]
-                # minx = torch.min(box_corners_in_image[..., 0], dim=1)[0]
-                # maxx = torch.max(box_corners_in_image[..., 0], dim=1)[0]
-                # miny = torch.min(box_corners_in_image[..., 1], dim=1)[0]
-                # maxy = torch.max(box_corners_in_image[..., 1], dim=1)[0]
-                # box_2d_preds = torch.stack([minx, miny, maxx, maxy], dim=1)
-                box_2d_preds = torch.cat([minxy, maxxy], dim=1)
+            if selected_boxes is not None and self._output_format == "lidar":
+                predictions_dict = {
+                    "box3d_lidar": final_box_preds,
+                    "scores": final_scores,
+                    "label_preds": final_labels,
+                    "image_idx": img_idx,
+                }
+            elif selected_boxes is not None:
+                with profile_stage(self._profiler, "projection"):
+                    final_box_preds_camera = box_torch_ops.box_lidar_to_camera(
+                        final_box_preds, rect, Trv2c)
+                    locs = final_box_preds_camera[:, :3]
+                    dims = final_box_preds_camera[:, 3:6]
+                    angles = final_box_preds_camera[:, 6]
+                    camera_box_origin = [0.5, 1.0, 0.5]
+                    box_corners = box_torch_ops.center_to_corner_box3d(
+                        locs, dims, angles, camera_box_origin, axis=1)
+                    box_corners_in_image = box_torch_ops.project_to_image(
+                        box_corners, P2)
+                    # box_corners_in_image: [N, 8, 2]
+                    minxy = torch.min(box_corners_in_image, dim=1)[0]
+                    maxxy = torch.max(box_corners_in_image, dim=1)[0]
+                    # minx = torch.min(box_corners_in_image[..., 0], dim=1)[0]
+                    # maxx = torch.max(box_corners_in_image[..., 0], dim=1)[0]
+                    # miny = torch.min(box_corners_in_image[..., 1], dim=1)[0]
+                    # maxy = torch.max(box_corners_in_image[..., 1], dim=1)[0]
+                    # box_2d_preds = torch.stack([minx, miny, maxx, maxy], dim=1)
+                    box_2d_preds = torch.cat([minxy, maxxy], dim=1)
                 # predictions
                 predictions_dict = {
                     "bbox": box_2d_preds,
@@ -1028,6 +1329,13 @@ class VoxelNet(nn.Module):
                     "label_preds": label_preds,
                     "image_idx": img_idx,
                 }
+            elif self._output_format == "lidar":
+                predictions_dict = {
+                    "box3d_lidar": None,
+                    "scores": None,
+                    "label_preds": None,
+                    "image_idx": img_idx,
+                }
             else:
                 predictions_dict = {
                     "bbox": None,
@@ -1040,8 +1348,202 @@ class VoxelNet(nn.Module):
             predictions_dicts.append(predictions_dict)
         return predictions_dicts
 
+    def compute_predict_batched(self, batch_box_preds, batch_cls_preds,
+                                batch_dir_preds, batch_rect, batch_Trv2c,
+                                batch_P2, batch_imgidx, batch_anchors_mask,
+                                num_class_with_bg):
+        """compute_predict (single label nms) for the whole batch at once.
+        score threshold and top-k run on [B, N] scores, nms runs once
+        with every sample shifted apart in bird's eye view so boxes of
+        different samples never overlap, camera and image projection
+        run on the concatenated detections which are split at the end.
+        batch_box_preds is either [B, N, 7] decoded boxes or a function
+        (batch_ids, anchor_ids) -> [M, 7] that decodes the candidates.
+        with output_format "candidates" nms and projection are skipped.
+        """
+        candidates = self.select_candidates(batch_box_preds, batch_cls_preds,
+                                            batch_dir_preds,
+                                            batch_anchors_mask,
+                                            num_class_with_bg)
+        if self._output_format != "candidates":
+            return self.postprocess_candidates(*candidates, batch_rect,
+                                               batch_Trv2c, batch_P2,
+                                               batch_imgidx)
+        counts = torch.bincount(
+            candidates[0], minlength=len(batch_imgidx)).tolist()
+        keys = ["box3d_lidar", "scores", "label_preds", "dir_labels"]
+        columns = [
+            c.split(counts) if c is not None else [None] * len(counts)
+            for c in candidates[1:]
+        ]
+        predictions_dicts = []
+        for i, img_idx in enumerate(batch_imgidx):
+            predictions_dict = {k: c[i] for k, c in zip(keys, columns)}
+            predictions_dict["image_idx"] = img_idx
+            predictions_dicts.append(predictions_dict)
+        return predictions_dicts
+
+    def select_candidates(self, batch_box_preds, batch_cls_preds,
+                          batch_dir_preds, batch_anchors_mask,
+                          num_class_with_bg):
+        """nms candidates of the whole batch: the anchors with a score
+        above nms_score_threshold, at most nms_pre_max_size per sample.
+        Returns:
+            batch_ids: [M] sample of every candidate, candidates of a
+                sample are ordered by score.
+            box_preds: [M, 7] decoded boxes, direction not fixed yet.
+            scores, labels: [M] top class score and label.
+            dir_labels: [M], None without direction classifier.
+        """
+        batch_size = batch_cls_preds.shape[0]
+        device = batch_cls_preds.device
+        if self._encode_background_as_zeros:
+            # this don't support softmax
+            assert self._use_sigmoid_score is True
+            total_scores = torch.sigmoid(batch_cls_preds)
+        else:
+            # encode background as first element in one-hot vector
+            if self._use_sigmoid_score:
+                total_scores = torch.sigmoid(batch_cls_preds)[..., 1:]
+            else:
+                total_scores = F.softmax(batch_cls_preds, dim=-1)[..., 1:]
+        if num_class_with_bg == 1:
+            top_scores = total_scores.squeeze(-1)
+            top_labels = torch.zeros_like(top_scores, dtype=torch.long)
+        else:
+            top_scores, top_labels = torch.max(total_scores, dim=-1)
+        valid = top_scores >= self._nms_score_threshold
+        if isinstance(batch_anchors_mask, torch.Tensor):
+            valid &= batch_anchors_mask.bool()
+        # candidates of every sample: valid scores, at most pre_max_size.
+        num_cand = min(self._nms_pre_max_size, top_scores.shape[1])
+        cand_scores, cand_idx = torch.topk(
+            torch.where(valid, top_scores, torch.full_like(top_scores, -1)),
+            k=num_cand,
+            dim=1)
+        cand_valid = torch.gather(valid, 1, cand_idx)
+        batch_ids = torch.arange(
+            batch_size, device=device).view(-1, 1).expand_as(cand_idx)
+        batch_ids = batch_ids[cand_valid]
+        anchor_ids = cand_idx[cand_valid]
+        scores = cand_scores[cand_valid]
+        if callable(batch_box_preds):
+            with profile_stage(self._profiler, "decode"):
+                box_preds = batch_box_preds(batch_ids, anchor_ids)
+        else:
+            box_preds = batch_box_preds[batch_ids, anchor_ids]
+        labels = top_labels[batch_ids, anchor_ids]
+        dir_labels = None
+        if self._use_direction_classifier:
+            dir_labels = torch.max(batch_dir_preds, dim=-1)[1]
+            dir_labels = dir_labels[batch_ids, anchor_ids]
+        return batch_ids, box_preds, scores, labels, dir_labels
+
+    def postprocess_candidates(self, batch_ids, box_preds, scores, labels,
+                               dir_labels, batch_rect, batch_Trv2c, batch_P2,
+                               batch_imgidx):
+        """nms, nms_post_max_size per sample, direction fix and projection
+        of select_candidates output.
+        Returns:
+            predictions dicts, one per sample of batch_imgidx.
+        """
+        batch_size = len(batch_imgidx)
+        device = scores.device
+        selected = None
+        if scores.shape[0] > 0:
+            boxes_for_nms = box_preds[:, [0, 1, 3, 4, 6]]
+            if not self._use_rotate_nms:
+                box_preds_corners = box_torch_ops.center_to_corner_box2d(
+                    boxes_for_nms[:, :2], boxes_for_nms[:, 2:4],
+                    boxes_for_nms[:, 4])
+                boxes_for_nms = box_torch_ops.corner_to_standup_nd(
+                    box_preds_corners)
+            # every box lies inside [-2m, 2m] with m the largest
+            # coordinate or dimension.
+            offset = (boxes_for_nms[:, :4].abs().max() + 1) * 4
+            shift = batch_ids.type_as(boxes_for_nms) * offset
+            boxes_for_nms = boxes_for_nms.clone()
+            boxes_for_nms[:, 0] += shift
+            if not self._use_rotate_nms:
+                boxes_for_nms[:, 2] += shift
+            nms_func = (box_torch_ops.rotate_nms
+                        if self._use_rotate_nms else box_torch_ops.nms)
+            with profile_stage(self._profiler, "nms"):
+                selected = nms_func(
+                    boxes_for_nms,
+                    scores,
+                    iou_threshold=self._nms_iou_threshold,
+                    backend=self._nms_backend)
+        if selected is None:
+            counts = [0] * batch_size
+        else:
+            # selected is sorted by score, keep post_max_size per sample.
+            sel_batch, order = torch.sort(batch_ids[selected], stable=True)
+            selected = selected[order]
+            counts = torch.bincount(sel_batch, minlength=batch_size)
+            starts = torch.cumsum(counts, dim=0) - counts
+            rank = torch.arange(
+                selected.shape[0], device=device) - starts[sel_batch]
+            keep = rank < self._nms_post_max_size
+            selected = selected[keep]
+            sel_batch = sel_batch[keep]
+            counts = torch.bincount(
+                sel_batch, minlength=batch_size).tolist()
+
+        predictions_dicts = []
+        if sum(counts) > 0:
+            box_preds = box_preds[selected]
+            scores = scores[selected]
+            labels = labels[selected]
+            if self._use_direction_classifier:
+                dir_labels = dir_labels[selected]
+                opp_labels = dir_labels.bool() ^ (box_preds[..., -1] > 0)
+                box_preds[..., -1] += torch.where(
+                    opp_labels,
+                    torch.tensor(np.pi).type_as(box_preds),
+                    torch.tensor(0.0).type_as(box_preds))
+        if sum(counts) > 0 and self._output_format == "lidar":
+            outputs = {
+                "box3d_lidar": box_preds.split(counts),
+                "scores": scores.split(counts),
+                "label_preds": labels.split(counts),
+            }
+        elif sum(counts) > 0:
+            with profile_stage(self._profiler, "projection"):
+                box_preds_camera = box_torch_ops.batched_box_lidar_to_camera(
+                    box_preds, batch_rect[sel_batch], batch_Trv2c[sel_batch])
+                locs = box_preds_camera[:, :3]
+                dims = box_preds_camera[:, 3:6]
+                angles = box_preds_camera[:, 6]
+                camera_box_origin = [0.5, 1.0, 0.5]
+                box_corners = box_torch_ops.center_to_corner_box3d(
+                    locs, dims, angles, camera_box_origin, axis=1)
+                box_corners_in_image = box_torch_ops.batched_project_to_image(
+                    box_corners, batch_P2[sel_batch])
+                minxy = torch.min(box_corners_in_image, dim=1)[0]
+                maxxy = torch.max(box_corners_in_image, dim=1)[0]
+                box_2d_preds = torch.cat([minxy, maxxy], dim=1)
+            outputs = {
+                "bbox": box_2d_preds.split(counts),
+                "box3d_camera": box_preds_camera.split(counts),
+                "box3d_lidar": box_preds.split(counts),
+                "scores": scores.split(counts),
+                "label_preds": labels.split(counts),
+            }
+        keys = ["box3d_lidar", "scores", "label_preds"]
+        if self._output_format == "kitti":
+            keys = ["bbox", "box3d_camera"] + keys
+        for i in range(batch_size):
+            predictions_dict = {
+                key: outputs[key][i] if counts[i] > 0 else None
+                for key in keys
+            }
+            predictions_dict["image_idx"] = batch_imgidx[i]
+            predictions_dicts.append(predictions_dict)
+        return predictions_dicts
+
     def predict_coarse(self, example, preds_dict):
-        t = time.time()
+        t = self._timestamp(example["anchors"].device)
         batch_size = example['anchors'].shape[0]
         batch_anchors = example["anchors"].view(batch_size, -1, 7)
 
@@ -1055,8 +1557,8 @@ class VoxelNet(nn.Module):
             batch_anchors_mask = example["anchors_mask"].view(batch_size, -1)
         batch_imgidx = example['image_idx']
 
-        self._total_forward_time += time.time() - t
-        t = time.time()
+        self._total_forward_time += self._timestamp(example["anchors"].device) - t
+        t = self._timestamp(example["anchors"].device)
         batch_box_preds = preds_dict["box_preds"]
         batch_cls_preds = preds_dict["cls_preds"]
         batch_box_preds = batch_box_preds.view(batch_size, -1,
@@ -1067,8 +1569,15 @@ class VoxelNet(nn.Module):
 
         batch_cls_preds = batch_cls_preds.view(batch_size, -1,
                                                num_class_with_bg)
-        batch_box_preds = self._box_coder.decode_torch(batch_box_preds,
-                                                       batch_anchors)
+        if self._decode_after_select and self._use_batched_postprocess():
+            batch_box_preds = partial(
+                self.decode_selected,
+                encodings=[batch_box_preds],
+                anchors=batch_anchors)
+        else:
+            with profile_stage(self._profiler, "decode"):
+                batch_box_preds = self._box_coder.decode_torch(
+                    batch_box_preds, batch_anchors)
         if self._use_direction_classifier:
             batch_dir_preds = preds_dict["dir_cls_preds"]
             batch_dir_preds = batch_dir_preds.view(batch_size, -1, 2)
@@ -1078,11 +1587,11 @@ class VoxelNet(nn.Module):
         predictions_dicts = self.compute_predict(batch_box_preds, batch_cls_preds,
                                                  batch_dir_preds, batch_rect, batch_Trv2c,
                                                  batch_P2, batch_imgidx, batch_anchors_mask, num_class_with_bg)
-        self._total_postprocess_time += time.time() - t
+        self._total_postprocess_time += self._timestamp(example["anchors"].device) - t
         return predictions_dicts
 
     def predict_refine(self, example, preds_dict):
-        t = time.time()
+        t = self._timestamp(example["anchors"].device)
         batch_size = example['anchors'].shape[0]
         batch_anchors = example["anchors"].view(batch_size, -1, 7)
 
@@ -1096,8 +1605,8 @@ class VoxelNet(nn.Module):
             batch_anchors_mask = example["anchors_mask"].view(batch_size, -1)
         batch_imgidx = example['image_idx']
 
-        self._total_forward_time += time.time() - t
-        t = time.time()
+        self._total_forward_time += self._timestamp(example["anchors"].device) - t
+        t = self._timestamp(example["anchors"].device)
 
         num_class_with_bg = self._num_class
         if not self._encode_background_as_zeros:
@@ -1114,10 +1623,17 @@ class VoxelNet(nn.Module):
         refine_box_preds = refine_box_preds.view(batch_size, -1,
                                            self._box_coder.code_size)
 
-        de_coarse_boxes = self._box_coder.decode_torch(coarse_box_preds, batch_anchors)
-        de_refine_boxes = self._box_coder.decode_torch(refine_box_preds, de_coarse_boxes)
-
-        batch_box_preds = de_refine_boxes
+        if self._decode_after_select and self._use_batched_postprocess():
+            # refine boxes are decoded over the coarse ones.
+            batch_box_preds = partial(
+                self.decode_selected,
+                encodings=[coarse_box_preds, refine_box_preds],
+                anchors=batch_anchors)
+        else:
+            with profile_stage(self._profiler, "decode"):
+                de_coarse_boxes = self._box_coder.decode_torch(coarse_box_preds, batch_anchors)
+                de_refine_boxes = self._box_coder.decode_torch(refine_box_preds, de_coarse_boxes)
+            batch_box_preds = de_refine_boxes
         batch_cls_preds = refine_cls_preds
         batch_cls_preds = batch_cls_preds.view(batch_size, -1,
                                                num_class_with_bg)
@@ -1131,7 +1647,7 @@ class VoxelNet(nn.Module):
         predictions_dicts = self.compute_predict(batch_box_preds, batch_cls_preds,
                                                  batch_dir_preds, batch_rect, batch_Trv2c,
                                                  batch_P2, batch_imgidx, batch_anchors_mask, num_class_with_bg)
-        self._total_postprocess_time += time.time() - t
+        self._total_postprocess_time += self._timestamp(example["anchors"].device) - t
         return predictions_dicts
 
     @property
@@ -1202,7 +1718,7 @@ class VoxelNet(nn.Module):
         if isinstance(net, torch.nn.modules.batchnorm._BatchNorm):
             net.float()
         for child in net.children():
-            VoxelNet.convert_norm_to_float(net)
+            VoxelNet.convert_norm_to_float(child)
         return net
 
 
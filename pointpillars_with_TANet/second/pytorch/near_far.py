@@ -0,0 +1,297 @@
+"""run near/far (or N) range models as one detector.
+
+every model voxelizes the frame for its own point_cloud_range and runs
+in its own thread (and cuda stream on gpu). detections are merged in
+lidar bird's eye view: boxes inside the overlap zone of two ranges go
+through a per-class rotated nms across models, all other boxes are kept
+as they are.
+
+usage:
+    python ./pytorch/near_far.py evaluate \
+        --config_paths=[near.proto,far.proto] \
+        --ckpt_paths=[near.tckpt,far.tckpt]
+"""
+import pathlib
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fire
+import numpy as np
+import torch
+
+import second.data.kitti_common as kitti
+from second.core import box_np_ops
+from second.core.non_max_suppression.nms_parallel import (
+    rotate_nms_cpu_parallel)
+from second.pytorch.inference import build_inference_context
+from second.pytorch.train import log_metrics
+from second.utils.eval import (EvalSession, GroundTruthTable,
+                               get_distance_eval_result,
+                               get_official_eval_result)
+from second.utils.progress_bar import ProgressBar
+from metrics import AverageMetric, Metric
+
+
+def overlap_zones(ranges, margin=0.0):
+    """bev overlap rectangles of every pair of point cloud ranges.
+    Args:
+        ranges: list of [xmin, ymin, zmin, xmax, ymax, zmax].
+        margin: meters added on every side, boxes close to a range
+            boundary are usually seen (partially) by both models.
+    Returns:
+        zones: [M, 4] array of [xmin, ymin, xmax, ymax].
+    """
+    zones = []
+    for i in range(len(ranges)):
+        for j in range(i + 1, len(ranges)):
+            lo = np.maximum(ranges[i][[0, 1]], ranges[j][[0, 1]]) - margin
+            hi = np.minimum(ranges[i][[3, 4]], ranges[j][[3, 4]]) + margin
+            if np.all(hi > lo):
+                zones.append(np.concatenate([lo, hi]))
+    return np.array(zones, dtype=np.float32).reshape(-1, 4)
+
+
+def merge_annos(annos, rect, Trv2c, zones, iou_threshold=0.1):
+    """merge kitti annos of several models of the same frame.
+    """
+    annos = [a for a in annos if len(a["name"]) > 0]
+    if len(annos) == 0:
+        return kitti.empty_result_anno()
+    merged = {
+        key: np.concatenate([a[key] for a in annos], axis=0)
+        for key in annos[0].keys()
+    }
+    if len(annos) == 1 or len(zones) == 0:
+        return merged
+    model_ids = np.concatenate(
+        [np.full([len(a["name"])], i) for i, a in enumerate(annos)])
+    boxes_camera = np.concatenate([
+        merged["location"], merged["dimensions"],
+        merged["rotation_y"][..., np.newaxis]
+    ], axis=1)
+    boxes_lidar = box_np_ops.box_camera_to_lidar(boxes_camera, rect, Trv2c)
+    xy = boxes_lidar[:, :2]
+    in_zone = np.zeros([len(xy)], dtype=np.bool_)
+    for zone in zones:
+        in_zone |= np.all((xy >= zone[:2]) & (xy <= zone[2:]), axis=1)
+    keep = ~in_zone
+    for name in np.unique(merged["name"][in_zone]):
+        cand = np.where(in_zone & (merged["name"] == name))[0]
+        if len(np.unique(model_ids[cand])) < 2:
+            keep[cand] = True
+            continue
+        dets = np.concatenate([
+            boxes_lidar[cand][:, [0, 1, 3, 4, 6]],
+            merged["score"][cand][:, np.newaxis]
+        ], axis=1).astype(np.float32)
+        keep[cand[rotate_nms_cpu_parallel(dets, iou_threshold)]] = True
+    return {key: val[keep] for key, val in merged.items()}
+
+
+class NearFarInferenceEngine:
+    """N inference contexts with (partially) disjoint point cloud ranges.
+    """
+    def __init__(self,
+                 config_paths,
+                 ckpt_paths,
+                 root_path=None,
+                 backend="torch",
+                 device=None,
+                 iou_threshold=0.1,
+                 boundary_margin=2.0,
+                 concurrent=True,
+                 **ctx_kwargs):
+        assert len(config_paths) == len(ckpt_paths)
+        if device is None and backend == "torch":
+            device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        if backend == "torch":
+            ctx_kwargs["device"] = torch.device(device)
+        # one list of annos per context, PSA included.
+        ctx_kwargs["refine_only"] = True
+        self.contexts = []
+        for config_path, ckpt_path in zip(config_paths, ckpt_paths):
+            ctx = build_inference_context(backend, **ctx_kwargs)
+            ctx.build(str(config_path))
+            ctx.restore(str(ckpt_path))
+            ctx.root_path = root_path
+            self.contexts.append(ctx)
+        self.names = [pathlib.Path(p).stem for p in config_paths]
+        if len(set(self.names)) != len(self.names):
+            self.names = [
+                "{}_{}".format(i, n) for i, n in enumerate(self.names)
+            ]
+        self.ranges = [
+            ctx.voxel_generator.point_cloud_range for ctx in self.contexts
+        ]
+        self.zones = overlap_zones(self.ranges, boundary_margin)
+        self.iou_threshold = iou_threshold
+        self.streams = [None] * len(self.contexts)
+        use_cuda = getattr(self.contexts[0], "device",
+                           torch.device("cpu")).type == "cuda"
+        if concurrent and use_cuda:
+            self.streams = [torch.cuda.Stream() for _ in self.contexts]
+        if concurrent and not use_cuda:
+            # "auto" nms runs the numba parallel kernels on cpu, launching
+            # them from several threads hangs the workqueue layer.
+            for ctx in self.contexts:
+                ctx.net.set_nms_backend("torch")
+        self.executor = None
+        if concurrent:
+            self.executor = ThreadPoolExecutor(len(self.contexts))
+        self.latency = {
+            name: AverageMetric()
+            for name in self.names + ["merge", "total"]
+        }
+
+    def _run_one(self, ctx, stream, info, points):
+        t = time.perf_counter()
+        example = ctx.get_inference_input_dict(info, points)
+        if stream is not None:
+            with torch.cuda.stream(stream):
+                with ctx.ctx():
+                    anno = ctx.inference(example)[0]
+            stream.synchronize()
+        else:
+            with ctx.ctx():
+                anno = ctx.inference(example)[0]
+        return anno, time.perf_counter() - t
+
+    def inference(self, info, points):
+        """detect one frame.
+        Returns:
+            anno: a single kitti anno merged from all models.
+        """
+        t = time.perf_counter()
+        args = list(zip(self.contexts, self.streams))
+        if self.executor is not None:
+            futures = [
+                self.executor.submit(self._run_one, ctx, stream, info, points)
+                for ctx, stream in args
+            ]
+            results = [f.result() for f in futures]
+        else:
+            results = [
+                self._run_one(ctx, stream, info, points)
+                for ctx, stream in args
+            ]
+        for name, (_, latency) in zip(self.names, results):
+            self.latency[name].update(latency * 1000)
+        t_merge = time.perf_counter()
+        anno = merge_annos([r[0] for r in results],
+                           info["calib/R0_rect"],
+                           info["calib/Tr_velo_to_cam"], self.zones,
+                           self.iou_threshold)
+        num_example = len(anno["name"])
+        anno["image_idx"] = np.array([info["image_idx"]] * num_example,
+                                     dtype=np.int64)
+        t_end = time.perf_counter()
+        self.latency["merge"].update((t_end - t_merge) * 1000)
+        self.latency["total"].update((t_end - t) * 1000)
+        return anno
+
+    def latency_metrics(self):
+        return {
+            name + " latency ms": metric
+            for name, metric in self.latency.items()
+        }
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def _read_points(info, root_path, num_point_features):
+    v_path = pathlib.Path(root_path) / info['velodyne_path']
+    v_path = v_path.parent.parent / (
+        v_path.parent.stem + "_reduced") / v_path.name
+    return np.fromfile(
+        str(v_path), dtype=np.float32,
+        count=-1).reshape([-1, num_point_features])
+
+
+def evaluate(config_paths,
+             ckpt_paths,
+             backend="torch",
+             device=None,
+             iou_threshold=0.1,
+             boundary_margin=2.0,
+             concurrent=True,
+             num_frames=None,
+             metrics_file_name=None,
+             distance_bins=None,
+             distance="x"):
+    """evaluate the merged detector on the eval split of the first config.
+    Args:
+        distance_bins: e.g. [0, 20, 35, 50], AP per distance bin as well,
+            see get_distance_eval_result.
+    """
+    engine = NearFarInferenceEngine(
+        config_paths,
+        ckpt_paths,
+        backend=backend,
+        device=device,
+        iou_threshold=iou_threshold,
+        boundary_margin=boundary_margin,
+        concurrent=concurrent)
+    config = engine.contexts[0].config
+    input_cfg = config.eval_input_reader
+    model_cfg = config.model.second
+    class_names = list(input_cfg.class_names)
+    root_path = input_cfg.kitti_root_path
+    for ctx in engine.contexts:
+        ctx.root_path = root_path
+    with open(input_cfg.kitti_info_path, "rb") as f:
+        kitti_infos = pickle.load(f)
+    if num_frames is not None:
+        kitti_infos = kitti_infos[:num_frames]
+    dt_annos = []
+    bar = ProgressBar()
+    bar.start(len(kitti_infos))
+    for info in kitti_infos:
+        points = _read_points(info, root_path, model_cfg.num_point_features)
+        dt_annos.append(engine.inference(info, points))
+        bar.print_bar()
+    print()
+    engine.close()
+    gt_annos = [info["annos"] for info in kitti_infos]
+    session = EvalSession(gt_annos,
+                          dt_annos,
+                          gt_table=GroundTruthTable.from_infos(kitti_infos))
+    result, _, _, mAP3d, _ = get_official_eval_result(
+        gt_annos, dt_annos, class_names, return_data=True, session=session)
+    print(result)
+    total_metrics = {
+        "Models": Metric(", ".join(engine.names)),
+        **engine.latency_metrics(),
+    }
+    for i, class_name in enumerate(class_names):
+        metric = Metric()
+        metric.update([mAP3d[i, 0, 0], mAP3d[i, 1, 0], mAP3d[i, 2, 0]])
+        total_metrics["Near/far " + class_name + " 3D APs"] = metric
+    if distance_bins is not None:
+        result, ap_by_bin = get_distance_eval_result(gt_annos,
+                                                     dt_annos,
+                                                     class_names,
+                                                     distance_bins,
+                                                     distance,
+                                                     return_data=True,
+                                                     session=session)
+        print(result)
+        for name, (_, _, mAP3d, _, _) in ap_by_bin.items():
+            if name == "all":
+                continue
+            for i, class_name in enumerate(class_names):
+                metric = Metric()
+                metric.update(
+                    [mAP3d[i, 0, 0], mAP3d[i, 1, 0], mAP3d[i, 2, 0]])
+                total_metrics["Near/far " + class_name + " 3D APs " +
+                              name] = metric
+    if metrics_file_name is not None:
+        log_metrics(metrics_file_name, total_metrics)
+    log_metrics("console", total_metrics)
+    return dt_annos
+
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -0,0 +1,288 @@
+"""parity of the numba cpu nms kernels against the existing kernels.
+
+``record`` stores the nms candidates (decoded bev boxes and scores after
+the score threshold and pre_max_size) of eval frames, ``check`` runs
+every available kernel on them, plus frames of identical and collinear
+boxes, and reports frames whose keep indices differ from the reference
+kernel, plus the mean kernel latency.
+``benchmark`` times box_torch_ops.rotate_nms per backend.
+
+usage:
+    python ./pytorch/nms_parity.py record --config_path=... \
+        --ckpt_path=... --output_path=nms_dets.pkl --num_frames=100
+    python ./pytorch/nms_parity.py check --dets_path=nms_dets.pkl
+    python ./pytorch/nms_parity.py benchmark --pre_max_size=1000
+"""
+import pickle
+import time
+from functools import partial
+
+import fire
+import numpy as np
+import torch
+from google.protobuf import text_format
+
+import torchplus
+from second.builder import target_assigner_builder, voxel_builder
+from second.core import box_np_ops
+from second.core.non_max_suppression.nms_parallel import (
+    nms_cpu_parallel, rotate_nms_cpu_parallel)
+from second.data.preprocess import merge_second_batch
+from second.protos import pipeline_pb2
+from second.pytorch.builder import (box_coder_builder, input_reader_builder,
+                                    second_builder)
+from second.pytorch.core import box_torch_ops
+from second.pytorch.train import example_convert_to_torch
+from second.utils.progress_bar import ProgressBar
+
+
+def _torch_kernel(dets, thresh, rotate):
+    dets = torch.from_numpy(dets)
+    order = torch.argsort(dets[:, -1], descending=True)
+    keep = box_torch_ops.greedy_keep(
+        box_torch_ops._suppression_matrix(dets[order, :-1], thresh, rotate))
+    return order[keep].numpy()
+
+
+def _available_kernels(rotate):
+    """name -> kernel(dets, thresh), kernels that fail to import are
+    skipped (no cuda device, no pybind build).
+    """
+    if rotate:
+        kernels = {"cpu": rotate_nms_cpu_parallel}
+    else:
+        kernels = {"cpu": nms_cpu_parallel}
+    kernels["torch"] = partial(_torch_kernel, rotate=rotate)
+    try:
+        from second.core.non_max_suppression.nms_gpu import (nms_gpu,
+                                                             rotate_nms_gpu)
+        kernels["gpu"] = rotate_nms_gpu if rotate else nms_gpu
+    except Exception as e:
+        print("skip numba.cuda kernels: {}".format(e))
+    try:
+        from second.core.non_max_suppression.nms_cpu import (nms_cc,
+                                                             rotate_nms_cc)
+        kernels["cc"] = rotate_nms_cc if rotate else nms_cc
+    except Exception as e:
+        print("skip pybind kernels: {}".format(e))
+    return kernels
+
+
+def record(config_path,
+           ckpt_path,
+           output_path,
+           num_frames=100,
+           device=None):
+    """store rotated nms candidates [N, 6] of the first eval frames.
+    """
+    config = pipeline_pb2.TrainEvalPipelineConfig()
+    with open(config_path, "r") as f:
+        proto_str = f.read()
+        text_format.Merge(proto_str, config)
+    input_cfg = config.eval_input_reader
+    model_cfg = config.model.second
+    if device is None:
+        device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+
+    voxel_generator = voxel_builder.build(model_cfg.voxel_generator)
+    bv_range = voxel_generator.point_cloud_range[[0, 1, 3, 4]]
+    box_coder = box_coder_builder.build(model_cfg.box_coder)
+    target_assigner = target_assigner_builder.build(
+        model_cfg.target_assigner, bv_range, box_coder)
+    net = second_builder.build(model_cfg, voxel_generator, target_assigner)
+    torchplus.train.restore(ckpt_path, net)
+    net.to(device).eval()
+    eval_dataset = input_reader_builder.build(
+        input_cfg,
+        model_cfg,
+        training=False,
+        voxel_generator=voxel_generator,
+        target_assigner=target_assigner)
+    num_frames = min(num_frames, len(eval_dataset))
+
+    recorded = []
+    bar = ProgressBar()
+    bar.start(num_frames)
+    with torch.no_grad():
+        for i in range(num_frames):
+            example = merge_second_batch([eval_dataset[i]])
+            example = example_convert_to_torch(example, torch.float32, device)
+            bar.print_bar()
+            if len(example["voxels"]) < 4:
+                continue
+            preds_dict = net.network_forward(example)
+            anchors = example["anchors"].view(-1, 7)
+            box_preds = box_coder.decode_torch(
+                preds_dict["box_preds"].view(-1, box_coder.code_size),
+                anchors)
+            scores = torch.sigmoid(preds_dict["cls_preds"].view(
+                anchors.shape[0], -1).float()).max(dim=-1)[0]
+            mask = scores >= model_cfg.nms_score_threshold
+            if "anchors_mask" in example:
+                mask &= example["anchors_mask"].view(-1).bool()
+            box_preds = box_preds[mask]
+            scores = scores[mask]
+            k = min(model_cfg.nms_pre_max_size, scores.shape[0])
+            scores, indices = torch.topk(scores, k=k)
+            dets = torch.cat(
+                [box_preds[indices][:, [0, 1, 3, 4, 6]],
+                 scores.unsqueeze(-1)],
+                dim=1)
+            recorded.append(dets.cpu().numpy().astype(np.float32))
+    print()
+    with open(output_path, "wb") as f:
+        pickle.dump({
+            "dets": recorded,
+            "iou_threshold": model_cfg.nms_iou_threshold,
+        }, f)
+    print("record {} frames to {}".format(len(recorded), output_path))
+
+
+def _standup_dets(rdets):
+    corners = box_np_ops.center_to_corner_box2d(rdets[:, :2], rdets[:, 2:4],
+                                                rdets[:, 4])
+    standup = box_np_ops.corner_to_standup_nd(corners)
+    return np.concatenate([standup, rdets[:, 5:]],
+                          axis=1).astype(np.float32)
+
+
+def _degenerate_dets(rng, num_boxes=40):
+    """frames of candidates with degenerate overlaps: exact duplicates of
+    rotated and axis-aligned boxes, and boxes shifted along their own x
+    axis so their long edges are collinear (touching and overlapping).
+    """
+    boxes = _random_dets(num_boxes, rng)
+    boxes[:num_boxes // 4, 4] = 0.0
+    # only one corner of the pair passes point_in_quadrilateral.
+    boxes[0] = [0.9566196, 0.4077631, 2.3086958, 3.4210815, 2.4007568, 0.9]
+    duplicates = boxes.copy()
+    duplicates[:, 5] = rng.uniform(size=[num_boxes])
+    axis = np.stack([np.cos(boxes[:, 4]), -np.sin(boxes[:, 4])], axis=1)
+    frames = [np.concatenate([boxes, duplicates])]
+    for shift in [1.0, 0.5]:
+        shifted = duplicates.copy()
+        shifted[:, :2] += shift * boxes[:, 2:3] * axis
+        frames.append(np.concatenate([boxes, shifted]))
+    return [frame.astype(np.float32) for frame in frames]
+
+
+def check(dets_path, iou_threshold=None, reference=None, degenerate=True):
+    """compare keep indices of all kernels on recorded candidates.
+    Args:
+        iou_threshold: None for the recorded one.
+        reference: kernel compared against, "gpu" if available, else "cc".
+        degenerate: add the frames of _degenerate_dets.
+    Returns:
+        dict: "rotate" / "standup" -> kernel name -> number of frames
+            with different keep indices.
+    """
+    with open(dets_path, "rb") as f:
+        recorded = pickle.load(f)
+    if iou_threshold is None:
+        iou_threshold = recorded["iou_threshold"]
+    frames = list(recorded["dets"])
+    if degenerate:
+        frames += _degenerate_dets(np.random.default_rng(0))
+    report = {}
+    for mode, rotate in [("rotate", True), ("standup", False)]:
+        kernels = _available_kernels(rotate)
+        ref = reference
+        if ref is None:
+            ref = "gpu" if "gpu" in kernels else "cc"
+        if ref not in kernels:
+            print("{}: reference kernel {} not available".format(mode, ref))
+            continue
+        keeps = {name: [] for name in kernels}
+        times = {name: 0.0 for name in kernels}
+        warmup = [d for d in frames if len(d) > 0][:1]
+        for rdets in warmup:
+            # jit compilation isn't part of the latency.
+            dets = rdets if rotate else _standup_dets(rdets)
+            for kernel in kernels.values():
+                kernel(dets, iou_threshold)
+        for rdets in frames:
+            dets = rdets if rotate else _standup_dets(rdets)
+            if len(dets) == 0:
+                continue
+            for name, kernel in kernels.items():
+                t = time.perf_counter()
+                keep = np.array(kernel(dets, iou_threshold), dtype=np.int64)
+                times[name] += time.perf_counter() - t
+                keeps[name].append(keep)
+        num_frames = len(keeps[ref])
+        report[mode] = {}
+        print("{} nms, reference {}, {} frames:".format(mode, ref,
+                                                        num_frames))
+        for name in kernels:
+            mismatch = sum(not np.array_equal(a, b)
+                           for a, b in zip(keeps[name], keeps[ref]))
+            report[mode][name] = mismatch
+            print("  {:<8}mismatched frames: {:>5}  mean {:.3f} ms".format(
+                name, mismatch, times[name] / max(num_frames, 1) * 1000))
+    return report
+
+
+def _random_dets(num_boxes, rng):
+    """candidates clustered around objects, like rpn outputs.
+    """
+    num_objects = max(num_boxes // 20, 1)
+    centers = rng.uniform([0, -40], [70, 40], size=[num_objects, 2])
+    obj = rng.integers(0, num_objects, size=num_boxes)
+    xy = centers[obj] + rng.normal(scale=0.5, size=[num_boxes, 2])
+    wl = np.array([1.6, 3.9]) + rng.normal(scale=0.2, size=[num_boxes, 2])
+    angle = rng.uniform(-np.pi, np.pi, size=[num_objects])[obj]
+    angle += rng.normal(scale=0.1, size=[num_boxes])
+    scores = rng.uniform(size=[num_boxes])
+    return np.concatenate([xy, wl, angle[:, None], scores[:, None]],
+                          axis=1).astype(np.float32)
+
+
+def benchmark(dets_path=None,
+              pre_max_size=1000,
+              post_max_size=300,
+              iou_threshold=0.1,
+              num_frames=20,
+              device="cpu",
+              backends=("torch", "cpu", "legacy")):
+    """mean latency of box_torch_ops.rotate_nms per backend.
+    Args:
+        dets_path: recorded candidates, None for random clustered boxes
+            (pre_max_size boxes per frame).
+    """
+    device = torch.device(device)
+    if dets_path is not None:
+        with open(dets_path, "rb") as f:
+            frames = pickle.load(f)["dets"][:num_frames]
+    else:
+        rng = np.random.default_rng(0)
+        frames = [_random_dets(pre_max_size, rng) for _ in range(num_frames)]
+    frames = [torch.from_numpy(d).to(device) for d in frames if len(d) > 0]
+    results = {}
+    for backend in backends:
+        try:
+            # warmup, includes jit compilation.
+            box_torch_ops.rotate_nms(frames[0][:, :5], frames[0][:, 5],
+                                     pre_max_size, post_max_size,
+                                     iou_threshold, backend=backend)
+        except Exception as e:
+            print("skip {}: {}".format(backend, e))
+            continue
+        total = 0.0
+        for dets in frames:
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            t = time.perf_counter()
+            box_torch_ops.rotate_nms(dets[:, :5], dets[:, 5], pre_max_size,
+                                     post_max_size, iou_threshold,
+                                     backend=backend)
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            total += time.perf_counter() - t
+        results[backend] = total / len(frames) * 1000
+        print("{:<8}{:>10.3f} ms".format(backend, results[backend]))
+    return results
+
+
+if __name__ == '__main__':
+    fire.Fire()
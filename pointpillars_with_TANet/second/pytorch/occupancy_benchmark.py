@@ -0,0 +1,189 @@
+"""latency of the occupancy-cropped rpn versus the full canvas run.
+
+for every frame of the eval input reader the network (VFE, scatter,
+RPN) runs once on the full canvas and once on the occupancy crop. frames
+are binned by occupancy (crop area / canvas area). the table reports
+both latencies and the largest output difference over the anchors kept
+by the crop. at the default margin (the rpn receptive field) the kept
+outputs must equal the full run, checked with the reference conv
+kernels; the table shows the fp32 rounding of the default kernels then.
+a smaller margin reports the error of the approximation.
+
+usage:
+    python ./pytorch/occupancy_benchmark.py occupancy_latency \
+        --config_path=... --ckpt_path=... --margin=16
+"""
+import time
+
+import fire
+import numpy as np
+import torch
+from google.protobuf import text_format
+
+import torchplus
+from second.builder import target_assigner_builder, voxel_builder
+from second.data.preprocess import merge_second_batch
+from second.protos import pipeline_pb2
+from second.pytorch.builder import (box_coder_builder, input_reader_builder,
+                                    second_builder)
+from second.pytorch.train import example_convert_to_torch
+from second.utils.progress_bar import ProgressBar
+
+
+def _timed_network_forward(net, example, device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    t = time.perf_counter()
+    preds_dict = net.network_forward(example)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return preds_dict, time.perf_counter() - t
+
+
+def _max_diff(preds_crop, preds_full, inside):
+    max_diff = 0.0
+    for name, full in preds_full.items():
+        batch_size = full.shape[0]
+        diff = (preds_crop[name] - full).abs().view(
+            batch_size, inside.shape[1], -1)[inside]
+        if diff.numel() > 0:
+            max_diff = max(max_diff, diff.max().item())
+    return max_diff
+
+
+def _exact_diff(net, example, inside):
+    """_max_diff of the default margin with the reference conv kernels:
+    mkldnn and cudnn pick kernels by input size, which reorders fp32
+    sums between the cropped and the full run.
+    """
+    with torch.backends.mkldnn.flags(enabled=False), \
+            torch.backends.cudnn.flags(enabled=False):
+        net.set_occupancy_crop(True)
+        preds_crop = net.network_forward(example)
+        net.set_occupancy_crop(False)
+        preds_full = net.network_forward(example)
+    return _max_diff(preds_crop, preds_full, inside)
+
+
+def occupancy_latency(config_path,
+                      ckpt_path=None,
+                      num_frames=None,
+                      margin=None,
+                      num_bins=10,
+                      warmup_frames=5,
+                      device=None,
+                      csv_path=None):
+    """measure full vs cropped rpn latency against occupancy.
+    Args:
+        ckpt_path: None for random weights (latency only).
+        margin: occupancy crop margin in pillars, None for the rpn
+            receptive field (VoxelNet.occupancy_crop_context).
+        num_bins: number of equal-width occupancy bins in [0, 1].
+        csv_path: if not None, write per-frame results there.
+    """
+    config = pipeline_pb2.TrainEvalPipelineConfig()
+    with open(config_path, "r") as f:
+        proto_str = f.read()
+        text_format.Merge(proto_str, config)
+    input_cfg = config.eval_input_reader
+    model_cfg = config.model.second
+    if device is None:
+        device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+
+    voxel_generator = voxel_builder.build(model_cfg.voxel_generator)
+    bv_range = voxel_generator.point_cloud_range[[0, 1, 3, 4]]
+    box_coder = box_coder_builder.build(model_cfg.box_coder)
+    target_assigner = target_assigner_builder.build(
+        model_cfg.target_assigner, bv_range, box_coder)
+    net = second_builder.build(model_cfg, voxel_generator, target_assigner)
+    if ckpt_path is not None:
+        torchplus.train.restore(ckpt_path, net)
+    net.to(device).eval()
+    eval_dataset = input_reader_builder.build(
+        input_cfg,
+        model_cfg,
+        training=False,
+        voxel_generator=voxel_generator,
+        target_assigner=target_assigner)
+    if num_frames is None:
+        num_frames = len(eval_dataset)
+    num_frames = min(num_frames, len(eval_dataset))
+    scatter = net.middle_feature_extractor
+    canvas_area = scatter.ny * scatter.nx
+
+    records = []
+    bar = ProgressBar()
+    bar.start(num_frames)
+    with torch.no_grad():
+        for i in range(num_frames):
+            example = merge_second_batch([eval_dataset[i]])
+            example = example_convert_to_torch(example, torch.float32, device)
+            bar.print_bar()
+            if len(example["voxels"]) < 4:
+                continue
+            net.set_occupancy_crop(True, margin)
+            crop, keep = net.occupancy_crop(example["coordinates"])
+            preds_crop, crop_time = _timed_network_forward(
+                net, example, device)
+            net.set_occupancy_crop(False)
+            preds_full, full_time = _timed_network_forward(
+                net, example, device)
+            if i < warmup_frames:
+                continue
+            # every anchor kept by the crop, regardless of anchors_mask.
+            inside = net.crop_anchors_mask({
+                "anchors": example["anchors"]
+            }, keep).bool()
+            max_diff = _max_diff(preds_crop, preds_full, inside)
+            if margin is None:
+                exact_diff = _exact_diff(net, example, inside)
+                assert exact_diff == 0.0, (
+                    "frame {}: cropped rpn differs from the full run by {}"
+                    .format(example["image_idx"][0], exact_diff))
+            occupancy = (crop[1] - crop[0]) * (crop[3] - crop[2]) / canvas_area
+            records.append(
+                [example["image_idx"][0], occupancy, full_time, crop_time,
+                 max_diff])
+    print()
+    records = np.array(records, dtype=np.float64).reshape(-1, 5)
+    if csv_path is not None:
+        np.savetxt(
+            csv_path,
+            records,
+            delimiter=",",
+            header="image_idx,occupancy,full_s,crop_s,max_abs_diff",
+            comments="")
+    print(occupancy_table_str(records, num_bins))
+    return records
+
+
+def occupancy_table_str(records, num_bins=10):
+    lines = [
+        "{:<14}{:>8}{:>12}{:>12}{:>10}{:>14}".format(
+            "occupancy", "frames", "full ms", "crop ms", "speedup",
+            "max abs diff")
+    ]
+    edges = np.linspace(0, 1, num_bins + 1)
+    bin_idx = np.clip(
+        np.digitize(records[:, 1], edges) - 1, 0, num_bins - 1)
+    for b in range(num_bins):
+        rec = records[bin_idx == b]
+        if len(rec) == 0:
+            continue
+        full_ms = rec[:, 2].mean() * 1000
+        crop_ms = rec[:, 3].mean() * 1000
+        lines.append("{:<14}{:>8}{:>12.2f}{:>12.2f}{:>10.2f}{:>14.6f}".format(
+            "{:.2f}-{:.2f}".format(edges[b], edges[b + 1]), len(rec),
+            full_ms, crop_ms, full_ms / crop_ms, rec[:, 4].max()))
+    if len(records) > 0:
+        full_ms = records[:, 2].mean() * 1000
+        crop_ms = records[:, 3].mean() * 1000
+        lines.append("{:<14}{:>8}{:>12.2f}{:>12.2f}{:>10.2f}{:>14.6f}".format(
+            "all", len(records), full_ms, crop_ms, full_ms / crop_ms,
+            records[:, 4].max()))
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    fire.Fire()
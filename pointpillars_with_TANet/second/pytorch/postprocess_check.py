@@ -0,0 +1,168 @@
+"""check the fast postprocess paths of VoxelNet against the original one.
+
+the network runs once per frame, then every postprocess mode predicts
+from the same rpn outputs:
+    per_sample: original per-sample loop, every anchor decoded.
+    batched: compute_predict_batched, every anchor decoded.
+    decode_after_select: batched, only the candidates are decoded.
+decode_after_select must be bit-exact to batched, batched must give the
+same detections as per_sample (nms on shifted boxes may flip borderline
+suppressions at batch size > 1 by float rounding).
+
+usage:
+    python ./pytorch/postprocess_check.py check --config_path=... \
+        --ckpt_path=... --num_frames=50
+"""
+import time
+
+import fire
+import numpy as np
+import torch
+from google.protobuf import text_format
+
+import torchplus
+from second.builder import target_assigner_builder, voxel_builder
+from second.data.preprocess import merge_second_batch
+from second.protos import pipeline_pb2
+from second.pytorch.builder import (box_coder_builder, input_reader_builder,
+                                    second_builder)
+from second.pytorch.train import example_convert_to_torch
+from second.utils.progress_bar import ProgressBar
+
+POSTPROCESS_MODES = {
+    "per_sample": (False, False),
+    "batched": (True, False),
+    "decode_after_select": (True, True),
+}
+
+
+def _predict(net, example, preds_dict, use_coarse_to_fine):
+    if "anchors_mask" in preds_dict:
+        example = {**example, "anchors_mask": preds_dict["anchors_mask"]}
+    if use_coarse_to_fine:
+        return net.predict_refine(example, preds_dict)
+    return net.predict_coarse(example, preds_dict)
+
+
+def _compare(dicts, ref_dicts):
+    """Returns: (bit-exact, max abs diff) over all detections."""
+    exact = True
+    max_diff = 0.0
+    for pred, ref in zip(dicts, ref_dicts):
+        for key, ref_val in ref.items():
+            val = pred[key]
+            if not isinstance(ref_val, torch.Tensor):
+                exact &= (val is None) == (ref_val is None)
+                continue
+            if val is None or val.shape != ref_val.shape:
+                return False, np.inf
+            exact &= torch.equal(val, ref_val)
+            if val.numel() > 0:
+                max_diff = max(max_diff,
+                               (val.double() - ref_val.double()).abs().max()
+                               .item())
+    return exact, max_diff
+
+
+def check(config_path,
+          ckpt_path,
+          num_frames=50,
+          batch_size=None,
+          device=None):
+    """compare detections and postprocess latency of all modes.
+    Args:
+        batch_size: None for eval_input_reader.batch_size.
+    Returns:
+        dict: mode -> {"exact", "max_diff", "postprocess_ms"}, compared
+            to per_sample (decode_after_select compared to batched).
+    """
+    config = pipeline_pb2.TrainEvalPipelineConfig()
+    with open(config_path, "r") as f:
+        proto_str = f.read()
+        text_format.Merge(proto_str, config)
+    input_cfg = config.eval_input_reader
+    model_cfg = config.model.second
+    use_coarse_to_fine = model_cfg.rpn.module_class_name in [
+        "PSA", "RefineDet"
+    ]
+    if batch_size is None:
+        batch_size = input_cfg.batch_size
+    if device is None:
+        device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+
+    voxel_generator = voxel_builder.build(model_cfg.voxel_generator)
+    bv_range = voxel_generator.point_cloud_range[[0, 1, 3, 4]]
+    box_coder = box_coder_builder.build(model_cfg.box_coder)
+    target_assigner = target_assigner_builder.build(
+        model_cfg.target_assigner, bv_range, box_coder)
+    net = second_builder.build(model_cfg, voxel_generator, target_assigner)
+    torchplus.train.restore(ckpt_path, net)
+    net.to(device).eval()
+    eval_dataset = input_reader_builder.build(
+        input_cfg,
+        model_cfg,
+        training=False,
+        voxel_generator=voxel_generator,
+        target_assigner=target_assigner)
+    num_frames = min(num_frames, len(eval_dataset))
+
+    report = {
+        mode: {
+            "exact": True,
+            "max_diff": 0.0,
+            "postprocess_ms": 0.0
+        }
+        for mode in POSTPROCESS_MODES
+    }
+    num_batches = 0
+    bar = ProgressBar()
+    bar.start((num_frames + batch_size - 1) // batch_size)
+    with torch.no_grad():
+        for start in range(0, num_frames, batch_size):
+            example = merge_second_batch([
+                eval_dataset[i]
+                for i in range(start, min(start + batch_size, num_frames))
+            ])
+            example = example_convert_to_torch(example, torch.float32, device)
+            bar.print_bar()
+            if len(example["voxels"]) < 4:
+                continue
+            preds_dict = net.network_forward(example)
+            outputs = {}
+            for mode, (batched, decode_after_select) in (
+                    POSTPROCESS_MODES.items()):
+                net.set_batched_postprocess(batched)
+                net.set_decode_after_select(decode_after_select)
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                t = time.perf_counter()
+                outputs[mode] = _predict(net, example, preds_dict,
+                                         use_coarse_to_fine)
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                report[mode]["postprocess_ms"] += (
+                    time.perf_counter() - t) * 1000
+            num_batches += 1
+            for mode, ref_mode in [("batched", "per_sample"),
+                                   ("decode_after_select", "batched")]:
+                exact, max_diff = _compare(outputs[mode], outputs[ref_mode])
+                report[mode]["exact"] &= exact
+                report[mode]["max_diff"] = max(report[mode]["max_diff"],
+                                               max_diff)
+    print()
+    net.set_batched_postprocess(True)
+    net.set_decode_after_select(True)
+    print("{:<22}{:>12}{:>8}{:>14}".format("mode", "reference", "exact",
+                                           "max abs diff"))
+    for mode, ref_mode in [("per_sample", "-"), ("batched", "per_sample"),
+                           ("decode_after_select", "batched")]:
+        report[mode]["postprocess_ms"] /= max(num_batches, 1)
+        print("{:<22}{:>12}{:>8}{:>14.6f}  {:.3f} ms".format(
+            mode, ref_mode, str(report[mode]["exact"]),
+            report[mode]["max_diff"], report[mode]["postprocess_ms"]))
+    return report
+
+
+if __name__ == '__main__':
+    fire.Fire()
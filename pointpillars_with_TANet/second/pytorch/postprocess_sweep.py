@@ -0,0 +1,489 @@
+"""sweep the postprocessing parameters without re-running the network.
+
+dump runs the network once over the eval split and saves the nms
+candidates of every frame (output_format "candidates": decoded boxes,
+scores, labels and direction labels of the max_candidates best anchors
+above min_score, see VoxelNet.select_candidates) with the frame's image
+shape and calibs to one npz file. PSA / RefineDet dumps hold the coarse
+and the refine candidates.
+
+sweep re-runs only nms, the kitti output and the official eval for
+every setting of a grid of nms_score_threshold, nms_iou_threshold,
+nms_pre_max_size, nms_post_max_size, post_center_limit_range and head
+(coarse / refine), the settings are spread over worker processes. a
+score threshold >= min_score and a pre_max_size <= max_candidates give
+the detections of evaluate() with these settings.
+
+usage:
+    python ./pytorch/postprocess_sweep.py dump --config_path=pp.proto \
+        --model_dir=/path/to/model_dir --dump_path=candidates.npz
+    python ./pytorch/postprocess_sweep.py sweep --config_path=pp.proto \
+        --dump_path=candidates.npz --score_thresholds=[0.05,0.3,0.5] \
+        --iou_thresholds=[0.01,0.1] --md_path=sweep.md
+"""
+import itertools
+import multiprocessing
+import pathlib
+import pickle
+import time
+
+import fire
+import numpy as np
+import torch
+from google.protobuf import text_format
+
+import torchplus
+from second.builder import target_assigner_builder, voxel_builder
+from second.data.preprocess import merge_second_batch
+from second.protos import pipeline_pb2
+from second.pytorch.builder import (box_coder_builder, input_reader_builder,
+                                    second_builder)
+from second.pytorch.precision import PrecisionPolicy
+from second.pytorch.train import comput_kitti_output, example_convert_to_torch
+from second.utils.eval import (EvalSession, GroundTruthTable,
+                               get_official_eval_result)
+from second.utils.progress_bar import ProgressBar
+
+HEADS = ["coarse", "refine"]
+# per candidate arrays of a head in the dump and their dtypes.
+CANDIDATE_COLUMNS = {
+    "box3d_lidar": np.float32,
+    "scores": np.float32,
+    "label_preds": np.int32,
+    "dir_labels": np.uint8,
+}
+# per frame arrays of the dump.
+FRAME_COLUMNS = ["image_idx", "image_shape", "rect", "Trv2c", "P2"]
+
+
+def _read_config(config_path):
+    config = pipeline_pb2.TrainEvalPipelineConfig()
+    with open(config_path, "r") as f:
+        text_format.Merge(f.read(), config)
+    return config
+
+
+def _build_net(model_cfg, device):
+    voxel_generator = voxel_builder.build(model_cfg.voxel_generator)
+    bv_range = voxel_generator.point_cloud_range[[0, 1, 3, 4]]
+    box_coder = box_coder_builder.build(model_cfg.box_coder)
+    target_assigner = target_assigner_builder.build(
+        model_cfg.target_assigner, bv_range, box_coder)
+    net = second_builder.build(model_cfg, voxel_generator, target_assigner)
+    net.to(device)
+    net.eval()
+    return net, voxel_generator, target_assigner
+
+
+def _heads(model_cfg):
+    if model_cfg.rpn.module_class_name in ["PSA", "RefineDet"]:
+        return HEADS
+    return HEADS[:1]
+
+
+def dump(config_path,
+         model_dir,
+         ckpt_path=None,
+         dump_path=None,
+         max_candidates=None,
+         min_score=0.0,
+         eval_cache_dir=None,
+         device=None,
+         precision=None):
+    """save the nms candidates of every eval frame.
+    Args:
+        ckpt_path: latest checkpoint of model_dir if None.
+        dump_path: model_dir/eval_results/step_<step>/candidates.npz if
+            None.
+        max_candidates: candidates per frame and head, the largest
+            pre_max_size a sweep can use. nms_pre_max_size if None.
+        min_score: the smallest score threshold a sweep can use.
+    Returns:
+        dump_path
+    """
+    config = _read_config(config_path)
+    input_cfg = config.eval_input_reader
+    model_cfg = config.model.second
+    if model_cfg.use_multi_class_nms:
+        raise ValueError("candidates of multiclass nms can't be dumped")
+    if max_candidates is None:
+        max_candidates = model_cfg.nms_pre_max_size
+    if device is None:
+        device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+    net, voxel_generator, target_assigner = _build_net(model_cfg, device)
+    net.set_precision_policy(
+        PrecisionPolicy.from_config(config.train_config, device, precision))
+    net.set_batched_postprocess(True)
+    net.set_output_format("candidates")
+    net.set_nms_params(score_threshold=min_score,
+                       pre_max_size=max_candidates)
+    if ckpt_path is None:
+        torchplus.train.try_restore_latest_checkpoints(model_dir, [net])
+    else:
+        torchplus.train.restore(ckpt_path, net)
+    if dump_path is None:
+        dump_path = (pathlib.Path(model_dir) / "eval_results" /
+                     f"step_{net.get_global_step()}" / "candidates.npz")
+    dump_path = pathlib.Path(dump_path)
+    dump_path.parent.mkdir(parents=True, exist_ok=True)
+
+    eval_dataset = input_reader_builder.build(
+        input_cfg,
+        model_cfg,
+        training=False,
+        voxel_generator=voxel_generator,
+        target_assigner=target_assigner,
+        cache_dir=eval_cache_dir)
+    eval_dataloader = torch.utils.data.DataLoader(
+        eval_dataset,
+        batch_size=input_cfg.batch_size,
+        shuffle=False,
+        num_workers=input_cfg.num_workers,
+        pin_memory=False,
+        collate_fn=merge_second_batch)
+    heads = _heads(model_cfg)
+    names = list(CANDIDATE_COLUMNS)
+    if not model_cfg.use_direction_classifier:
+        names.remove("dir_labels")
+    frames = {name: [] for name in FRAME_COLUMNS}
+    candidates = {(head, name): [] for head in heads for name in names}
+    print("dump nms candidates...")
+    bar = ProgressBar()
+    bar.start(len(eval_dataloader))
+    with torch.no_grad():
+        for example in iter(eval_dataloader):
+            example = example_convert_to_torch(example, torch.float32,
+                                               device)
+            batch_size = len(example["image_idx"])
+            for name in FRAME_COLUMNS:
+                values = example[name]
+                if isinstance(values, torch.Tensor):
+                    values = values.cpu().numpy()
+                frames[name] += list(values)
+            # evaluate() has no detections for these batches.
+            if len(example["voxels"]) < 4:
+                outputs = [[None] * batch_size for _ in heads]
+            else:
+                outputs = net(example)
+                if len(heads) == 1:
+                    outputs = [outputs]
+            for head, preds_dicts in zip(heads, outputs):
+                for preds_dict in preds_dicts:
+                    for name in names:
+                        dtype = CANDIDATE_COLUMNS[name]
+                        if preds_dict is None:
+                            shape = [0, 7] if name == "box3d_lidar" else [0]
+                            column = np.zeros(shape, dtype=dtype)
+                        else:
+                            column = preds_dict[name].cpu().numpy()
+                        candidates[(head, name)].append(column.astype(dtype))
+            bar.print_bar()
+    print()
+    arrays = {
+        name: np.stack(values)
+        for name, values in frames.items()
+    }
+    for head in heads:
+        counts = [len(c) for c in candidates[(head, "scores")]]
+        arrays[f"{head}/offsets"] = np.concatenate([[0], np.cumsum(counts)])
+        for name in names:
+            arrays[f"{head}/{name}"] = np.concatenate(
+                candidates[(head, name)], axis=0)
+    np.savez(str(dump_path),
+             heads=np.array(heads),
+             max_candidates=max_candidates,
+             min_score=min_score,
+             **arrays)
+    num_candidates = [len(arrays[f"{head}/scores"]) for head in heads]
+    print("{} frames, {} candidates ({}), saved to {}".format(
+        len(arrays["image_idx"]), sum(num_candidates),
+        ", ".join(heads), dump_path))
+    return dump_path
+
+
+def load_dump(dump_path):
+    """the arrays of a dump file.
+    """
+    with np.load(str(dump_path)) as f:
+        return {key: f[key] for key in f.files}
+
+
+def postprocess_dump(net,
+                     arrays,
+                     setting,
+                     class_names,
+                     lidar_input=False,
+                     num_frames=None):
+    """kitti annos of the first num_frames (all if None) frames of a dump.
+    Args:
+        net: VoxelNet of the dump's config, only its postprocessing runs.
+        setting: dict of head, score_threshold, iou_threshold,
+            pre_max_size, post_max_size, center_limit_range and
+            batch_size (frames that go through nms together, like the
+            batches of evaluate()).
+    Returns:
+        dt_annos, seconds: postprocessing time of these frames.
+    """
+    net.set_nms_params(score_threshold=setting["score_threshold"],
+                       iou_threshold=setting["iou_threshold"],
+                       pre_max_size=setting["pre_max_size"],
+                       post_max_size=setting["post_max_size"])
+    head = setting["head"]
+    score_threshold = setting["score_threshold"]
+    pre_max_size = setting["pre_max_size"]
+    batch_size = setting["batch_size"]
+    offsets = arrays[f"{head}/offsets"]
+    if num_frames is None:
+        num_frames = len(arrays["image_idx"])
+    dt_annos = []
+    seconds = 0.0
+    with torch.no_grad():
+        for start in range(0, num_frames, batch_size):
+            frames = range(start, min(start + batch_size, num_frames))
+            t = time.perf_counter()
+            # candidates of a frame are ordered by score, the ones above
+            # score_threshold are a prefix.
+            indices = []
+            for frame in frames:
+                scores = arrays[f"{head}/scores"][offsets[frame]:
+                                                   offsets[frame + 1]]
+                num = min(np.count_nonzero(scores >= score_threshold),
+                          pre_max_size)
+                indices.append(np.arange(offsets[frame],
+                                         offsets[frame] + num))
+            batch_ids = np.repeat(np.arange(len(frames)),
+                                  [len(i) for i in indices])
+            indices = np.concatenate(indices)
+            columns = []
+            for name in CANDIDATE_COLUMNS:
+                column = arrays.get(f"{head}/{name}")
+                if column is not None:
+                    column = torch.from_numpy(column[indices]).to(
+                        torch.float32 if name in ["box3d_lidar", "scores"]
+                        else torch.int64)
+                columns.append(column)
+            batch = {
+                name: torch.from_numpy(arrays[name][start:frames.stop])
+                for name in ["rect", "Trv2c", "P2"]
+            }
+            preds_dicts = net.postprocess_candidates(
+                torch.from_numpy(batch_ids), *columns, batch["rect"],
+                batch["Trv2c"], batch["P2"],
+                arrays["image_idx"][start:frames.stop])
+            dt_annos += comput_kitti_output(
+                preds_dicts, arrays["image_shape"][start:frames.stop],
+                lidar_input, setting["center_limit_range"], class_names,
+                None)
+            seconds += time.perf_counter() - t
+    return dt_annos, seconds
+
+
+# state of a sweep worker process, see _init_worker.
+_worker = {}
+
+
+def _init_worker(config_path, dump_path, nms_backend, num_threads,
+                 warmup_setting):
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    config = _read_config(config_path)
+    input_cfg = config.eval_input_reader
+    model_cfg = config.model.second
+    net, _, _ = _build_net(model_cfg, torch.device("cpu"))
+    net.set_nms_backend(nms_backend)
+    with open(input_cfg.kitti_info_path, "rb") as f:
+        kitti_infos = pickle.load(f)
+    gt_annos = [info["annos"] for info in kitti_infos]
+    arrays = load_dump(dump_path)
+    assert len(arrays["image_idx"]) == len(gt_annos)
+    _worker.update(
+        net=net,
+        arrays=arrays,
+        gt_annos=gt_annos,
+        gt_table=GroundTruthTable(gt_annos),
+        class_names=list(input_cfg.class_names),
+        lidar_input=model_cfg.lidar_input,
+    )
+    # jit compilation of the nms kernels isn't part of the latency.
+    postprocess_dump(net, arrays, warmup_setting, _worker["class_names"],
+                     model_cfg.lidar_input, warmup_setting["batch_size"])
+
+
+def _run_setting(setting):
+    dt_annos, seconds = postprocess_dump(_worker["net"], _worker["arrays"],
+                                         setting, _worker["class_names"],
+                                         _worker["lidar_input"])
+    session = EvalSession(_worker["gt_annos"],
+                          dt_annos,
+                          num_parts=min(len(dt_annos), 50),
+                          gt_table=_worker["gt_table"])
+    _, _, mAPbev, mAP3d, _ = get_official_eval_result(
+        None, None, _worker["class_names"], return_data=True,
+        session=session)
+    return {
+        **setting,
+        "mAPbev": mAPbev[:, :, 0],
+        "mAP3d": mAP3d[:, :, 0],
+        "num_dt": sum(len(a["name"]) for a in dt_annos),
+        "ms": seconds / max(len(dt_annos), 1) * 1000,
+    }
+
+
+def sweep(config_path,
+          dump_path,
+          score_thresholds=None,
+          iou_thresholds=None,
+          pre_max_sizes=None,
+          post_max_sizes=None,
+          center_limit_ranges=None,
+          heads=None,
+          batch_size=None,
+          num_workers=None,
+          nms_backend="auto",
+          md_path=None,
+          csv_path=None):
+    """official bev / 3d APs (first min overlap) and postprocessing
+    latency of every setting of the grid. unset parameters take the
+    model config's value, heads all heads of the dump.
+    Args:
+        center_limit_ranges: list of [xmin, ymin, zmin, xmax, ymax, zmax].
+        batch_size: frames per nms call, eval_input_reader.batch_size if
+            None.
+        num_workers: worker processes, cpu count if None. latencies are
+            measured inside the workers, use 1 for latencies of an
+            otherwise idle host.
+    Returns:
+        list of dicts: setting, "mAPbev", "mAP3d" ([num_class,
+            num_difficulty]), "num_dt" and "ms" (postprocessing per
+            frame), in grid order.
+    """
+    config = _read_config(config_path)
+    input_cfg = config.eval_input_reader
+    model_cfg = config.model.second
+    class_names = list(input_cfg.class_names)
+    with np.load(str(dump_path)) as f:
+        dump_heads = list(f["heads"])
+        max_candidates = int(f["max_candidates"])
+        min_score = float(f["min_score"])
+
+    def values(given, default):
+        if given is None:
+            return [default]
+        if not isinstance(given, (list, tuple)):
+            return [given]
+        return list(given)
+
+    grid = {
+        "head": dump_heads if heads is None else values(heads, None),
+        "score_threshold": values(score_thresholds,
+                                  model_cfg.nms_score_threshold),
+        "iou_threshold": values(iou_thresholds, model_cfg.nms_iou_threshold),
+        "pre_max_size": values(pre_max_sizes, model_cfg.nms_pre_max_size),
+        "post_max_size": values(post_max_sizes,
+                                model_cfg.nms_post_max_size),
+        "center_limit_range": [
+            list(r) for r in values(center_limit_ranges,
+                                    list(model_cfg.post_center_limit_range))
+        ],
+    }
+    for head in grid["head"]:
+        if head not in dump_heads:
+            raise ValueError("{} has no {} candidates".format(
+                dump_path, head))
+    if max(grid["pre_max_size"]) > max_candidates:
+        raise ValueError(
+            "pre_max_size {} > {} candidates per frame of the dump".format(
+                max(grid["pre_max_size"]), max_candidates))
+    if min(grid["score_threshold"]) < min_score:
+        raise ValueError(
+            "score_threshold {} < min_score {} of the dump".format(
+                min(grid["score_threshold"]), min_score))
+    if batch_size is None:
+        batch_size = input_cfg.batch_size
+    settings = [
+        dict(zip(grid.keys(), values), batch_size=batch_size)
+        for values in itertools.product(*grid.values())
+    ]
+    if num_workers is None:
+        num_workers = multiprocessing.cpu_count()
+    num_workers = max(min(num_workers, len(settings)), 1)
+    print("{} settings, {} workers".format(len(settings), num_workers))
+    t = time.perf_counter()
+    if num_workers == 1:
+        _init_worker(config_path, dump_path, nms_backend, None, settings[0])
+        results = [_run_setting(s) for s in settings]
+    else:
+        # one thread per worker, the workers are the parallelism.
+        with multiprocessing.get_context("spawn").Pool(
+                num_workers,
+                initializer=_init_worker,
+                initargs=(config_path, dump_path, nms_backend, 1,
+                          settings[0])) as pool:
+            results = pool.map(_run_setting, settings)
+    print("sweep finished in {:.1f} s".format(time.perf_counter() - t))
+    table = _sweep_table_md(results, class_names)
+    print(table)
+    if md_path is not None:
+        with open(md_path, "w") as f:
+            f.write(table + "\n")
+    if csv_path is not None:
+        _write_sweep_csv(results, class_names, csv_path)
+    return results
+
+
+def _range_str(limit_range):
+    return "[" + ",".join("{:g}".format(v) for v in limit_range) + "]"
+
+
+def _sweep_table_md(results, class_names):
+    def aps(values):
+        return "/".join("{:.2f}".format(v) for v in values)
+
+    columns = [
+        f"{name} {metric} AP"
+        for name in class_names
+        for metric in ["bev", "3d"]
+    ]
+    lines = [
+        "| head | score | iou | pre max | post max | center limit | " +
+        " | ".join(columns) + " | num dt | ms/frame |",
+        "|---|---:|---:|---:|---:|---|" + "---:|" * (len(columns) + 2),
+    ]
+    for r in results:
+        cells = []
+        for j in range(len(class_names)):
+            cells += [aps(r["mAPbev"][j]), aps(r["mAP3d"][j])]
+        lines.append("| {} | {:g} | {:g} | {} | {} | {} | {} | {} | {:.2f} |"
+                     .format(r["head"], r["score_threshold"],
+                             r["iou_threshold"], r["pre_max_size"],
+                             r["post_max_size"],
+                             _range_str(r["center_limit_range"]),
+                             " | ".join(cells), r["num_dt"], r["ms"]))
+    return "\n".join(lines)
+
+
+def _write_sweep_csv(results, class_names, path):
+    """one row per (setting, class), APs easy, moderate, hard.
+    """
+    difficulties = ["easy", "moderate", "hard"]
+    settings = [
+        "head", "score_threshold", "iou_threshold", "pre_max_size",
+        "post_max_size", "center_limit_range"
+    ]
+    with open(path, "w") as f:
+        f.write(",".join(settings + ["class"] + [
+            f"{m}_{d}" for m in ["bev", "3d"] for d in difficulties
+        ] + ["num_dt", "ms"]) + "\n")
+        for r in results:
+            row = [str(r[s]) for s in settings[:-1]]
+            row.append('"' + _range_str(r["center_limit_range"]) + '"')
+            for j, name in enumerate(class_names):
+                values = list(r["mAPbev"][j]) + list(r["mAP3d"][j])
+                f.write(",".join(row + [name] + [
+                    "{:.4f}".format(v) for v in values
+                ] + [str(r["num_dt"]), "{:.4f}".format(r["ms"])]) + "\n")
+
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -0,0 +1,110 @@
+"""inference precision policy based on torch.autocast.
+
+only the network (VFE, scatter, RPN) runs under autocast. parameters
+stay in fp32, so BatchNorm statistics and affine parameters are never
+rounded, and the rpn outputs are cast back to fp32 before box decoding
+and nms (see VoxelNet.network_forward).
+"""
+import contextlib
+
+import numpy as np
+import torch
+
+PRECISIONS = {
+    "fp32": None,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+
+class PrecisionPolicy:
+    def __init__(self, precision="fp32", device_type="cuda"):
+        if precision not in PRECISIONS:
+            raise ValueError("unknown precision {}, available: {}".format(
+                precision, ", ".join(PRECISIONS.keys())))
+        self.precision = precision
+        self.device_type = device_type
+
+    @property
+    def dtype(self):
+        return PRECISIONS[self.precision]
+
+    @property
+    def enabled(self):
+        return self.dtype is not None
+
+    def autocast(self):
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return torch.autocast(self.device_type, dtype=self.dtype)
+
+    @staticmethod
+    def default_precision(device_type, enable_mixed_precision):
+        """legacy enable_mixed_precision maps to fp16 on gpu, bf16 on cpu.
+        """
+        if not enable_mixed_precision:
+            return "fp32"
+        return "fp16" if device_type == "cuda" else "bf16"
+
+    @classmethod
+    def from_config(cls, train_cfg, device, precision=None):
+        device = torch.device(device)
+        if precision is None:
+            precision = cls.default_precision(
+                device.type, train_cfg.enable_mixed_precision)
+        return cls(precision, device.type)
+
+    def __repr__(self):
+        return "PrecisionPolicy({}, {})".format(self.precision,
+                                                self.device_type)
+
+
+def precision_drift(net, examples, policy):
+    """compare every rpn head of net under policy against fp32.
+    Returns:
+        dict: head name -> {"max_abs", "mean_abs", "max_rel"}, worst
+            (max) or mean over examples.
+    """
+    if not policy.enabled:
+        return {}
+    old_policy = net.precision_policy
+    fp32_policy = PrecisionPolicy("fp32", policy.device_type)
+    stats = {}
+    with torch.no_grad():
+        for example in examples:
+            net.set_precision_policy(fp32_policy)
+            ref = net.network_forward(example)
+            net.set_precision_policy(policy)
+            preds = net.network_forward(example)
+            for name, ref_val in ref.items():
+                if not ref_val.is_floating_point():
+                    continue
+                diff = (preds[name].float() - ref_val).abs()
+                scale = ref_val.abs().max().clamp(min=1e-6)
+                head = stats.setdefault(name, {
+                    "max_abs": [],
+                    "mean_abs": [],
+                    "max_rel": []
+                })
+                head["max_abs"].append(diff.max().item())
+                head["mean_abs"].append(diff.mean().item())
+                head["max_rel"].append((diff.max() / scale).item())
+    net.set_precision_policy(old_policy)
+    return {
+        name: {
+            "max_abs": float(np.max(head["max_abs"])),
+            "mean_abs": float(np.mean(head["mean_abs"])),
+            "max_rel": float(np.max(head["max_rel"])),
+        }
+        for name, head in stats.items()
+    }
+
+
+def drift_report_str(drift, precision):
+    lines = ["precision drift of {} vs fp32:".format(precision)]
+    lines.append("{:<20}{:>12}{:>12}{:>12}".format("head", "max_abs",
+                                                   "mean_abs", "max_rel"))
+    for name, head in drift.items():
+        lines.append("{:<20}{:>12.5f}{:>12.5f}{:>12.5f}".format(
+            name, head["max_abs"], head["mean_abs"], head["max_rel"]))
+    return "\n".join(lines)
@@ -0,0 +1,287 @@
+"""per-stage inference profilers for VoxelNet.
+
+stages are timed with cuda events on gpu (no synchronization inside a
+frame, events are resolved in step()) and with perf_counter on cpu.
+step() closes a frame: the time of every stage in that frame is summed
+and added to the stage histogram. when tracing, every stage also opens a
+torch.profiler.record_function range, so torch.profiler traces show the
+stage names.
+
+VoxelNet has no profiler by default, set_profiler attaches one:
+    profiler = StageProfiler(device)
+    net.set_profiler(profiler)
+    for example in ...:
+        net(example)
+        profiler.step()
+    print(profiler.report_str())
+
+MemoryProfiler has the same interface and records the peak memory of
+every stage instead of its latency.
+"""
+import contextlib
+import json
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+
+STAGES = [
+    "vfe", "scatter", "rpn", "rpn_coarse", "rpn_refine", "decode", "nms",
+    "projection"
+]
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def profile_stage(profiler, name):
+    """profiler.stage(name), or a no-op context if profiler is None.
+    """
+    if profiler is None:
+        return _NULL_CONTEXT
+    return profiler.stage(name)
+
+
+class StageProfiler:
+    def __init__(self, device=None, record_functions=False):
+        """
+        Args:
+            device: cuda devices are timed with events.
+            record_functions: open a torch.profiler.record_function per
+                stage, only needed under torch.profiler.
+        """
+        device = torch.device(device or "cpu")
+        self.use_cuda = device.type == "cuda"
+        self.record_functions = record_functions
+        self._origin = time.perf_counter()
+        self._pending = []
+        self.samples = {}
+        self.events = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = contextlib.nullcontext()
+        if self.record_functions:
+            record = torch.autograd.profiler.record_function(name)
+        with record:
+            wall = time.perf_counter() - self._origin
+            if self.use_cuda:
+                start = torch.cuda.Event(enable_timing=True)
+                end = torch.cuda.Event(enable_timing=True)
+                start.record()
+                yield
+                end.record()
+                self._pending.append((name, wall, start, end))
+            else:
+                t = time.perf_counter()
+                yield
+                self._pending.append(
+                    (name, wall, (time.perf_counter() - t) * 1000, None))
+
+    def step(self):
+        """close a frame (or a batch), resolves pending cuda events.
+        """
+        if len(self._pending) == 0:
+            return
+        if self.use_cuda:
+            self._pending[-1][3].synchronize()
+        frame = {}
+        for name, wall, start, end in self._pending:
+            ms = start.elapsed_time(end) if end is not None else start
+            frame[name] = frame.get(name, 0.0) + ms
+            self.events.append((name, wall, ms))
+        for name, ms in frame.items():
+            self.samples.setdefault(name, []).append(ms)
+        self._pending = []
+
+    def reset(self):
+        self._pending = []
+        self.samples = {}
+        self.events = []
+
+    def summary(self):
+        """stage -> {"count", "mean", "p50", "p90", "p99"} in ms.
+        """
+        self.step()
+        names = [n for n in STAGES if n in self.samples]
+        names += sorted(n for n in self.samples if n not in STAGES)
+        summary = {}
+        for name in names:
+            ms = np.array(self.samples[name])
+            p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+            summary[name] = {
+                "count": len(ms),
+                "mean": ms.mean(),
+                "p50": p50,
+                "p90": p90,
+                "p99": p99,
+            }
+        return summary
+
+    def report_str(self):
+        lines = [
+            "{:<12}{:>8}{:>10}{:>10}{:>10}{:>10}".format(
+                "stage", "frames", "mean ms", "p50 ms", "p90 ms", "p99 ms")
+        ]
+        for name, s in self.summary().items():
+            lines.append("{:<12}{:>8}{:>10.3f}{:>10.3f}{:>10.3f}{:>10.3f}".
+                         format(name, s["count"], s["mean"], s["p50"],
+                                s["p90"], s["p99"]))
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        """stage ranges as a chrome://tracing json. starts are host times,
+        durations are device times on gpu.
+        """
+        self.step()
+        trace = [{
+            "name": name,
+            "ph": "X",
+            "ts": wall * 1e6,
+            "dur": ms * 1e3,
+            "pid": 0,
+            "tid": 0,
+        } for name, wall, ms in self.events]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace}, f)
+
+
+def _allocator_peaks(prof, windows):
+    """peak of the tracked torch cpu allocator inside every window.
+    Args:
+        prof: a finished torch.profiler.profile(profile_memory=True).
+        windows: record_function labels.
+    Returns:
+        label -> peak bytes above the allocation at the window start.
+    """
+    try:
+        events = prof.profiler.kineto_results.events()
+    except AttributeError:
+        return {}
+    allocs = sorted((e.start_ns(), e.nbytes()) for e in events
+                    if e.name() == "[memory]")
+    ranges = {
+        e.name(): (e.start_ns(), e.end_ns())
+        for e in events if e.name() in windows
+    }
+    if len(allocs) == 0:
+        return {}
+    times = np.array([t for t, _ in allocs])
+    usage = np.cumsum([n for _, n in allocs])
+    peaks = {}
+    for label, (start, end) in ranges.items():
+        first, last = np.searchsorted(times, [start, end], side="right")
+        base = usage[first - 1] if first > 0 else 0
+        peaks[label] = max(int(usage[first:last].max() - base), 0) if (
+            last > first) else 0
+    return peaks
+
+
+class MemoryProfiler:
+    """peak memory of every stage above the memory allocated when the
+    stage starts, maximum over all frames (bytes).
+
+    cuda: torch.cuda.max_memory_allocated. cpu: the peak of the torch
+    cpu allocator (allocation events of torch.profiler with
+    profile_memory) in peaks and the tracemalloc peak (numpy buffers) in
+    numpy_peaks. the two streams have no common timeline, their peaks
+    can happen at different times and aren't added. arrays allocated
+    inside numba kernels aren't tracked.
+    """
+    def __init__(self, device=None):
+        self.device = torch.device(device or "cpu")
+        self.use_cuda = self.device.type == "cuda"
+        self.peaks = {}
+        self.numpy_peaks = {}
+        # [name, base, running peak] of the open stages, nested stages
+        # reset the peak counters of the outer ones.
+        self._stack = []
+        self._own_tracemalloc = False
+        self._torch_profiler = None
+        # (name, record_function label, tracemalloc peak) of a frame.
+        self._cpu_stages = []
+
+    def _usage(self):
+        if self.use_cuda:
+            torch.cuda.synchronize(self.device)
+            return (torch.cuda.memory_allocated(self.device),
+                    torch.cuda.max_memory_allocated(self.device))
+        return tracemalloc.get_traced_memory()
+
+    def _reset(self):
+        if self.use_cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            tracemalloc.reset_peak()
+
+    def _update_open_stages(self):
+        _, peak = self._usage()
+        for entry in self._stack:
+            entry[2] = max(entry[2], peak - entry[1])
+
+    def _start_cpu_tracking(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._own_tracemalloc = True
+        self._torch_profiler = torch.profiler.profile(
+            activities=[torch.profiler.ProfilerActivity.CPU],
+            profile_memory=True)
+        self._torch_profiler.__enter__()
+
+    def _stop_cpu_tracking(self):
+        self._torch_profiler.__exit__(None, None, None)
+        if self._own_tracemalloc:
+            tracemalloc.stop()
+            self._own_tracemalloc = False
+        allocator_peaks = _allocator_peaks(
+            self._torch_profiler, {label for _, label, _ in self._cpu_stages})
+        for name, label, traced_peak in self._cpu_stages:
+            self.peaks[name] = max(self.peaks.get(name, 0),
+                                   allocator_peaks.get(label, 0))
+            self.numpy_peaks[name] = max(self.numpy_peaks.get(name, 0),
+                                         traced_peak)
+        self._torch_profiler = None
+        self._cpu_stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if len(self._stack) == 0 and not self.use_cuda:
+            self._start_cpu_tracking()
+        self._update_open_stages()
+        self._reset()
+        self._stack.append([name, self._usage()[0], 0])
+        label = "{}#{}".format(name, len(self._cpu_stages))
+        record = contextlib.nullcontext()
+        if not self.use_cuda:
+            record = torch.autograd.profiler.record_function(label)
+        try:
+            with record:
+                yield
+        finally:
+            self._update_open_stages()
+            _, _, peak = self._stack.pop()
+            if self.use_cuda:
+                self.peaks[name] = max(self.peaks.get(name, 0), peak)
+            else:
+                self._cpu_stages.append((name, label, peak))
+                if len(self._stack) == 0:
+                    self._stop_cpu_tracking()
+
+    def step(self):
+        pass
+
+    def reset(self):
+        self.peaks = {}
+        self.numpy_peaks = {}
+
+    def report_str(self):
+        if self.use_cuda:
+            lines = ["{:<16}{:>12}".format("stage", "peak MB")]
+            for name, peak in self.peaks.items():
+                lines.append("{:<16}{:>12.2f}".format(name, peak / 2**20))
+            return "\n".join(lines)
+        lines = ["{:<16}{:>12}{:>12}".format("stage", "torch MB", "numpy MB")]
+        for name, peak in self.peaks.items():
+            lines.append("{:<16}{:>12.2f}{:>12.2f}".format(
+                name, peak / 2**20, self.numpy_peaks[name] / 2**20))
+        return "\n".join(lines)
@@ -0,0 +1,248 @@
+"""post-training int8 quantization of a trained VoxelNet for cpu.
+
+the PFN linear layers of the VFE are quantized in eager mode
+(QuantWrapper), the RPN/PSA conv stack in FX graph mode. both use
+static quantization with per-channel weight observers of the chosen
+engine ("fbgemm" for x86, "qnnpack" for arm). observers are calibrated
+on the first frames of the eval input reader, then fp32 and int8 are
+evaluated on cpu and reported side by side.
+
+usage:
+    python ./pytorch/quantize.py quantize --config_path=... \
+        --ckpt_path=.../voxelnet-xxx.tckpt --num_calib_frames=100 \
+        --output_dir=.../int8
+"""
+import copy
+import time
+from collections import OrderedDict
+
+import fire
+import numpy as np
+import torch
+from google.protobuf import text_format
+from torch.ao import quantization as tq
+from torch.ao.quantization import quantize_fx
+
+import torchplus
+import second.data.kitti_common as kitti
+from second.builder import target_assigner_builder, voxel_builder
+from second.data.preprocess import merge_second_batch
+from second.protos import pipeline_pb2
+from second.pytorch.builder import (box_coder_builder, input_reader_builder,
+                                    second_builder)
+from second.pytorch.export import export_net
+from second.pytorch.models.pointpillars import PFNLayer
+from second.pytorch.train import (example_convert_to_torch, log_metrics,
+                                  predict_kitti_to_anno)
+from second.utils.eval import get_official_eval_result
+from second.utils.progress_bar import ProgressBar
+from metrics import Metric, RangeMetric
+
+
+def to_torch_nn(module):
+    """replace torchplus layers by torch.nn ones, in place:
+    change_default_args layers become their torch.nn base class and
+    torchplus Sequential becomes nn.Sequential. eager convert only swaps
+    exact torch.nn types and fx traces into everything else.
+    """
+    for name, child in module.named_children():
+        to_torch_nn(child)
+        if isinstance(child, torchplus.nn.Sequential):
+            setattr(module, name,
+                    torch.nn.Sequential(OrderedDict(child.named_children())))
+            continue
+        # only __init__ defaults differ, the instance is a valid base.
+        while type(child).__name__ == "DefaultArgLayer":
+            child.__class__ = type(child).__bases__[0]
+    return module
+
+
+def prepare_vfe(vfe, qconfig):
+    """insert observers around every PFN linear of the vfe.
+    """
+    to_torch_nn(vfe)
+    for module in vfe.modules():
+        if isinstance(module, PFNLayer):
+            module.linear = tq.QuantWrapper(module.linear)
+            module.linear.qconfig = qconfig
+    tq.prepare(vfe, inplace=True)
+    return vfe
+
+
+def prepare_rpn(rpn, qconfig_mapping, example_inputs):
+    """fuse conv-bn-relu and insert observers into the rpn graph.
+    """
+    return quantize_fx.prepare_fx(to_torch_nn(rpn), qconfig_mapping,
+                                  example_inputs)
+
+
+def quantize_net(net, calib_examples, engine="fbgemm"):
+    """return an int8 copy of a cpu fp32 net, calibrated by calib_examples.
+    """
+    torch.backends.quantized.engine = engine
+    qnet = copy.deepcopy(net).eval()
+    qconfig_mapping = tq.get_default_qconfig_mapping(engine)
+    prepare_vfe(qnet.voxel_feature_extractor,
+                tq.get_default_qconfig(engine))
+    example = calib_examples[0]
+    with torch.no_grad():
+        voxel_features = qnet.voxel_feature_extractor(
+            example["voxels"], example["num_points"], example["coordinates"])
+        spatial_features = qnet.middle_feature_extractor(
+            voxel_features, example["coordinates"],
+            example["anchors"].shape[0])
+    qnet.rpn = prepare_rpn(qnet.rpn, qconfig_mapping, (spatial_features, ))
+    print("Calibrate on {} frames...".format(len(calib_examples)))
+    with torch.no_grad():
+        for example in calib_examples:
+            qnet(example)
+    tq.convert(qnet.voxel_feature_extractor, inplace=True)
+    qnet.rpn = quantize_fx.convert_fx(qnet.rpn)
+    qnet.clear_time_metrics()
+    return qnet
+
+
+def evaluate_cpu(net, examples, class_names, center_limit_range,
+                 lidar_input, use_coarse_to_fine):
+    """run net over examples on cpu.
+    Returns:
+        dt_annos: final (refine if coarse-to-fine) detections.
+        latency: RangeMetric of per-frame latency in ms.
+    """
+    latency = RangeMetric()
+    dt_annos = []
+    net.clear_time_metrics()
+    with torch.no_grad():
+        for example in examples:
+            if len(example["voxels"]) < 4:
+                # same as evaluate(), psa can't handle almost empty frames.
+                anno = kitti.empty_result_anno()
+                anno["image_idx"] = np.array([], dtype=np.int64)
+                dt_annos.append(anno)
+                continue
+            t = time.perf_counter()
+            annos = predict_kitti_to_anno(
+                net,
+                example,
+                class_names,
+                center_limit_range,
+                lidar_input,
+                use_coarse_to_fine=use_coarse_to_fine)
+            latency.update((time.perf_counter() - t) * 1000)
+            if use_coarse_to_fine:
+                annos = annos[1]
+            dt_annos += annos
+    print()
+    return dt_annos, latency
+
+
+def quantize(config_path,
+             ckpt_path,
+             num_calib_frames=100,
+             num_eval_frames=None,
+             engine="fbgemm",
+             output_dir=None,
+             metrics_file_name=None):
+    """calibrate and evaluate an int8 version of a checkpoint.
+    Args:
+        num_calib_frames: frames of the eval input reader used to
+            calibrate observers.
+        num_eval_frames: frames to evaluate, None for the whole split.
+        engine: quantized engine, "fbgemm" (x86) or "qnnpack" (arm).
+        output_dir: if not None, export the int8 vfe and rpn there as
+            torchscript, loadable by CPUInferenceContext.
+        metrics_file_name: if not None, append the report to this file.
+    """
+    config = pipeline_pb2.TrainEvalPipelineConfig()
+    with open(config_path, "r") as f:
+        proto_str = f.read()
+        text_format.Merge(proto_str, config)
+    input_cfg = config.eval_input_reader
+    model_cfg = config.model.second
+    class_names = list(input_cfg.class_names)
+    center_limit_range = model_cfg.post_center_limit_range
+    use_coarse_to_fine = model_cfg.rpn.module_class_name in [
+        "PSA", "RefineDet"
+    ]
+    device = torch.device("cpu")
+
+    voxel_generator = voxel_builder.build(model_cfg.voxel_generator)
+    bv_range = voxel_generator.point_cloud_range[[0, 1, 3, 4]]
+    box_coder = box_coder_builder.build(model_cfg.box_coder)
+    target_assigner = target_assigner_builder.build(
+        model_cfg.target_assigner, bv_range, box_coder)
+    net = second_builder.build(model_cfg, voxel_generator, target_assigner)
+    torchplus.train.restore(ckpt_path, net)
+    net.cpu().eval()
+
+    eval_dataset = input_reader_builder.build(
+        input_cfg,
+        model_cfg,
+        training=False,
+        voxel_generator=voxel_generator,
+        target_assigner=target_assigner)
+    num_eval = len(eval_dataset)
+    if num_eval_frames is not None:
+        num_eval = min(num_eval, num_eval_frames)
+    num_frames = max(num_eval, min(num_calib_frames, len(eval_dataset)))
+    print("Prepare {} frames...".format(num_frames))
+    examples = []
+    bar = ProgressBar()
+    bar.start(num_frames)
+    for i in range(num_frames):
+        example = merge_second_batch([eval_dataset[i]])
+        examples.append(
+            example_convert_to_torch(example, torch.float32, device=device))
+        bar.print_bar()
+    print()
+    calib_examples = [
+        e for e in examples[:num_calib_frames] if len(e["voxels"]) >= 4
+    ]
+    eval_examples = examples[:num_eval]
+    gt_annos = [
+        info["annos"]
+        for info in eval_dataset.dataset.kitti_infos[:len(eval_examples)]
+    ]
+
+    qnet = quantize_net(net, calib_examples, engine)
+
+    total_metrics = {
+        "Quantization engine": Metric(engine),
+        "Calibration frames": Metric(len(calib_examples)),
+        "Evaluation frames": Metric(len(eval_examples)),
+    }
+    for name, model in [("fp32", net), ("int8", qnet)]:
+        print("Evaluate {}...".format(name))
+        dt_annos, latency = evaluate_cpu(model, eval_examples, class_names,
+                                         center_limit_range,
+                                         model_cfg.lidar_input,
+                                         use_coarse_to_fine)
+        result, _, _, mAP3d, _ = get_official_eval_result(
+            gt_annos, dt_annos, class_names, return_data=True)
+        print(result)
+        total_metrics[name + " latency ms"] = latency
+        total_metrics[name + " forward ms"] = Metric(
+            model.avg_forward_time * 1000)
+        for i, class_name in enumerate(class_names):
+            metric = Metric()
+            metric.update([mAP3d[i, 0, 0], mAP3d[i, 1, 0], mAP3d[i, 2, 0]])
+            total_metrics[name + " " + class_name + " 3D APs"] = metric
+
+    if output_dir is not None:
+        export_net(
+            qnet,
+            model_cfg,
+            voxel_generator,
+            output_dir,
+            backend="torchscript",
+            config_path=str(config_path),
+            ckpt_path=str(ckpt_path),
+            quantization=engine)
+    if metrics_file_name is not None:
+        log_metrics(metrics_file_name, total_metrics)
+    log_metrics("console", total_metrics)
+    return total_metrics
+
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -14,8 +14,15 @@ from tensorboardX import SummaryWriter
 import torchplus
 import second.data.kitti_common as kitti
 from second.builder import target_assigner_builder, voxel_builder
+from second.data.kitti_results import KittiResults, load_detections
 from second.data.preprocess import merge_second_batch
 from second.protos import pipeline_pb2
+from second.pytorch.precision import (
+    PrecisionPolicy,
+    drift_report_str,
+    precision_drift,
+)
+from second.pytorch.profiler import StageProfiler
 from second.pytorch.builder import (
     box_coder_builder,
     input_reader_builder,
@@ -23,7 +30,10 @@ from second.pytorch.builder import (
     optimizer_builder,
     second_builder,
 )
-from second.utils.eval import get_coco_eval_result, get_official_eval_result
+from second.utils.eval import (EvalSession, GroundTruthTable,
+                               StreamingEvaluator, get_coco_eval_result,
+                               get_distance_eval_result,
+                               get_official_eval_result)
 from second.utils.progress_bar import ProgressBar
 from metrics import AverageMetric, Metric, RangeMetric
 from second.core import box_np_ops
@@ -110,8 +120,13 @@ def train(
     summary_step=5,
     pickle_result=True,
     refine_weight=2,
+    eval_cache_dir=None,
 ):
     """train a VoxelNet model specified by a config file.
+    Args:
+        eval_cache_dir: the preprocessed eval split is cached in this
+            directory and read from it at every eval, see
+            data/eval_cache.py.
     """
     if create_folder:
         if pathlib.Path(model_dir).exists():
@@ -203,6 +218,7 @@ def train(
         training=False,
         voxel_generator=voxel_generator,
         target_assigner=target_assigner,
+        cache_dir=eval_cache_dir,
     )
 
     def _worker_init_fn(worker_id):
@@ -227,6 +243,10 @@ def train(
         pin_memory=False,
         collate_fn=merge_second_batch,
     )
+    # the gt side of the eval is the same at every eval step.
+    eval_gt_table = GroundTruthTable.from_infos(
+        eval_dataset.dataset.kitti_infos
+    )
     data_iter = iter(dataloader)
 
     ######################
@@ -493,6 +513,7 @@ def train(
                 f"generate label finished({sec_per_ex:.2f}/s). start eval:",
                 file=logf,
             )
+            eval_start = time.time()
             gt_annos = [
                 info["annos"] for info in eval_dataset.dataset.kitti_infos
             ]
@@ -512,33 +533,37 @@ def train(
                     mAP3d,
                     mAPaos,
                 ) = get_official_eval_result(
-                    gt_annos, dt_annos_coarse, class_names, return_data=True
+                    gt_annos,
+                    dt_annos_coarse,
+                    class_names,
+                    return_data=True,
+                    session=EvalSession(
+                        gt_annos, dt_annos_coarse, gt_table=eval_gt_table
+                    ),
                 )
                 print(result, file=logf)
                 print(result)
                 writer.add_text("eval_result", result, global_step)
 
                 print("After Refine:")
-                (
-                    result,
-                    mAPbbox,
-                    mAPbev,
-                    mAP3d,
-                    mAPaos,
-                ) = get_official_eval_result(
-                    gt_annos, dt_annos_refine, class_names, return_data=True
-                )
                 dt_annos = dt_annos_refine
-            else:
-                (
-                    result,
-                    mAPbbox,
-                    mAPbev,
-                    mAP3d,
-                    mAPaos,
-                ) = get_official_eval_result(
-                    gt_annos, dt_annos, class_names, return_data=True
-                )
+            # the coco eval reuses the overlaps of the official one.
+            eval_session = EvalSession(
+                gt_annos, dt_annos, gt_table=eval_gt_table
+            )
+            (
+                result,
+                mAPbbox,
+                mAPbev,
+                mAP3d,
+                mAPaos,
+            ) = get_official_eval_result(
+                gt_annos,
+                dt_annos,
+                class_names,
+                return_data=True,
+                session=eval_session,
+            )
             print(result, file=logf)
             print(result)
             writer.add_text("eval_result", result, global_step)
@@ -565,9 +590,14 @@ def train(
                 "aos_map", np.mean(mAPaos[:, 1, 0]), global_step
             )
 
-            result = get_coco_eval_result(gt_annos, dt_annos, class_names)
+            result = get_coco_eval_result(
+                gt_annos, dt_annos, class_names, session=eval_session
+            )
             print(result, file=logf)
             print(result)
+            eval_time = time.time() - eval_start
+            print(f"eval finished({eval_time:.2f}s)")
+            print(f"eval finished({eval_time:.2f}s)", file=logf)
             if pickle_result:
                 with open(result_path_step / "result.pkl", "wb") as f:
                     pickle.dump(dt_annos, f)
@@ -586,6 +616,102 @@ def train(
     logf.close()
 
 
+def kitti_anno_arrays(
+    preds_dict, image_shape, lidar_input, center_limit_range, class_names
+):
+    """kitti anno of one sample from its prediction dict, boxes outside
+    the image or with a center outside center_limit_range are dropped.
+    Returns:
+        anno without image_idx, None if no box is left.
+    """
+    if preds_dict["bbox"] is None:
+        return None
+    box_2d_preds = preds_dict["bbox"].detach().cpu().numpy()
+    box_preds = preds_dict["box3d_camera"].detach().cpu().numpy()
+    scores = preds_dict["scores"].detach().cpu().numpy()
+    box_preds_lidar = preds_dict["box3d_lidar"].detach().cpu().numpy()
+    label_preds = preds_dict["label_preds"].detach().cpu().numpy()
+    mask = np.ones([box_preds.shape[0]], dtype=np.bool_)
+    if not lidar_input:
+        mask &= (box_2d_preds[:, 0] <= image_shape[1]) & (
+            box_2d_preds[:, 1] <= image_shape[0]
+        )
+        mask &= (box_2d_preds[:, 2] >= 0) & (box_2d_preds[:, 3] >= 0)
+    if center_limit_range is not None:
+        limit_range = np.array(center_limit_range)
+        centers = box_preds_lidar[:, :3]
+        mask &= np.all(centers >= limit_range[:3], axis=1) & np.all(
+            centers <= limit_range[3:], axis=1
+        )
+    if not mask.any():
+        return None
+    bbox = box_2d_preds[mask]
+    bbox[:, 2:] = np.minimum(bbox[:, 2:], image_shape[::-1])
+    bbox[:, :2] = np.maximum(bbox[:, :2], [0, 0])
+    box = box_preds[mask]
+    box_lidar = box_preds_lidar[mask]
+    num_example = box.shape[0]
+    names = np.array(class_names, dtype=object)[label_preds[mask]]
+    return {
+        "name": names.astype(str),
+        "truncated": np.zeros([num_example], dtype=np.float64),
+        "occluded": np.zeros([num_example], dtype=np.int64),
+        "alpha": -np.arctan2(-box_lidar[:, 1], box_lidar[:, 0]) + box[:, 6],
+        "bbox": bbox,
+        "dimensions": box[:, 3:6],
+        "location": box[:, :3],
+        "rotation_y": box[:, 6],
+        "score": scores[mask],
+    }
+
+
+def kitti_result_lines(anno):
+    """kitti label file lines of a kitti_anno_arrays anno, formatted like
+    kitti.kitti_result_line (truncated and occluded left at -1).
+    """
+    line_format = "{} -1 -1 " + " ".join(["{:.4f}"] * 13)
+    # lhw->hwl(label file format)
+    values = np.concatenate(
+        [
+            anno["alpha"][:, np.newaxis],
+            anno["bbox"],
+            anno["dimensions"][:, [1, 2, 0]],
+            anno["location"],
+            anno["rotation_y"][:, np.newaxis],
+            anno["score"][:, np.newaxis],
+        ],
+        axis=1,
+    )
+    return [
+        line_format.format(name, *row)
+        for name, row in zip(anno["name"], values.tolist())
+    ]
+
+
+def unique_scores(scores, global_set, step=1 / 100000):
+    """make scores unique across all frames sharing global_set. in box
+    order, a score already in global_set moves down by step until it is
+    new. only the scores of this frame are looked up, the result keeps
+    the dtype of scores.
+    """
+    values = scores.tolist()
+    if len(set(values)) == len(values) and not any(
+            value in global_set for value in values):
+        global_set.update(values)
+        return scores
+    dtype = scores.dtype.type
+    step = dtype(step)
+    scores = scores.copy()
+    for i, value in enumerate(values):
+        score = dtype(value)
+        # one step per collision.
+        while score in global_set:
+            score = score - step
+        global_set.add(score)
+        scores[i] = score
+    return scores
+
+
 def comput_kitti_output(
     predictions_dicts,
     batch_image_shape,
@@ -596,70 +722,98 @@ def comput_kitti_output(
 ):
     annos = []
     for i, preds_dict in enumerate(predictions_dicts):
-        image_shape = batch_image_shape[i]
-        img_idx = preds_dict["image_idx"]
-        if preds_dict["bbox"] is not None:
-            box_2d_preds = preds_dict["bbox"].detach().cpu().numpy()
-            box_preds = preds_dict["box3d_camera"].detach().cpu().numpy()
-            scores = preds_dict["scores"].detach().cpu().numpy()
-            box_preds_lidar = preds_dict["box3d_lidar"].detach().cpu().numpy()
-            # write pred to file
-            label_preds = preds_dict["label_preds"].detach().cpu().numpy()
-            # label_preds = np.zeros([box_2d_preds.shape[0]], dtype=np.int32)
-            anno = kitti.get_start_result_anno()
-            num_example = 0
-            for box, box_lidar, bbox, score, label in zip(
-                box_preds, box_preds_lidar, box_2d_preds, scores, label_preds
-            ):
-                if not lidar_input:
-                    if bbox[0] > image_shape[1] or bbox[1] > image_shape[0]:
-                        continue
-                    if bbox[2] < 0 or bbox[3] < 0:
-                        continue
-                # print(img_shape)
-                if center_limit_range is not None:
-                    limit_range = np.array(center_limit_range)
-                    if np.any(box_lidar[:3] < limit_range[:3]) or np.any(
-                        box_lidar[:3] > limit_range[3:]
-                    ):
-                        continue
-                bbox[2:] = np.minimum(bbox[2:], image_shape[::-1])
-                bbox[:2] = np.maximum(bbox[:2], [0, 0])
-                anno["name"].append(class_names[int(label)])
-                anno["truncated"].append(0.0)
-                anno["occluded"].append(0)
-                anno["alpha"].append(
-                    -np.arctan2(-box_lidar[1], box_lidar[0]) + box[6]
-                )
-                anno["bbox"].append(bbox)
-                anno["dimensions"].append(box[3:6])
-                anno["location"].append(box[:3])
-                anno["rotation_y"].append(box[6])
-                if global_set is not None:
-                    for i in range(100000):
-                        if score in global_set:
-                            score -= 1 / 100000
-                        else:
-                            global_set.add(score)
-                            break
-                anno["score"].append(score)
-
-                num_example += 1
-            if num_example != 0:
-                anno = {n: np.stack(v) for n, v in anno.items()}
-                annos.append(anno)
-            else:
-                annos.append(kitti.empty_result_anno())
-        else:
-            annos.append(kitti.empty_result_anno())
-        num_example = annos[-1]["name"].shape[0]
-        annos[-1]["image_idx"] = np.array(
-            [img_idx] * num_example, dtype=np.int64
+        anno = kitti_anno_arrays(
+            preds_dict,
+            batch_image_shape[i],
+            lidar_input,
+            center_limit_range,
+            class_names,
         )
+        if anno is None:
+            anno = kitti.empty_result_anno()
+        elif global_set is not None:
+            anno["score"] = unique_scores(anno["score"], global_set)
+        num_example = anno["name"].shape[0]
+        anno["image_idx"] = np.array(
+            [preds_dict["image_idx"]] * num_example, dtype=np.int64
+        )
+        annos.append(anno)
 
     return annos
 
 
+def _timestamp(example):
+    """perf_counter once the queued cuda work of the example's device
+    is done, so fps covers the whole forward pass.
+    """
+    device = example["anchors"].device
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return time.perf_counter()
+
+
+# one row per detection of output_format="lidar" predictions.
+LIDAR_DETECTION_DTYPE = np.dtype([
+    ("image_idx", np.int64),
+    ("box3d_lidar", np.float32, (7,)),
+    ("score", np.float32),
+    ("label", np.int32),
+])
+
+
+def comput_lidar_output(predictions_dicts, center_limit_range=None):
+    """lidar box detections as LIDAR_DETECTION_DTYPE arrays, one per
+    sample. boxes with a center outside center_limit_range are dropped.
+    """
+    outputs = []
+    for preds_dict in predictions_dicts:
+        if preds_dict["box3d_lidar"] is None:
+            outputs.append(np.zeros([0], dtype=LIDAR_DETECTION_DTYPE))
+            continue
+        box_preds_lidar = preds_dict["box3d_lidar"].detach().cpu().numpy()
+        scores = preds_dict["scores"].detach().cpu().numpy()
+        label_preds = preds_dict["label_preds"].detach().cpu().numpy()
+        if center_limit_range is not None:
+            limit_range = np.array(center_limit_range)
+            centers = box_preds_lidar[:, :3]
+            mask = np.all((centers >= limit_range[:3])
+                          & (centers <= limit_range[3:]), axis=1)
+            box_preds_lidar = box_preds_lidar[mask]
+            scores = scores[mask]
+            label_preds = label_preds[mask]
+        dets = np.zeros([len(scores)], dtype=LIDAR_DETECTION_DTYPE)
+        dets["image_idx"] = preds_dict["image_idx"]
+        dets["box3d_lidar"] = box_preds_lidar
+        dets["score"] = scores
+        dets["label"] = label_preds
+        outputs.append(dets)
+    return outputs
+
+
+def predict_lidar_detections(
+    net,
+    example,
+    center_limit_range=None,
+    use_coarse_to_fine=True,
+    fps_metric=None,
+):
+    """net must use output_format="lidar". coarse-to-fine models return
+    the refined detections only.
+    """
+    tt = _timestamp(example)
+    if use_coarse_to_fine:
+        _, predictions_dicts = net(example)
+    else:
+        predictions_dicts = net(example)
+    tt = _timestamp(example) - tt
+    fps = 1.0 / tt
+
+    print("fps:", fps, end="\t")
+    if fps_metric is not None:
+        fps_metric.update(fps)
+    return comput_lidar_output(predictions_dicts, center_limit_range)
+
+
 def predict_kitti_to_anno(
     net,
     example,
@@ -675,11 +829,11 @@ def predict_kitti_to_anno(
 
     if use_coarse_to_fine:
 
-        tt = time.perf_counter()
+        tt = _timestamp(example)
 
         predictions_dicts_coarse, predictions_dicts_refine = net(example)
 
-        tt = time.perf_counter() - tt
+        tt = _timestamp(example) - tt
         fps = 1.0 / tt
 
         print("fps:", fps, end="\t")
@@ -706,11 +860,11 @@ def predict_kitti_to_anno(
         return annos_coarse, annos_refine
     else:
 
-        tt = time.perf_counter()
+        tt = _timestamp(example)
 
         predictions_dicts_coarse = net(example)
 
-        tt = time.perf_counter() - tt
+        tt = _timestamp(example) - tt
         fps = 1.0 / tt
 
         print("fps:", fps, end="\t")
@@ -746,53 +900,18 @@ def _predict_kitti_to_file(
         predictions_dicts = predictions_dicts_refine
     else:
         predictions_dicts = net(example)
-    # t = time.time()
     for i, preds_dict in enumerate(predictions_dicts):
-        image_shape = batch_image_shape[i]
         img_idx = preds_dict["image_idx"]
-        if preds_dict["bbox"] is not None:
-            box_2d_preds = preds_dict["bbox"].data.cpu().numpy()
-            box_preds = preds_dict["box3d_camera"].data.cpu().numpy()
-            scores = preds_dict["scores"].data.cpu().numpy()
-            box_preds_lidar = preds_dict["box3d_lidar"].data.cpu().numpy()
-            # write pred to file
-            box_preds = box_preds[
-                :, [0, 1, 2, 4, 5, 3, 6]
-            ]  # lhw->hwl(label file format)
-            label_preds = preds_dict["label_preds"].data.cpu().numpy()
-            # label_preds = np.zeros([box_2d_preds.shape[0]], dtype=np.int32)
-            result_lines = []
-            for box, box_lidar, bbox, score, label in zip(
-                box_preds, box_preds_lidar, box_2d_preds, scores, label_preds
-            ):
-                if not lidar_input:
-                    if bbox[0] > image_shape[1] or bbox[1] > image_shape[0]:
-                        continue
-                    if bbox[2] < 0 or bbox[3] < 0:
-                        continue
-                # print(img_shape)
-                if center_limit_range is not None:
-                    limit_range = np.array(center_limit_range)
-                    if np.any(box_lidar[:3] < limit_range[:3]) or np.any(
-                        box_lidar[:3] > limit_range[3:]
-                    ):
-                        continue
-                bbox[2:] = np.minimum(bbox[2:], image_shape[::-1])
-                bbox[:2] = np.maximum(bbox[:2], [0, 0])
-                result_dict = {
-                    "name": class_names[int(label)],
-                    "alpha": -np.arctan2(-box_lidar[1], box_lidar[0])
-                    + box[6],
-                    "bbox": bbox,
-                    "location": box[:3],
-                    "dimensions": box[3:6],
-                    "rotation_y": box[6],
-                    "score": score,
-                }
-                result_line = kitti.kitti_result_line(result_dict)
-                result_lines.append(result_line)
-        else:
-            result_lines = []
+        anno = kitti_anno_arrays(
+            preds_dict,
+            batch_image_shape[i],
+            lidar_input,
+            center_limit_range,
+            class_names,
+        )
+        result_lines = []
+        if anno is not None:
+            result_lines = kitti_result_lines(anno)
         result_file = (
             f"{result_save_path}/{kitti.get_image_index_str(img_idx)}.txt"
         )
@@ -807,11 +926,28 @@ def evaluate(
     result_path=None,
     predict_test=False,
     ckpt_path=None,
-    ref_detfile=None,
+    ref_detfile=None,  # result.npz, result.pkl or label dir: eval it, no net
     pickle_result=True,
+    save_npz=False,  # write result.npz, see data/kitti_results.py
     evaluation_mode="1/2",  # 1/2: take all ground truth boxes, 1/1: take only gt boxes inside voxel range
     metrics_file_name="eval-metrics.txt",
     gt_limit_range=None, # remove ground truth objects outside of this range
+    device=None,
+    precision=None,  # fp32, fp16 or bf16, None: from enable_mixed_precision
+    drift_frames=0,  # frames used for the precision drift report
+    occupancy_crop=False,  # run the rpn on occupied pillars' bbox only
+    occupancy_crop_margin=None,  # None: the rpn receptive field (exact)
+    nms_backend="auto",  # auto, torch, legacy (cuda kernels) or cpu
+    batched_postprocess=True,  # postprocess the whole batch at once
+    decode_after_select=True,  # decode only the nms candidates
+    output_format="kitti",  # kitti or lidar (lidar boxes only, no kitti metrics)
+    profile=False,  # per-stage latency histograms, see pytorch/profiler.py
+    profile_trace_path=None,  # chrome trace of the profiled stages
+    torch_profile_path=None,  # torch.profiler chrome trace
+    torch_profile_frames=20,  # batches recorded by torch.profiler
+    distance_bins=None,  # e.g. [0,20,35,50]: AP per distance bin as well
+    distance="x",  # x or bev, see eval.box_distances
+    eval_cache_dir=None,  # preprocessed eval split cache, see data/eval_cache.py
 ):
     model_dir = pathlib.Path(model_dir)
     if predict_test:
@@ -849,12 +985,52 @@ def evaluate(
         target_assigner_cfg, bv_range, box_coder
     )
 
+    if device is None:
+        device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
     net = second_builder.build(model_cfg, voxel_generator, target_assigner)
-    net.cuda()
-    if train_cfg.enable_mixed_precision:
-        net.half()
-        net.metrics_to_float()
-        net.convert_norm_to_float(net)
+    net.to(device)
+    precision_policy = PrecisionPolicy.from_config(
+        train_cfg, device, precision
+    )
+    net.set_precision_policy(precision_policy)
+    print("precision policy:", precision_policy)
+    net.set_occupancy_crop(occupancy_crop, occupancy_crop_margin)
+    net.set_nms_backend(nms_backend)
+    net.set_batched_postprocess(batched_postprocess)
+    net.set_decode_after_select(decode_after_select)
+    net.set_output_format(output_format)
+    profiler = None
+    torch_profiler = None
+    if (
+        profile
+        or profile_trace_path is not None
+        or torch_profile_path is not None
+    ):
+        profiler = StageProfiler(
+            device, record_functions=torch_profile_path is not None
+        )
+        net.set_profiler(profiler)
+    if torch_profile_path is not None:
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if device.type == "cuda":
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        torch_profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(
+                wait=0, warmup=1, active=torch_profile_frames, repeat=1
+            ),
+            on_trace_ready=lambda p: p.export_chrome_trace(
+                str(torch_profile_path)
+            ),
+        )
+        torch_profiler.start()
+
+    def after_batch():
+        if profiler is not None:
+            profiler.step()
+        if torch_profiler is not None:
+            torch_profiler.step()
 
     if ckpt_path is None:
         torchplus.train.try_restore_latest_checkpoints(model_dir, [net])
@@ -867,6 +1043,7 @@ def evaluate(
         training=False,
         voxel_generator=voxel_generator,
         target_assigner=target_assigner,
+        cache_dir=eval_cache_dir,
     )
     eval_dataloader = torch.utils.data.DataLoader(
         eval_dataset,
@@ -877,22 +1054,35 @@ def evaluate(
         collate_fn=merge_second_batch,
     )
 
-    if train_cfg.enable_mixed_precision:
-        float_dtype = torch.float16
-    else:
-        float_dtype = torch.float32
+    # inputs stay fp32, the precision policy autocasts the network.
+    float_dtype = torch.float32
 
     net.eval()
     result_path_step = result_path / f"step_{net.get_global_step()}"
     result_path_step.mkdir(parents=True, exist_ok=True)
+
+    total_metrics = {}
+
+    if drift_frames > 0 and precision_policy.enabled:
+        drift_examples = [
+            example_convert_to_torch(
+                merge_second_batch([eval_dataset[i]]), float_dtype, device
+            )
+            for i in range(min(drift_frames, len(eval_dataset)))
+        ]
+        drift_examples = [e for e in drift_examples if len(e["voxels"]) >= 4]
+        drift = precision_drift(net, drift_examples, precision_policy)
+        print(drift_report_str(drift, precision_policy.precision))
+        for head, head_drift in drift.items():
+            for stat, value in head_drift.items():
+                total_metrics[f"Drift {head} {stat}"] = Metric(value)
+
     t = time.time()
 
     fps_metric = AverageMetric()
     total_time = 0
     total_count = 0
 
-    total_metrics = {}
-
     empty_coarse = [
         {
             "name": np.array([], dtype=np.float64),
@@ -1000,6 +1190,97 @@ def evaluate(
         total_metrics["Objects in range"] = Metric(in_range_count)
         total_metrics["Objects not in range"] = Metric(not_in_range_count)
 
+    if output_format == "lidar":
+        return _evaluate_lidar(
+            net,
+            eval_dataloader,
+            center_limit_range,
+            model_cfg.rpn.module_class_name in ["PSA", "RefineDet"],
+            device,
+            result_path_step,
+            model_dir / metrics_file_name,
+            total_metrics,
+            after_batch,
+            lambda: _finish_profiling(
+                profiler, torch_profiler, profile_trace_path
+            ),
+        )
+
+    # pickled results are evaluated frame by frame while inference runs,
+    # the annos of the split aren't kept.
+    coarse_evaluator = None
+    evaluator = None
+    if pickle_result and not predict_test:
+        coarse_evaluator = StreamingEvaluator(class_names)
+        evaluator = StreamingEvaluator(class_names)
+
+    kitti_infos = eval_dataset.dataset.kitti_infos
+
+    def collect(annos, dt_annos, evaluator):
+        if evaluator is None or save_npz:
+            dt_annos += annos
+        if evaluator is not None:
+            for anno in annos:
+                i = evaluator.num_frames
+                evaluator.update(gt_annos[i], anno, kitti_infos[i])
+
+    def official_result(dt_annos, evaluator, prefix=""):
+        if evaluator is not None:
+            session = evaluator.session
+        else:
+            session = EvalSession(
+                gt_annos,
+                dt_annos,
+                gt_table=GroundTruthTable(gt_annos, kitti_infos),
+            )
+        result, *aps = get_official_eval_result(
+            None, None, class_names, return_data=True, session=session
+        )
+        if distance_bins is not None:
+            distance_result, ap_by_bin = get_distance_eval_result(
+                None,
+                None,
+                class_names,
+                distance_bins,
+                distance,
+                return_data=True,
+                session=session,
+            )
+            result += distance_result
+            for name, (_, _, mAP3d, _, _) in ap_by_bin.items():
+                if name == "all":
+                    continue
+                for i, class_name in enumerate(class_names):
+                    metric = Metric()
+                    metric.update(
+                        [mAP3d[i, 0, 0], mAP3d[i, 1, 0], mAP3d[i, 2, 0]]
+                    )
+                    total_metrics[
+                        f"{prefix}{class_name} 3D APs {name}"
+                    ] = metric
+        return (result, *aps)
+
+    if ref_detfile is not None:
+        dt_annos = load_detections(
+            ref_detfile, [info["image_idx"] for info in kitti_infos]
+        )
+        assert len(dt_annos) == len(gt_annos)
+        result, mAPbbox, mAPbev, mAP3d, mAPaos = official_result(
+            dt_annos, None
+        )
+        print(result)
+        for i, class_name in enumerate(class_names):
+            metric = Metric()
+            metric.update([mAP3d[i, 0, 0], mAP3d[i, 1, 0], mAP3d[i, 2, 0]])
+            total_metrics[class_name + " 3D APs"] = metric
+        total_metrics = {
+            "Evaluation Mode": Metric(evaluation_mode),
+            **total_metrics,
+        }
+        log_metrics(model_dir / metrics_file_name, total_metrics)
+        log_metrics("console", total_metrics)
+        return
+
     if (
         model_cfg.rpn.module_class_name == "PSA"
         or model_cfg.rpn.module_class_name == "RefineDet"
@@ -1010,12 +1291,12 @@ def evaluate(
         bar = ProgressBar()
         bar.start(len(eval_dataset) // input_cfg.batch_size + 1)
         for example in iter(eval_dataloader):
-            example = example_convert_to_torch(example, float_dtype)
+            example = example_convert_to_torch(example, float_dtype, device)
 
             if len(example["voxels"]) < 4:
                 print("#", end="\n")
-                dt_annos_coarse += empty_coarse
-                dt_annos_refine += empty_refine
+                collect(empty_coarse, dt_annos_coarse, coarse_evaluator)
+                collect(empty_refine, dt_annos_refine, evaluator)
                 continue
 
             tt = time.perf_counter()
@@ -1031,8 +1312,6 @@ def evaluate(
                     global_set=None,
                     fps_metric=fps_metric,
                 )
-                dt_annos_coarse += coarse
-                dt_annos_refine += refine
             else:
                 _predict_kitti_to_file(
                     net,
@@ -1048,6 +1327,11 @@ def evaluate(
             tt = time.perf_counter() - tt
             total_time += tt
             total_count += 1
+            if pickle_result:
+                # not part of the inference time.
+                collect(coarse, dt_annos_coarse, coarse_evaluator)
+                collect(refine, dt_annos_refine, evaluator)
+            after_batch()
             bar.print_bar()
 
         total_detected_coarse = sum(
@@ -1056,6 +1340,9 @@ def evaluate(
         total_detected_refine = sum(
             [len(a["alpha"]) for a in dt_annos_refine]
         )
+        if evaluator is not None:
+            total_detected_coarse = coarse_evaluator.num_dt
+            total_detected_refine = evaluator.num_dt
 
         print()
         print(" || total_detected_coarse:", total_detected_coarse)
@@ -1067,12 +1354,12 @@ def evaluate(
         bar = ProgressBar()
         bar.start(len(eval_dataset) // input_cfg.batch_size + 1)
         for example in iter(eval_dataloader):
-            example = example_convert_to_torch(example, float_dtype)
+            example = example_convert_to_torch(example, float_dtype, device)
 
             tt = time.perf_counter()
 
             if pickle_result:
-                dt_annos += predict_kitti_to_anno(
+                annos = predict_kitti_to_anno(
                     net,
                     example,
                     class_names,
@@ -1097,6 +1384,9 @@ def evaluate(
             tt = time.perf_counter() - tt
             total_time += tt
             total_count += 1
+            if pickle_result:
+                collect(annos, dt_annos, evaluator)
+            after_batch()
             bar.print_bar()
 
     sec_per_example = len(eval_dataset) / (time.time() - t)
@@ -1110,6 +1400,22 @@ def evaluate(
 
     print(f"avg forward time per example: {net.avg_forward_time:.3f}")
     print(f"avg postprocess time per example: {net.avg_postprocess_time:.3f}")
+    total_metrics.update(
+        _finish_profiling(profiler, torch_profiler, profile_trace_path)
+    )
+    if save_npz and pickle_result:
+        image_ids = [info["image_idx"] for info in kitti_infos]
+        if (
+            model_cfg.rpn.module_class_name == "PSA"
+            or model_cfg.rpn.module_class_name == "RefineDet"
+        ):
+            KittiResults.from_annos(dt_annos_coarse, image_ids).save(
+                result_path_step / "result_coarse.npz"
+            )
+            dt_annos = dt_annos_refine
+        KittiResults.from_annos(dt_annos, image_ids).save(
+            result_path_step / "result.npz"
+        )
     if not predict_test:
         # gt_annos = [
         #     info["annos"] for info in eval_dataset.dataset.kitti_infos
@@ -1133,9 +1439,7 @@ def evaluate(
                 mAPbev_coarse,
                 mAP3d_coarse,
                 mAPaos_coarse,
-            ) = get_official_eval_result(
-                gt_annos, dt_annos_coarse, class_names, return_data=True,
-            )
+            ) = official_result(dt_annos_coarse, coarse_evaluator, "Coarse ")
             print(result_coarse)
 
             print("After Refine:")
@@ -1145,9 +1449,7 @@ def evaluate(
                 mAPbev_refine,
                 mAP3d_refine,
                 mAPaos_refine,
-            ) = get_official_eval_result(
-                gt_annos, dt_annos_refine, class_names, return_data=True,
-            )
+            ) = official_result(dt_annos_refine, evaluator, "Refine ")
             print(result_refine)
             # result = get_coco_eval_result(
             #     gt_annos, dt_annos_refine, class_names
@@ -1201,8 +1503,8 @@ def evaluate(
             )
 
         else:
-            result, mAPbbox, mAPbev, mAP3d, mAPaos = get_official_eval_result(
-                gt_annos, dt_annos, class_names, return_data=True
+            result, mAPbbox, mAPbev, mAP3d, mAPaos = official_result(
+                dt_annos, evaluator
             )
             print(result)
 
@@ -1237,6 +1539,290 @@ def evaluate(
         #         pickle.dump(dt_annos, f)
 
 
+def _evaluate_lidar(
+    net,
+    eval_dataloader,
+    center_limit_range,
+    use_coarse_to_fine,
+    device,
+    result_path_step,
+    metrics_path,
+    total_metrics,
+    after_batch,
+    finish_profiling,
+):
+    """evaluate() with output_format="lidar": detections are written to
+    result_lidar.pkl, only latency metrics are logged.
+    """
+    fps_metric = AverageMetric()
+    dt_dets = []
+    print("Generate lidar detections...")
+    bar = ProgressBar()
+    bar.start(len(eval_dataloader))
+    for example in iter(eval_dataloader):
+        example = example_convert_to_torch(example, torch.float32, device)
+        if len(example["voxels"]) < 4:
+            print("#", end="\n")
+            dt_dets += [
+                np.zeros([0], dtype=LIDAR_DETECTION_DTYPE)
+                for _ in example["image_idx"]
+            ]
+            continue
+        dt_dets += predict_lidar_detections(
+            net,
+            example,
+            center_limit_range,
+            use_coarse_to_fine=use_coarse_to_fine,
+            fps_metric=fps_metric,
+        )
+        after_batch()
+        bar.print_bar()
+    print()
+    print(" || total_detected:", sum([len(d) for d in dt_dets]))
+    print(f"avg forward time per example: {net.avg_forward_time:.3f}")
+    print(f"avg postprocess time per example: {net.avg_postprocess_time:.3f}")
+    total_metrics.update(finish_profiling())
+    with open(result_path_step / "result_lidar.pkl", "wb") as f:
+        pickle.dump(dt_dets, f)
+    total_metrics = {
+        "FPS": fps_metric,
+        "Output Format": Metric("lidar"),
+        "Detections": Metric(sum([len(d) for d in dt_dets])),
+        **total_metrics,
+    }
+    log_metrics(metrics_path, total_metrics)
+    log_metrics("console", total_metrics)
+    return dt_dets
+
+
+def eval_checkpoint_paths(model_dir, model_name="voxelnet"):
+    """checkpoints of model_name in model_dir/eval_checkpoints (saved at
+    every eval of train()), ordered by step.
+    """
+    ckpt_dir = pathlib.Path(model_dir) / "eval_checkpoints"
+    paths = [
+        p for p in ckpt_dir.glob(f"{model_name}-*.tckpt")
+        if p.stem.split("-")[-1].isdigit()
+    ]
+    return sorted(
+        (str(p) for p in paths), key=lambda p: _checkpoint_step(p)
+    )
+
+
+def _checkpoint_step(ckpt_path):
+    return int(pathlib.Path(ckpt_path).stem.split("-")[-1])
+
+
+def evaluate_many(
+    config_path,
+    model_dir,
+    ckpt_paths=None,  # default: eval_checkpoint_paths(model_dir)
+    eval_cache_dir=None,  # preprocessed eval split cache, see data/eval_cache.py
+    device=None,
+    precision=None,  # fp32, fp16 or bf16, None: from enable_mixed_precision
+    md_path=None,
+    csv_path=None,
+):
+    """evaluate K checkpoints of a config in one pass over the eval split.
+
+    every eval batch is loaded once and runs through all checkpoints in
+    turn, their weights are swapped in with load_state_dict. each
+    checkpoint has its own StreamingEvaluator. a table of the official
+    bev / 3d APs (first min overlap) and the latency of every checkpoint
+    is printed and written to md_path / csv_path.
+    Returns:
+        dict: checkpoint index in ckpt_paths -> {"ckpt_path", "step",
+            "mAPbev", "mAP3d", "ms"}, step is the global step stored in
+            the checkpoint, APs are [num_class, num_difficulty], ms per
+            frame (net and kitti output).
+    """
+    if ckpt_paths is None:
+        ckpt_paths = eval_checkpoint_paths(model_dir)
+    if isinstance(ckpt_paths, str):
+        ckpt_paths = [ckpt_paths]
+    if len(ckpt_paths) == 0:
+        raise ValueError("no checkpoints to evaluate in {}".format(model_dir))
+    config = pipeline_pb2.TrainEvalPipelineConfig()
+    with open(config_path, "r") as f:
+        text_format.Merge(f.read(), config)
+    input_cfg = config.eval_input_reader
+    model_cfg = config.model.second
+    class_names = list(input_cfg.class_names)
+    center_limit_range = model_cfg.post_center_limit_range
+    use_coarse_to_fine = model_cfg.rpn.module_class_name in [
+        "PSA",
+        "RefineDet",
+    ]
+    voxel_generator = voxel_builder.build(model_cfg.voxel_generator)
+    bv_range = voxel_generator.point_cloud_range[[0, 1, 3, 4]]
+    box_coder = box_coder_builder.build(model_cfg.box_coder)
+    target_assigner = target_assigner_builder.build(
+        model_cfg.target_assigner, bv_range, box_coder
+    )
+    if device is None:
+        device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    device = torch.device(device)
+    net = second_builder.build(model_cfg, voxel_generator, target_assigner)
+    net.to(device)
+    net.set_precision_policy(
+        PrecisionPolicy.from_config(config.train_config, device, precision)
+    )
+    net.eval()
+    # weights stay on the host, only the running checkpoint's are on device.
+    state_dicts = [torch.load(p, map_location="cpu") for p in ckpt_paths]
+    steps = []
+    for state_dict in state_dicts:
+        net.load_state_dict(state_dict)
+        steps.append(net.get_global_step())
+
+    eval_dataset = input_reader_builder.build(
+        input_cfg,
+        model_cfg,
+        training=False,
+        voxel_generator=voxel_generator,
+        target_assigner=target_assigner,
+        cache_dir=eval_cache_dir,
+    )
+    eval_dataloader = torch.utils.data.DataLoader(
+        eval_dataset,
+        batch_size=input_cfg.batch_size,
+        shuffle=False,
+        num_workers=input_cfg.num_workers,
+        pin_memory=False,
+        collate_fn=merge_second_batch,
+    )
+    kitti_infos = eval_dataset.dataset.kitti_infos
+    evaluators = [StreamingEvaluator(class_names) for _ in ckpt_paths]
+    total_times = [0.0] * len(ckpt_paths)
+    num_frames = 0
+    print(f"evaluate {len(ckpt_paths)} checkpoints...")
+    bar = ProgressBar()
+    bar.start(len(eval_dataloader))
+    with torch.no_grad():
+        for example in iter(eval_dataloader):
+            example = example_convert_to_torch(example, torch.float32, device)
+            batch_size = len(example["image_idx"])
+            for k, state_dict in enumerate(state_dicts):
+                if len(example["voxels"]) < 4:
+                    annos = [
+                        kitti.empty_result_anno() for _ in range(batch_size)
+                    ]
+                else:
+                    net.load_state_dict(state_dict)
+                    tt = _timestamp(example)
+                    annos = predict_kitti_to_anno(
+                        net,
+                        example,
+                        class_names,
+                        center_limit_range,
+                        model_cfg.lidar_input,
+                        use_coarse_to_fine=use_coarse_to_fine,
+                    )
+                    total_times[k] += _timestamp(example) - tt
+                    if use_coarse_to_fine:
+                        annos = annos[1]
+                for i, anno in enumerate(annos):
+                    frame = num_frames + i
+                    evaluators[k].update(
+                        kitti_infos[frame]["annos"], anno, kitti_infos[frame]
+                    )
+            num_frames += batch_size
+            bar.print_bar()
+    print()
+    results = {}
+    for k, evaluator in enumerate(evaluators):
+        _, _, mAPbev, mAP3d, _ = evaluator.finalize(return_data=True)
+        results[k] = {
+            "ckpt_path": str(ckpt_paths[k]),
+            "step": steps[k],
+            "mAPbev": mAPbev[:, :, 0],
+            "mAP3d": mAP3d[:, :, 0],
+            "ms": total_times[k] / max(num_frames, 1) * 1000,
+        }
+    table = _checkpoint_table_md(results, class_names)
+    print(table)
+    if md_path is not None:
+        with open(md_path, "w") as f:
+            f.write(table + "\n")
+    if csv_path is not None:
+        _write_checkpoint_csv(results, class_names, csv_path)
+    return results
+
+
+def _checkpoint_table_md(results, class_names):
+    def aps(values):
+        return "/".join("{:.2f}".format(v) for v in values)
+
+    columns = [
+        f"{name} {metric} AP"
+        for name in class_names
+        for metric in ["bev", "3d"]
+    ]
+    lines = [
+        "| checkpoint | step | " + " | ".join(columns) + " | ms/frame |",
+        "|---|---:|" + "---:|" * (len(columns) + 1),
+    ]
+    for r in results.values():
+        cells = []
+        for j in range(len(class_names)):
+            cells += [aps(r["mAPbev"][j]), aps(r["mAP3d"][j])]
+        lines.append(
+            "| {} | {} | {} | {:.2f} |".format(
+                pathlib.Path(r["ckpt_path"]).name,
+                r["step"],
+                " | ".join(cells),
+                r["ms"],
+            )
+        )
+    return "\n".join(lines)
+
+
+def _write_checkpoint_csv(results, class_names, path):
+    """one row per (checkpoint, class), APs easy, moderate, hard.
+    """
+    difficulties = ["easy", "moderate", "hard"]
+    with open(path, "w") as f:
+        f.write(
+            ",".join(
+                ["step", "class"]
+                + [f"{m}_{d}" for m in ["bev", "3d"] for d in difficulties]
+                + ["ms", "ckpt_path"]
+            )
+            + "\n"
+        )
+        for r in results.values():
+            for j, name in enumerate(class_names):
+                values = list(r["mAPbev"][j]) + list(r["mAP3d"][j])
+                f.write(
+                    ",".join(
+                        [str(r["step"]), name]
+                        + ["{:.4f}".format(v) for v in values]
+                        + ["{:.4f}".format(r["ms"]), r["ckpt_path"]]
+                    )
+                    + "\n"
+                )
+
+
+def _finish_profiling(profiler, torch_profiler, profile_trace_path):
+    """stop profiling, print the stage table and export traces.
+    Returns:
+        metrics: "Stage <name> p50/p90/p99 ms" per profiled stage.
+    """
+    if torch_profiler is not None:
+        torch_profiler.stop()
+    if profiler is None:
+        return {}
+    print(profiler.report_str())
+    if profile_trace_path is not None:
+        profiler.export_chrome_trace(str(profile_trace_path))
+    return {
+        f"Stage {name} p50/p90/p99 ms": Metric(
+            [round(float(s[p]), 3) for p in ["p50", "p90", "p99"]]
+        )
+        for name, s in profiler.summary().items()
+    }
+
+
 def log_metrics(path: str, metrics):
     for name, metric in metrics.items():
         metric.log(path, name + " | ")
@@ -1,4 +1,5 @@
 import torch
+from torch import nn
 
 
 def get_paddings_indicator(actual_num, max_num, axis=0):
@@ -23,3 +24,57 @@ def get_paddings_indicator(actual_num, max_num, axis=0):
     paddings_indicator = actual_num.int() > max_num
     # paddings_indicator shape: [batch_size, max_num]
     return paddings_indicator
+
+
+def _pair_first(value):
+    if isinstance(value, (tuple, list)):
+        return value[0]
+    return value
+
+
+def receptive_field(module, field=(1, 0, 0)):
+    """dependence of the output cells of module (its children applied in
+    order) on the input canvas, along one (square) axis.
+
+    Args:
+        module: a layer or a Sequential of ZeroPad2d, Conv2d,
+            ConvTranspose2d, MaxPool2d and pointwise layers.
+        field: (spacing, lo, hi) of the input: cell i depends on the
+            canvas pixels [spacing * i + lo, spacing * i + hi].
+
+    Returns:
+        (spacing, lo, hi) of the output.
+    """
+    spacing, lo, hi = field
+    layers = list(module.children()) or [module]
+    pad = 0
+    for layer in layers:
+        if isinstance(layer, nn.ZeroPad2d):
+            pad += _pair_first(layer.padding)
+            continue
+        if isinstance(layer, (nn.Conv2d, nn.MaxPool2d)):
+            kernel = _pair_first(layer.kernel_size)
+            stride = _pair_first(layer.stride)
+            padding = _pair_first(layer.padding) + pad
+            dilation = _pair_first(layer.dilation)
+            lo -= spacing * padding
+            hi += spacing * (dilation * (kernel - 1) - padding)
+            spacing *= stride
+        elif isinstance(layer, nn.ConvTranspose2d):
+            kernel = _pair_first(layer.kernel_size)
+            stride = _pair_first(layer.stride)
+            padding = _pair_first(layer.padding)
+            assert spacing % stride == 0
+            spacing //= stride
+            lo += spacing * (padding - kernel + 1)
+            hi += spacing * padding
+        pad = 0
+    return spacing, lo, hi
+
+
+def union_fields(*fields):
+    """receptive field of a concatenation / sum of same spacing maps.
+    """
+    assert len(set(f[0] for f in fields)) == 1
+    return (fields[0][0], min(f[1] for f in fields),
+            max(f[2] for f in fields))
@@ -86,7 +86,7 @@ def load_pb11(sources,
     cmds = []
     outs = []
     main_sources = []
-    if arch is None:
+    if arch is None and cuda:
         arch = find_cuda_device_arch()
 
     for s in sources:
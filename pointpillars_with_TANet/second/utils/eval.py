@@ -3,8 +3,15 @@ import time
 
 import numba
 import numpy as np
+from numba import cuda
 
-from second.core.non_max_suppression.nms_gpu import rotate_iou_gpu_eval
+from second.core.non_max_suppression.nms_parallel import rotate_iou_cpu
+from second.data.kitti_results import KittiResults
+
+IOU_BACKENDS = ["auto", "gpu", "cpu"]
+DISTANCES = ["x", "bev"]
+# lower edges of the distance bins in meters, the last one is open.
+DISTANCE_BINS = [0, 20, 35, 50]
 
 
 def get_mAP(prec):
@@ -36,11 +43,15 @@ def get_thresholds(scores: np.ndarray, num_gt, num_sample_pts=41):
     return thresholds
 
 
+CLASS_NAMES = ['car', 'pedestrian', 'cyclist', 'van', 'person_sitting', 'car', 'tractor', 'trailer']
+MIN_HEIGHT = [40, 25, 25]
+MAX_OCCLUSION = [0, 1, 2]
+MAX_TRUNCATION = [0.15, 0.3, 0.5]
+
+
 def clean_data(gt_anno, dt_anno, current_class, difficulty):
-    CLASS_NAMES = ['car', 'pedestrian', 'cyclist', 'van', 'person_sitting', 'car', 'tractor', 'trailer']
-    MIN_HEIGHT = [40, 25, 25]
-    MAX_OCCLUSION = [0, 1, 2]
-    MAX_TRUNCATION = [0.15, 0.3, 0.5]
+    """per frame reference of GroundTruthTable and DetectionTable.
+    """
     dc_bboxes, ignored_gt, ignored_dt = [], [], []
     current_cls_name = CLASS_NAMES[current_class].lower()
     num_gt = len(gt_anno["name"])
@@ -92,6 +103,210 @@ def clean_data(gt_anno, dt_anno, current_class, difficulty):
     return num_valid_gt, ignored_gt, ignored_dt, dc_bboxes
 
 
+class GroundTruthTable:
+    """columnar gt annos of an eval split.
+
+    the gt side of clean_data (ignored gts of every class and difficulty,
+    valid gt counts, dontcare boxes) doesn't depend on the detections, it
+    is built once and reused by every eval of the split.
+    """
+
+    def __init__(self, gt_annos, kitti_infos=None):
+        """
+        Args:
+            kitti_infos: infos of the frames of gt_annos, their calibs give
+                the lidar frame locations of the boxes (distance binned
+                evals, see EvalSession.distance_bin).
+        """
+        self.num_frames = len(gt_annos)
+        self.num_gt = np.array([len(a["name"]) for a in gt_annos],
+                               dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.num_gt)])
+        names = _concat_names(gt_annos)
+        bbox = np.concatenate([a["bbox"] for a in gt_annos], 0)
+        alpha = np.concatenate([a["alpha"] for a in gt_annos], 0)
+        occluded = np.concatenate([a["occluded"] for a in gt_annos], 0)
+        truncated = np.concatenate([a["truncated"] for a in gt_annos], 0)
+        self.gt_datas = np.concatenate([bbox, alpha[..., np.newaxis]], 1)
+        # integer-encoded lower case names.
+        name_vocab, name_codes = np.unique(np.char.lower(names),
+                                           return_inverse=True)
+        dontcare = names == "DontCare"
+        frame_idx = np.repeat(np.arange(self.num_frames), self.num_gt)
+        self.num_dc = np.bincount(frame_idx[dontcare],
+                                  minlength=self.num_frames).astype(np.int64)
+        self.dc_offsets = np.concatenate([[0], np.cumsum(self.num_dc)])
+        self.dontcares = bbox[dontcare].reshape(-1, 4).astype(np.float64)
+        height = bbox[:, 3] - bbox[:, 1]
+        # [num_difficulty, num_gt]
+        ignore = ((occluded > np.array(MAX_OCCLUSION)[:, np.newaxis])
+                  | (truncated > np.array(MAX_TRUNCATION)[:, np.newaxis])
+                  | (height <= np.array(MIN_HEIGHT)[:, np.newaxis]))
+        # [num_class, num_difficulty, num_gt]
+        self.ignored_gts = np.zeros(
+            [len(CLASS_NAMES), len(MIN_HEIGHT),
+             len(names)], dtype=np.int64)
+        for c, cls_name in enumerate(CLASS_NAMES):
+            valid_class = np.full(len(names), -1)
+            valid_class[_name_mask(name_vocab, name_codes, cls_name)] = 1
+            if cls_name == "pedestrian":
+                valid_class[_name_mask(name_vocab, name_codes,
+                                       "person_sitting")] = 0
+            elif cls_name == "car":
+                valid_class[_name_mask(name_vocab, name_codes, "van")] = 0
+            valid = valid_class == 1
+            self.ignored_gts[c] = np.where(
+                valid & ~ignore, 0,
+                np.where((valid_class == 0) | (ignore & valid), 1, -1))
+        self.num_valid_gt = (self.ignored_gts == 0).sum(-1)
+        self.lidar_transforms = None
+        self.lidar_locations = None
+        if kitti_infos is not None:
+            assert len(kitti_infos) == self.num_frames
+            self.lidar_transforms = lidar_transforms(kitti_infos)
+            self.lidar_locations = camera_to_lidar_frames(
+                _concat_locations(gt_annos), self.num_gt,
+                self.lidar_transforms)
+
+    @classmethod
+    def from_infos(cls, kitti_infos):
+        return cls([info["annos"] for info in kitti_infos], kitti_infos)
+
+    @classmethod
+    def concatenate(cls, tables):
+        """the table of the frames of all tables, in order.
+        """
+        table = cls.__new__(cls)
+        table.num_frames = sum(t.num_frames for t in tables)
+        table.num_gt = np.concatenate([t.num_gt for t in tables])
+        table.offsets = np.concatenate([[0], np.cumsum(table.num_gt)])
+        table.gt_datas = np.concatenate([t.gt_datas for t in tables], 0)
+        table.num_dc = np.concatenate([t.num_dc for t in tables])
+        table.dc_offsets = np.concatenate([[0], np.cumsum(table.num_dc)])
+        table.dontcares = np.concatenate([t.dontcares for t in tables], 0)
+        table.ignored_gts = np.concatenate([t.ignored_gts for t in tables],
+                                           -1)
+        table.num_valid_gt = sum(t.num_valid_gt for t in tables)
+        table.lidar_transforms = None
+        table.lidar_locations = None
+        if all(t.lidar_transforms is not None for t in tables):
+            table.lidar_transforms = np.concatenate(
+                [t.lidar_transforms for t in tables], 0)
+            table.lidar_locations = np.concatenate(
+                [t.lidar_locations for t in tables], 0)
+        return table
+
+
+class DetectionTable:
+    """columnar dt annos, the dt side of clean_data for one eval.
+    """
+
+    def __init__(self, dt_annos):
+        self.num_dt = _num_boxes(dt_annos)
+        self.offsets = np.concatenate([[0], np.cumsum(self.num_dt)])
+        bbox = _concat_field(dt_annos, "bbox")
+        self.dt_datas = np.concatenate([
+            bbox,
+            _concat_field(dt_annos, "alpha")[..., np.newaxis],
+            _concat_field(dt_annos, "score")[..., np.newaxis],
+        ], 1)
+        self.names = np.char.lower(_concat_names(dt_annos))
+        self.height = np.abs(bbox[:, 3] - bbox[:, 1])
+        self.locations = _concat_locations(dt_annos)
+
+    @classmethod
+    def concatenate(cls, tables):
+        table = cls.__new__(cls)
+        table.num_dt = np.concatenate([t.num_dt for t in tables])
+        table.offsets = np.concatenate([[0], np.cumsum(table.num_dt)])
+        table.dt_datas = np.concatenate([t.dt_datas for t in tables], 0)
+        table.names = np.concatenate([t.names for t in tables])
+        table.height = np.concatenate([t.height for t in tables])
+        table.locations = np.concatenate([t.locations for t in tables], 0)
+        return table
+
+    @property
+    def compute_aos(self):
+        """alpha is valid, checked on the first detection.
+        """
+        return bool(len(self.dt_datas) > 0 and self.dt_datas[0, 4] != -10)
+
+    def ignored_dets(self, current_class, difficulty):
+        valid = self.names == CLASS_NAMES[current_class]
+        return np.where(self.height < MIN_HEIGHT[difficulty], 1,
+                        np.where(valid, 0, -1)).astype(np.int64)
+
+
+def _num_boxes(annos):
+    if isinstance(annos, KittiResults):
+        return annos.num_dt
+    return np.array([len(a["name"]) for a in annos], dtype=np.int64)
+
+
+def _concat_field(annos, key):
+    """a field of all annos, the column of a KittiResults.
+    """
+    if isinstance(annos, KittiResults):
+        return annos.column(key)
+    return np.concatenate([a[key] for a in annos], 0)
+
+
+def _concat_names(annos):
+    if isinstance(annos, KittiResults):
+        return annos.column("name")
+    return np.concatenate([np.asarray(a["name"]).astype(str) for a in annos],
+                          0)
+
+
+def _concat_locations(annos):
+    if isinstance(annos, KittiResults):
+        return annos.column("location").astype(np.float64)
+    return np.concatenate(
+        [np.asarray(a["location"]).reshape(-1, 3) for a in annos],
+        0).astype(np.float64)
+
+
+def lidar_transforms(kitti_infos):
+    """camera (rect) to lidar transforms of the frames, [num_frames, 4, 4].
+    """
+    rect = np.stack([info["calib/R0_rect"] for info in kitti_infos])
+    Trv2c = np.stack([info["calib/Tr_velo_to_cam"] for info in kitti_infos])
+    return np.linalg.inv(rect.astype(np.float64) @ Trv2c.astype(np.float64))
+
+
+def camera_to_lidar_frames(locations, num_boxes, transforms):
+    """box_np_ops.camera_to_lidar of the boxes of all frames at once.
+    Args:
+        locations: [N, 3] camera locations, num_boxes[i] of frame i.
+        transforms: lidar_transforms of the frames.
+    """
+    frame_idx = np.repeat(np.arange(len(num_boxes)), num_boxes)
+    points = np.concatenate([locations, np.ones([len(locations), 1])], 1)
+    return np.einsum("nij,nj->ni", transforms[frame_idx], points)[:, :3]
+
+
+def box_distances(lidar_locations, distance="x"):
+    """
+    Args:
+        distance: "x": forward distance (lidar x, the axis the near/far
+            point cloud ranges split), "bev": bird's eye view distance to
+            the lidar.
+    """
+    if distance == "x":
+        return lidar_locations[:, 0]
+    if distance == "bev":
+        return np.linalg.norm(lidar_locations[:, :2], axis=1)
+    raise ValueError("unknown distance {}, available: {}".format(
+        distance, ", ".join(DISTANCES)))
+
+
+def _name_mask(name_vocab, name_codes, name):
+    code = np.searchsorted(name_vocab, name)
+    if code == len(name_vocab) or name_vocab[code] != name:
+        return np.zeros(len(name_codes), dtype=bool)
+    return name_codes == code
+
+
 @numba.jit(nopython=True)
 def image_box_overlap(boxes, query_boxes, criterion=-1):
     N = boxes.shape[0]
@@ -122,8 +337,28 @@ def image_box_overlap(boxes, query_boxes, criterion=-1):
     return overlaps
 
 
-def bev_box_overlap(boxes, qboxes, criterion=-1):
-    riou = rotate_iou_gpu_eval(boxes, qboxes, criterion)
+def rotate_iou_eval(boxes, qboxes, criterion=-1, backend="auto"):
+    """rotated overlaps of the eval.
+    Args:
+        backend: "gpu" for the numba.cuda kernel, "cpu" for the numba
+            parallel port of it (same float32 polygon clipping), "auto"
+            picks gpu if a cuda device is available.
+    """
+    if backend == "auto":
+        backend = "gpu" if cuda.is_available() else "cpu"
+    if backend == "gpu":
+        # imported here, the module builds the cuda nms extension.
+        from second.core.non_max_suppression.nms_gpu import (
+            rotate_iou_gpu_eval)
+        return rotate_iou_gpu_eval(boxes, qboxes, criterion)
+    if backend == "cpu":
+        return rotate_iou_cpu(boxes, qboxes, criterion)
+    raise ValueError("unknown iou backend {}, available: {}".format(
+        backend, ", ".join(IOU_BACKENDS)))
+
+
+def bev_box_overlap(boxes, qboxes, criterion=-1, backend="auto"):
+    riou = rotate_iou_eval(boxes, qboxes, criterion, backend)
     return riou
 
 
@@ -131,7 +366,7 @@ def bev_box_overlap(boxes, qboxes, criterion=-1):
 def d3_box_overlap_kernel(boxes, qboxes, rinc, criterion=-1):
     # ONLY support overlap in CAMERA, not lider.
     N, K = boxes.shape[0], qboxes.shape[0]
-    for i in range(N):
+    for i in numba.prange(N):
         for j in range(K):
             if rinc[i, j] > 0:
                 iw = (min(boxes[i, 1], qboxes[j, 1]) - max(
@@ -154,9 +389,9 @@ def d3_box_overlap_kernel(boxes, qboxes, rinc, criterion=-1):
                     rinc[i, j] = 0.0
 
 
-def d3_box_overlap(boxes, qboxes, criterion=-1):
-    rinc = rotate_iou_gpu_eval(boxes[:, [0, 2, 3, 5, 6]],
-                               qboxes[:, [0, 2, 3, 5, 6]], 2)
+def d3_box_overlap(boxes, qboxes, criterion=-1, backend="auto"):
+    rinc = rotate_iou_eval(boxes[:, [0, 2, 3, 5, 6]],
+                           qboxes[:, [0, 2, 3, 5, 6]], 2, backend)
     d3_box_overlap_kernel(boxes, qboxes, rinc, criterion)
     return rinc
 
@@ -292,7 +527,73 @@ def get_split_parts(num, num_part):
         return [same_part] * num_part + [remain_num]
 
 
-@numba.jit(nopython=True)
+def flatten_overlaps(overlaps):
+    """the [dt, gt] overlaps of every example (see calculate_iou_partly),
+    raveled and concatenated, the layout of the fused kernels.
+    """
+    return np.concatenate([np.zeros((0, ))] +
+                          [o.ravel() for o in overlaps]).astype(np.float64)
+
+
+@numba.jit(nopython=True, parallel=True)
+def fused_compute_thresholds(overlaps,
+                             gt_nums,
+                             dt_nums,
+                             dc_nums,
+                             gt_datas,
+                             dt_datas,
+                             dontcares,
+                             ignored_gts,
+                             ignored_dets,
+                             metric,
+                             min_overlap):
+    """scores of the true positives of every example (the
+    compute_fp=False pass of compute_statistics_jit), examples run in
+    parallel, the scores keep the example order.
+    Args:
+        overlaps: flatten_overlaps of the examples.
+    """
+    num_examples = gt_nums.shape[0]
+    gt_offsets = np.zeros(num_examples + 1, dtype=np.int64)
+    dt_offsets = np.zeros(num_examples + 1, dtype=np.int64)
+    dc_offsets = np.zeros(num_examples + 1, dtype=np.int64)
+    overlap_offsets = np.zeros(num_examples + 1, dtype=np.int64)
+    for i in range(num_examples):
+        gt_offsets[i + 1] = gt_offsets[i] + gt_nums[i]
+        dt_offsets[i + 1] = dt_offsets[i] + dt_nums[i]
+        dc_offsets[i + 1] = dc_offsets[i] + dc_nums[i]
+        overlap_offsets[i + 1] = overlap_offsets[i] + dt_nums[i] * gt_nums[i]
+    # at most one true positive per gt.
+    scores = np.zeros((gt_offsets[-1], ))
+    num_scores = np.zeros((num_examples, ), dtype=np.int64)
+    for i in numba.prange(num_examples):
+        gt_start, gt_end = gt_offsets[i], gt_offsets[i + 1]
+        dt_start, dt_end = dt_offsets[i], dt_offsets[i + 1]
+        overlap = overlaps[overlap_offsets[i]:overlap_offsets[i + 1]].reshape(
+            (dt_nums[i], gt_nums[i]))
+        tp, fp, fn, similarity, thresholds = compute_statistics_jit(
+            overlap,
+            gt_datas[gt_start:gt_end],
+            dt_datas[dt_start:dt_end],
+            ignored_gts[gt_start:gt_end],
+            ignored_dets[dt_start:dt_end],
+            dontcares[dc_offsets[i]:dc_offsets[i + 1]],
+            metric,
+            min_overlap=min_overlap,
+            thresh=0.0,
+            compute_fp=False)
+        scores[gt_start:gt_start + thresholds.shape[0]] = thresholds
+        num_scores[i] = thresholds.shape[0]
+    ret = np.zeros((num_scores.sum(), ))
+    idx = 0
+    for i in range(num_examples):
+        ret[idx:idx + num_scores[i]] = scores[gt_offsets[i]:gt_offsets[i] +
+                                              num_scores[i]]
+        idx += num_scores[i]
+    return ret
+
+
+@numba.jit(nopython=True, parallel=True)
 def fused_compute_statistics(overlaps,
                              pr,
                              gt_nums,
@@ -307,13 +608,22 @@ def fused_compute_statistics(overlaps,
                              min_overlap,
                              thresholds,
                              compute_aos=False):
-    gt_num = 0
-    dt_num = 0
-    dc_num = 0
-    for i in range(gt_nums.shape[0]):
-        for t, thresh in enumerate(thresholds):
-            overlap = overlaps[dt_num:dt_num + dt_nums[i], gt_num:
-                               gt_num + gt_nums[i]]
+    """
+    Args:
+        overlaps: flatten_overlaps of the examples.
+    """
+    # every threshold accumulates its own row of pr, in example order, so
+    # the thresholds run in parallel with the sequential sums.
+    for t in numba.prange(thresholds.shape[0]):
+        thresh = thresholds[t]
+        gt_num = 0
+        dt_num = 0
+        dc_num = 0
+        overlap_num = 0
+        for i in range(gt_nums.shape[0]):
+            overlap_size = dt_nums[i] * gt_nums[i]
+            overlap = overlaps[overlap_num:overlap_num +
+                               overlap_size].reshape((dt_nums[i], gt_nums[i]))
 
             gt_data = gt_datas[gt_num:gt_num + gt_nums[i]]
             dt_data = dt_datas[dt_num:dt_num + dt_nums[i]]
@@ -337,23 +647,31 @@ def fused_compute_statistics(overlaps,
             pr[t, 2] += fn
             if similarity != -1:
                 pr[t, 3] += similarity
-        gt_num += gt_nums[i]
-        dt_num += dt_nums[i]
-        dc_num += dc_nums[i]
+            gt_num += gt_nums[i]
+            dt_num += dt_nums[i]
+            dc_num += dc_nums[i]
+            overlap_num += overlap_size
 
 
-def calculate_iou_partly(gt_annos, dt_annos, metric, num_parts=50):
+def calculate_iou_partly(gt_annos,
+                         dt_annos,
+                         metric,
+                         num_parts=50,
+                         iou_backend="auto"):
     """fast iou algorithm. this function can be used independently to
     do result analysis. Must be used in CAMERA coordinate system.
     Args:
         gt_annos: dict, must from get_label_annos() in kitti_common.py
-        dt_annos: dict, must from get_label_annos() in kitti_common.py
+        dt_annos: dict, must from get_label_annos() in kitti_common.py,
+            or a KittiResults (either side).
         metric: eval type. 0: bbox, 1: bev, 2: 3d
         num_parts: int. a parameter for fast calculate algorithm
+        iou_backend: rotated iou backend of bev and 3d, see
+            rotate_iou_eval.
     """
     assert len(gt_annos) == len(dt_annos)
-    total_dt_num = np.stack([len(a["name"]) for a in dt_annos], 0)
-    total_gt_num = np.stack([len(a["name"]) for a in gt_annos], 0)
+    total_dt_num = _num_boxes(dt_annos)
+    total_gt_num = _num_boxes(gt_annos)
     num_examples = len(gt_annos)
     split_parts = get_split_parts(num_examples, num_parts)
     parted_overlaps = []
@@ -363,39 +681,35 @@ def calculate_iou_partly(gt_annos, dt_annos, metric, num_parts=50):
         gt_annos_part = gt_annos[example_idx:example_idx + num_part]
         dt_annos_part = dt_annos[example_idx:example_idx + num_part]
         if metric == 0:
-            gt_boxes = np.concatenate([a["bbox"] for a in gt_annos_part], 0)
-            dt_boxes = np.concatenate([a["bbox"] for a in dt_annos_part], 0)
+            gt_boxes = _concat_field(gt_annos_part, "bbox")
+            dt_boxes = _concat_field(dt_annos_part, "bbox")
             overlap_part = image_box_overlap(gt_boxes, dt_boxes)
         elif metric == 1:
-            loc = np.concatenate(
-                [a["location"][:, [0, 2]] for a in gt_annos_part], 0)
-            dims = np.concatenate(
-                [a["dimensions"][:, [0, 2]] for a in gt_annos_part], 0)
-            rots = np.concatenate([a["rotation_y"] for a in gt_annos_part], 0)
+            loc = _concat_field(gt_annos_part, "location")[:, [0, 2]]
+            dims = _concat_field(gt_annos_part, "dimensions")[:, [0, 2]]
+            rots = _concat_field(gt_annos_part, "rotation_y")
             gt_boxes = np.concatenate(
                 [loc, dims, rots[..., np.newaxis]], axis=1)
-            loc = np.concatenate(
-                [a["location"][:, [0, 2]] for a in dt_annos_part], 0)
-            dims = np.concatenate(
-                [a["dimensions"][:, [0, 2]] for a in dt_annos_part], 0)
-            rots = np.concatenate([a["rotation_y"] for a in dt_annos_part], 0)
+            loc = _concat_field(dt_annos_part, "location")[:, [0, 2]]
+            dims = _concat_field(dt_annos_part, "dimensions")[:, [0, 2]]
+            rots = _concat_field(dt_annos_part, "rotation_y")
             dt_boxes = np.concatenate(
                 [loc, dims, rots[..., np.newaxis]], axis=1)
-            overlap_part = bev_box_overlap(gt_boxes, dt_boxes).astype(
-                np.float64)
+            overlap_part = bev_box_overlap(
+                gt_boxes, dt_boxes, backend=iou_backend).astype(np.float64)
         elif metric == 2:
-            loc = np.concatenate([a["location"] for a in gt_annos_part], 0)
-            dims = np.concatenate([a["dimensions"] for a in gt_annos_part], 0)
-            rots = np.concatenate([a["rotation_y"] for a in gt_annos_part], 0)
+            loc = _concat_field(gt_annos_part, "location")
+            dims = _concat_field(gt_annos_part, "dimensions")
+            rots = _concat_field(gt_annos_part, "rotation_y")
             gt_boxes = np.concatenate(
                 [loc, dims, rots[..., np.newaxis]], axis=1)
-            loc = np.concatenate([a["location"] for a in dt_annos_part], 0)
-            dims = np.concatenate([a["dimensions"] for a in dt_annos_part], 0)
-            rots = np.concatenate([a["rotation_y"] for a in dt_annos_part], 0)
+            loc = _concat_field(dt_annos_part, "location")
+            dims = _concat_field(dt_annos_part, "dimensions")
+            rots = _concat_field(dt_annos_part, "rotation_y")
             dt_boxes = np.concatenate(
                 [loc, dims, rots[..., np.newaxis]], axis=1)
-            overlap_part = d3_box_overlap(gt_boxes, dt_boxes).astype(
-                np.float64)
+            overlap_part = d3_box_overlap(
+                gt_boxes, dt_boxes, backend=iou_backend).astype(np.float64)
         else:
             raise ValueError("unknown metric")
         parted_overlaps.append(overlap_part)
@@ -419,35 +733,35 @@ def calculate_iou_partly(gt_annos, dt_annos, metric, num_parts=50):
     return overlaps, parted_overlaps, total_gt_num, total_dt_num
 
 
-def _prepare_data(gt_annos, dt_annos, current_class, difficulty):
-    gt_datas_list = []
-    dt_datas_list = []
-    total_dc_num = []
-    ignored_gts, ignored_dets, dontcares = [], [], []
-    total_num_valid_gt = 0
-    for i in range(len(gt_annos)):
-        rets = clean_data(gt_annos[i], dt_annos[i], current_class, difficulty)
-        num_valid_gt, ignored_gt, ignored_det, dc_bboxes = rets
-        ignored_gts.append(np.array(ignored_gt, dtype=np.int64))
-        ignored_dets.append(np.array(ignored_det, dtype=np.int64))
-        if len(dc_bboxes) == 0:
-            dc_bboxes = np.zeros((0, 4)).astype(np.float64)
-        else:
-            dc_bboxes = np.stack(dc_bboxes, 0).astype(np.float64)
-        total_dc_num.append(dc_bboxes.shape[0])
-        dontcares.append(dc_bboxes)
-        total_num_valid_gt += num_valid_gt
-        gt_datas = np.concatenate(
-            [gt_annos[i]["bbox"], gt_annos[i]["alpha"][..., np.newaxis]], 1)
-        dt_datas = np.concatenate([
-            dt_annos[i]["bbox"], dt_annos[i]["alpha"][..., np.newaxis],
-            dt_annos[i]["score"][..., np.newaxis]
-        ], 1)
-        gt_datas_list.append(gt_datas)
-        dt_datas_list.append(dt_datas)
-    total_dc_num = np.stack(total_dc_num, axis=0)
-    return (gt_datas_list, dt_datas_list, ignored_gts, ignored_dets, dontcares,
-            total_dc_num, total_num_valid_gt)
+def _prepare_columns(gt_table, dt_table, current_class, difficulty):
+    """_prepare_data of all frames, concatenated.
+    """
+    return (gt_table.gt_datas, dt_table.dt_datas,
+            gt_table.ignored_gts[current_class, difficulty],
+            dt_table.ignored_dets(current_class, difficulty),
+            gt_table.dontcares,
+            int(gt_table.num_valid_gt[current_class, difficulty]))
+
+
+def _prepare_data(gt_annos,
+                  dt_annos,
+                  current_class,
+                  difficulty,
+                  gt_table=None,
+                  dt_table=None):
+    if gt_table is None:
+        gt_table = GroundTruthTable(gt_annos)
+    if dt_table is None:
+        dt_table = DetectionTable(dt_annos)
+    (gt_datas, dt_datas, ignored_gt, ignored_det, dontcares,
+     total_num_valid_gt) = _prepare_columns(gt_table, dt_table,
+                                            current_class, difficulty)
+    gt_splits = gt_table.offsets[1:-1]
+    dt_splits = dt_table.offsets[1:-1]
+    return (np.split(gt_datas, gt_splits), np.split(dt_datas, dt_splits),
+            np.split(ignored_gt, gt_splits), np.split(ignored_det, dt_splits),
+            np.split(dontcares, gt_table.dc_offsets[1:-1]), gt_table.num_dc,
+            total_num_valid_gt)
 
 
 def eval_class(gt_annos,
@@ -457,7 +771,9 @@ def eval_class(gt_annos,
                metric,
                min_overlap,
                compute_aos=False,
-               num_parts=50):
+               num_parts=50,
+               iou_backend="auto",
+               session=None):
     """Kitti eval. Only support 2d/bev/3d/aos eval for now.
     Args:
         gt_annos: dict, must from get_label_annos() in kitti_common.py
@@ -469,81 +785,206 @@ def eval_class(gt_annos,
             [[0.7, 0.5, 0.5], [0.7, 0.5, 0.5], [0.7, 0.5, 0.5]] 
             format: [metric, class]. choose one from matrix above.
         num_parts: int. a parameter for fast calculate algorithm
+        iou_backend: see rotate_iou_eval.
+        session: EvalSession of gt_annos and dt_annos, see eval_class_v3.
 
     Returns:
         dict of recall, precision and aos
     """
-    assert len(gt_annos) == len(dt_annos)
-    num_examples = len(gt_annos)
-    split_parts = get_split_parts(num_examples, num_parts)
-    thresholdss = []
-    rets = calculate_iou_partly(dt_annos, gt_annos, metric, num_parts)
-    overlaps, parted_overlaps, total_dt_num, total_gt_num = rets
-    rets = _prepare_data(gt_annos, dt_annos, current_class, difficulty)
-    (gt_datas_list, dt_datas_list, ignored_gts, ignored_dets, dontcares,
-     total_dc_num, total_num_valid_gt) = rets
-
-    for i in range(len(gt_annos)):
-        rets = compute_statistics_jit(
-            overlaps[i],
-            gt_datas_list[i],
-            dt_datas_list[i],
-            ignored_gts[i],
-            ignored_dets[i],
-            dontcares[i],
-            metric,
-            min_overlap=min_overlap,
-            thresh=0.0,
-            compute_fp=False)
-        tp, fp, fn, similarity, thresholds = rets
-        thresholdss += thresholds.tolist()
-    thresholdss = np.array(thresholdss)
-    thresholds = get_thresholds(thresholdss, total_num_valid_gt)
-    thresholds = np.array(thresholds)
-    pr = np.zeros([len(thresholds), 4])
-    idx = 0
-    for j, num_part in enumerate(split_parts):
-        gt_datas_part = np.concatenate(gt_datas_list[idx:idx + num_part], 0)
-        dt_datas_part = np.concatenate(dt_datas_list[idx:idx + num_part], 0)
-        dc_datas_part = np.concatenate(dontcares[idx:idx + num_part], 0)
-        ignored_dets_part = np.concatenate(ignored_dets[idx:idx + num_part], 0)
-        ignored_gts_part = np.concatenate(ignored_gts[idx:idx + num_part], 0)
+    if session is None:
+        session = EvalSession(gt_annos, dt_annos, num_parts, iou_backend)
+    recall, precision, aos = session.curves(metric, current_class,
+                                            difficulty, min_overlap,
+                                            compute_aos)
+    ret_dict = {
+        "recall": recall.copy(),
+        "precision": precision.copy(),
+        "orientation": aos.copy(),
+    }
+    return ret_dict
+
+
+class EvalSession:
+    """one (gt_annos, dt_annos) set, evaluated any number of times.
+
+    the overlaps of every metric, the ignored masks of every (class,
+    difficulty) and the precision / recall / aos of every (metric, class,
+    difficulty, min_overlap) are computed once and reused, so
+    get_official_eval_result and get_coco_eval_result given the same
+    session share all of them.
+    """
+
+    def __init__(self,
+                 gt_annos,
+                 dt_annos,
+                 num_parts=50,
+                 iou_backend="auto",
+                 gt_table=None):
+        """
+        Args:
+            num_parts: int. a parameter for fast calculate algorithm
+            iou_backend: see rotate_iou_eval.
+            gt_table: GroundTruthTable of gt_annos, built if None. pass
+                the same one to every session of an eval split.
+        """
+        assert len(gt_annos) == len(dt_annos)
+        if gt_table is None:
+            gt_table = GroundTruthTable(gt_annos)
+        assert gt_table.num_frames == len(gt_annos)
+        self.gt_annos = gt_annos
+        self.dt_annos = dt_annos
+        self.num_parts = num_parts
+        self.iou_backend = iou_backend
+        self.gt_table = gt_table
+        self.dt_table = DetectionTable(dt_annos)
+        self._overlaps = {}
+        self._datas = {}
+        self._thresholds = {}
+        self._curves = {}
+        self._distances = {}
+        self._gt_mask = self._dt_mask = None
+
+    @classmethod
+    def from_tables(cls, gt_table, dt_table, overlaps, thresholds=None):
+        """a session of precomputed tables, see StreamingEvaluator.
+        Args:
+            overlaps: metric -> flatten_overlaps of all frames.
+            thresholds: (metric, class, difficulty, min_overlap) -> true
+                positive scores, computed on demand if missing.
+        """
+        session = cls.__new__(cls)
+        session.gt_annos = session.dt_annos = None
+        session.gt_table = gt_table
+        session.dt_table = dt_table
+        session._overlaps = dict(overlaps)
+        session._datas = {}
+        session._thresholds = dict(thresholds or {})
+        session._curves = {}
+        session._distances = {}
+        session._gt_mask = session._dt_mask = None
+        return session
+
+    def overlaps(self, metric):
+        """flatten_overlaps of calculate_iou_partly of dt and gt annos.
+        """
+        if metric not in self._overlaps:
+            overlaps, _, _, _ = calculate_iou_partly(
+                self.dt_annos, self.gt_annos, metric, self.num_parts,
+                self.iou_backend)
+            self._overlaps[metric] = flatten_overlaps(overlaps)
+        return self._overlaps[metric]
+
+    def datas(self, current_class, difficulty):
+        """_prepare_columns of all frames.
+        """
+        key = (current_class, difficulty)
+        if key not in self._datas:
+            datas = _prepare_columns(self.gt_table, self.dt_table,
+                                     current_class, difficulty)
+            if self._gt_mask is not None:
+                (gt_datas, dt_datas, ignored_gt, ignored_det, dontcares,
+                 _) = datas
+                ignored_gt = np.where(self._gt_mask, ignored_gt, -1)
+                ignored_det = np.where(self._dt_mask, ignored_det, -1)
+                datas = (gt_datas, dt_datas, ignored_gt, ignored_det,
+                         dontcares, int((ignored_gt == 0).sum()))
+            self._datas[key] = datas
+        return self._datas[key]
+
+    def distances(self, distance="x"):
+        """box_distances of the gts and the dts.
+        """
+        if distance not in self._distances:
+            if self.gt_table.lidar_transforms is None:
+                raise ValueError(
+                    "distances need the calibs of the frames, build the "
+                    "GroundTruthTable with kitti_infos")
+            dt_locations = camera_to_lidar_frames(
+                self.dt_table.locations, self.dt_table.num_dt,
+                self.gt_table.lidar_transforms)
+            self._distances[distance] = (
+                box_distances(self.gt_table.lidar_locations, distance),
+                box_distances(dt_locations, distance))
+        return self._distances[distance]
+
+    def distance_bin(self, lower, upper=None, distance="x"):
+        """the session of the boxes with lower <= distance < upper (no
+        upper bound if None), sharing the overlaps of this one.
+
+        gts and dts of other distances are ignored (-1), the same as
+        removing them from the annos. dontcare boxes are kept.
+        """
+        gt_distances, dt_distances = self.distances(distance)
+        upper = np.inf if upper is None else upper
+        session = EvalSession.from_tables(
+            self.gt_table, self.dt_table,
+            {metric: self.overlaps(metric)
+             for metric in range(3)})
+        session._gt_mask = (gt_distances >= lower) & (gt_distances < upper)
+        session._dt_mask = (dt_distances >= lower) & (dt_distances < upper)
+        return session
+
+    def _kernel_args(self, metric, current_class, difficulty):
+        (gt_datas, dt_datas, ignored_gts, ignored_dets, dontcares,
+         _) = self.datas(current_class, difficulty)
+        return (self.overlaps(metric), self.gt_table.num_gt,
+                self.dt_table.num_dt, self.gt_table.num_dc, gt_datas,
+                dt_datas, dontcares, ignored_gts, ignored_dets)
+
+    def thresholds(self, metric, current_class, difficulty, min_overlap):
+        """true positive scores of all frames, the candidates of the
+        score thresholds.
+        """
+        key = (metric, current_class, difficulty, float(min_overlap))
+        if key not in self._thresholds:
+            self._thresholds[key] = fused_compute_thresholds(
+                *self._kernel_args(metric, current_class, difficulty),
+                metric, min_overlap)
+        return self._thresholds[key]
+
+    def curves(self,
+               metric,
+               current_class,
+               difficulty,
+               min_overlap,
+               compute_aos=False):
+        """recall, precision and aos of one setting, [N_SAMPLE_PTS] each.
+        """
+        key = (metric, current_class, difficulty, float(min_overlap),
+               compute_aos)
+        if key in self._curves:
+            return self._curves[key]
+        total_num_valid_gt = self.datas(current_class, difficulty)[-1]
+        # get_thresholds sorts its input.
+        thresholdss = self.thresholds(metric, current_class, difficulty,
+                                      min_overlap).copy()
+        thresholds = get_thresholds(thresholdss, total_num_valid_gt)
+        thresholds = np.array(thresholds)
+        pr = np.zeros([len(thresholds), 4])
         fused_compute_statistics(
-            parted_overlaps[j],
+            self.overlaps(metric),
             pr,
-            total_gt_num[idx:idx + num_part],
-            total_dt_num[idx:idx + num_part],
-            total_dc_num[idx:idx + num_part],
-            gt_datas_part,
-            dt_datas_part,
-            dc_datas_part,
-            ignored_gts_part,
-            ignored_dets_part,
+            *self._kernel_args(metric, current_class, difficulty)[1:],
             metric,
             min_overlap=min_overlap,
             thresholds=thresholds,
             compute_aos=compute_aos)
-        idx += num_part
-    N_SAMPLE_PTS = 41
-    precision = np.zeros([N_SAMPLE_PTS])
-    recall = np.zeros([N_SAMPLE_PTS])
-    aos = np.zeros([N_SAMPLE_PTS])
-    for i in range(len(thresholds)):
-        recall[i] = pr[i, 0] / (pr[i, 0] + pr[i, 2])
-        precision[i] = pr[i, 0] / (pr[i, 0] + pr[i, 1])
-        if compute_aos:
-            aos[i] = pr[i, 3] / (pr[i, 0] + pr[i, 1])
-    for i in range(len(thresholds)):
-        precision[i] = np.max(precision[i:])
-        recall[i] = np.max(recall[i:])
-        if compute_aos:
-            aos[i] = np.max(aos[i:])
-    ret_dict = {
-        "recall": recall,
-        "precision": precision,
-        "orientation": aos,
-    }
-    return ret_dict
+        N_SAMPLE_PTS = 41
+        precision = np.zeros([N_SAMPLE_PTS])
+        recall = np.zeros([N_SAMPLE_PTS])
+        aos = np.zeros([N_SAMPLE_PTS])
+        for i in range(len(thresholds)):
+            recall[i] = pr[i, 0] / (pr[i, 0] + pr[i, 2])
+            precision[i] = pr[i, 0] / (pr[i, 0] + pr[i, 1])
+            if compute_aos:
+                aos[i] = pr[i, 3] / (pr[i, 0] + pr[i, 1])
+        for i in range(len(thresholds)):
+            precision[i] = np.max(precision[i:])
+            recall[i] = np.max(recall[i:])
+            if compute_aos:
+                aos[i] = np.max(aos[i:])
+        self._curves[key] = (recall, precision, aos)
+        return self._curves[key]
 
 
 def eval_class_v3(gt_annos,
@@ -553,7 +994,9 @@ def eval_class_v3(gt_annos,
                   metric,
                   min_overlaps,
                   compute_aos=False,
-                  num_parts=50):
+                  num_parts=50,
+                  iou_backend="auto",
+                  session=None):
     """Kitti eval. support 2d/bev/3d/aos eval. support 0.5:0.05:0.95 coco AP.
     Args:
         gt_annos: dict, must from get_label_annos() in kitti_common.py
@@ -565,16 +1008,15 @@ def eval_class_v3(gt_annos,
             [[0.7, 0.5, 0.5], [0.7, 0.5, 0.5], [0.7, 0.5, 0.5]] 
             format: [metric, class]. choose one from matrix above.
         num_parts: int. a parameter for fast calculate algorithm
+        iou_backend: see rotate_iou_eval.
+        session: EvalSession of gt_annos and dt_annos, its overlaps and
+            curves are reused. num_parts and iou_backend are ignored.
 
     Returns:
         dict of recall, precision and aos
     """
-    assert len(gt_annos) == len(dt_annos)
-    num_examples = len(gt_annos)
-    split_parts = get_split_parts(num_examples, num_parts)
-
-    rets = calculate_iou_partly(dt_annos, gt_annos, metric, num_parts)
-    overlaps, parted_overlaps, total_dt_num, total_gt_num = rets
+    if session is None:
+        session = EvalSession(gt_annos, dt_annos, num_parts, iou_backend)
     N_SAMPLE_PTS = 41
     num_minoverlap = len(min_overlaps)
     num_class = len(current_classes)
@@ -586,68 +1028,11 @@ def eval_class_v3(gt_annos,
     aos = np.zeros([num_class, num_difficulty, num_minoverlap, N_SAMPLE_PTS])
     for m, current_class in enumerate(current_classes):
         for l, difficulty in enumerate(difficultys):
-            rets = _prepare_data(gt_annos, dt_annos, current_class, difficulty)
-            (gt_datas_list, dt_datas_list, ignored_gts, ignored_dets,
-             dontcares, total_dc_num, total_num_valid_gt) = rets
             for k, min_overlap in enumerate(min_overlaps[:, metric, m]):
-                thresholdss = []
-                for i in range(len(gt_annos)):
-                    rets = compute_statistics_jit(
-                        overlaps[i],
-                        gt_datas_list[i],
-                        dt_datas_list[i],
-                        ignored_gts[i],
-                        ignored_dets[i],
-                        dontcares[i],
-                        metric,
-                        min_overlap=min_overlap,
-                        thresh=0.0,
-                        compute_fp=False)
-                    tp, fp, fn, similarity, thresholds = rets
-                    thresholdss += thresholds.tolist()
-                thresholdss = np.array(thresholdss)
-                thresholds = get_thresholds(thresholdss, total_num_valid_gt)
-                thresholds = np.array(thresholds)
-                pr = np.zeros([len(thresholds), 4])
-                idx = 0
-                for j, num_part in enumerate(split_parts):
-                    gt_datas_part = np.concatenate(
-                        gt_datas_list[idx:idx + num_part], 0)
-                    dt_datas_part = np.concatenate(
-                        dt_datas_list[idx:idx + num_part], 0)
-                    dc_datas_part = np.concatenate(
-                        dontcares[idx:idx + num_part], 0)
-                    ignored_dets_part = np.concatenate(
-                        ignored_dets[idx:idx + num_part], 0)
-                    ignored_gts_part = np.concatenate(
-                        ignored_gts[idx:idx + num_part], 0)
-                    fused_compute_statistics(
-                        parted_overlaps[j],
-                        pr,
-                        total_gt_num[idx:idx + num_part],
-                        total_dt_num[idx:idx + num_part],
-                        total_dc_num[idx:idx + num_part],
-                        gt_datas_part,
-                        dt_datas_part,
-                        dc_datas_part,
-                        ignored_gts_part,
-                        ignored_dets_part,
-                        metric,
-                        min_overlap=min_overlap,
-                        thresholds=thresholds,
-                        compute_aos=compute_aos)
-                    idx += num_part
-                for i in range(len(thresholds)):
-                    recall[m, l, k, i] = pr[i, 0] / (pr[i, 0] + pr[i, 2])
-                    precision[m, l, k, i] = pr[i, 0] / (pr[i, 0] + pr[i, 1])
-                    if compute_aos:
-                        aos[m, l, k, i] = pr[i, 3] / (pr[i, 0] + pr[i, 1])
-                for i in range(len(thresholds)):
-                    precision[m, l, k, i] = np.max(
-                        precision[m, l, k, i:], axis=-1)
-                    recall[m, l, k, i] = np.max(recall[m, l, k, i:], axis=-1)
-                    if compute_aos:
-                        aos[m, l, k, i] = np.max(aos[m, l, k, i:], axis=-1)
+                (recall[m, l, k], precision[m, l, k],
+                 aos[m, l, k]) = session.curves(metric, current_class,
+                                                difficulty, min_overlap,
+                                                compute_aos)
     ret_dict = {
         "recall": recall,
         "precision": precision,
@@ -657,25 +1042,26 @@ def eval_class_v3(gt_annos,
 
 
 def do_eval(gt_annos, dt_annos, current_class, min_overlaps,
-            compute_aos=False):
+            compute_aos=False, iou_backend="auto"):
 
     mAP_bbox = []
     mAP_aos = []
     for i in range(3):  # i=difficulty
         ret = eval_class(gt_annos, dt_annos, current_class, i, 0,
-                         min_overlaps[0], compute_aos)
+                         min_overlaps[0], compute_aos,
+                         iou_backend=iou_backend)
         mAP_bbox.append(get_mAP(ret["precision"]))
         if compute_aos:
             mAP_aos.append(get_mAP(ret["orientation"]))
     mAP_bev = []
     for i in range(3):
         ret = eval_class(gt_annos, dt_annos, current_class, i, 1,
-                         min_overlaps[1])
+                         min_overlaps[1], iou_backend=iou_backend)
         mAP_bev.append(get_mAP(ret["precision"]))
     mAP_3d = []
     for i in range(3):
         ret = eval_class(gt_annos, dt_annos, current_class, i, 2,
-                         min_overlaps[2])
+                         min_overlaps[2], iou_backend=iou_backend)
         mAP_3d.append(get_mAP(ret["precision"]))
     return mAP_bbox, mAP_bev, mAP_3d, mAP_aos
 
@@ -692,33 +1078,38 @@ def do_eval_v2(gt_annos,
                current_classes,
                min_overlaps,
                compute_aos=False,
-               difficultys = [0, 1, 2]):
+               difficultys = [0, 1, 2],
+               iou_backend="auto",
+               session=None):
     # min_overlaps: [num_minoverlap, metric, num_class]
+    if session is None:
+        session = EvalSession(gt_annos, dt_annos, iou_backend=iou_backend)
     ret = eval_class_v3(gt_annos, dt_annos, current_classes, difficultys, 0,
-                        min_overlaps, compute_aos)
+                        min_overlaps, compute_aos, session=session)
     # ret: [num_class, num_diff, num_minoverlap, num_sample_points]
     mAP_bbox = get_mAP_v2(ret["precision"])
     mAP_aos = None
     if compute_aos:
         mAP_aos = get_mAP_v2(ret["orientation"])
     ret = eval_class_v3(gt_annos, dt_annos, current_classes, difficultys, 1,
-                        min_overlaps)
+                        min_overlaps, session=session)
     mAP_bev = get_mAP_v2(ret["precision"])
     ret = eval_class_v3(gt_annos, dt_annos, current_classes, difficultys, 2,
-                        min_overlaps)
+                        min_overlaps, session=session)
     mAP_3d = get_mAP_v2(ret["precision"])
     return mAP_bbox, mAP_bev, mAP_3d, mAP_aos
 
 
 def do_coco_style_eval(gt_annos, dt_annos, current_classes, overlap_ranges,
-                       compute_aos):
+                       compute_aos, iou_backend="auto", session=None):
     # overlap_ranges: [range, metric, num_class]
     min_overlaps = np.zeros([10, *overlap_ranges.shape[1:]])
     for i in range(overlap_ranges.shape[1]):
         for j in range(overlap_ranges.shape[2]):
             min_overlaps[:, i, j] = np.linspace(*overlap_ranges[:, i, j].astype('int'))
     mAP_bbox, mAP_bev, mAP_3d, mAP_aos = do_eval_v2(
-        gt_annos, dt_annos, current_classes, min_overlaps, compute_aos)
+        gt_annos, dt_annos, current_classes, min_overlaps, compute_aos,
+        iou_backend=iou_backend, session=session)
     # ret: [num_class, num_diff, num_minoverlap]
     mAP_bbox = mAP_bbox.mean(-1)
     mAP_bev = mAP_bev.mean(-1)
@@ -737,7 +1128,8 @@ def print_str(value, *arg, sstream=None):
     return sstream.getvalue()
 
 
-def get_official_eval_result_v1(gt_annos, dt_annos, current_class):
+def get_official_eval_result_v1(gt_annos, dt_annos, current_class,
+                                iou_backend="auto"):
     mAP_0_7 = np.array([[0.7, 0.5, 0.5, 0.7, 0.5], [0.7, 0.5, 0.5, 0.7, 0.5],
                         [0.7, 0.5, 0.5, 0.7, 0.5]])
     mAP_0_5 = np.array([[0.7, 0.5, 0.5, 0.7,
@@ -766,7 +1158,7 @@ def get_official_eval_result_v1(gt_annos, dt_annos, current_class):
         # mAP threshold matrix: [num_minoverlap, metric, class]
         mAPbbox, mAPbev, mAP3d, mAPaos = do_eval(
             gt_annos, dt_annos, current_class, mAP[:, current_class],
-            compute_aos)
+            compute_aos, iou_backend)
         # mAP: [num_class, num_diff, num_minoverlap]
         result += print_str(
             (f"{class_to_name[current_class]} "
@@ -788,13 +1180,26 @@ def get_official_eval_result_v1(gt_annos, dt_annos, current_class):
     return result
 
 
-def get_official_eval_result(
-    gt_annos,
-    dt_annos,
-    current_classes,
-    difficultys=[0, 1, 2],
-    return_data=False,
-):
+OFFICIAL_CLASS_TO_NAME = {
+    0: "Car",
+    1: "Pedestrian",
+    2: "Cyclist",
+    3: "Van",
+    4: "Person_sitting",
+    5: "car",
+    6: "tractor",
+    7: "trailer",
+}
+
+
+def official_min_overlaps(current_classes):
+    """
+    Args:
+        current_classes: class names or ints, see OFFICIAL_CLASS_TO_NAME.
+    Returns:
+        current_classes as ints and their min overlaps of
+        get_official_eval_result, [num_minoverlap, metric, num_class].
+    """
     overlap_0_7 = np.array(
         [
             [0.7, 0.5, 0.5, 0.7, 0.5, 0.7, 0.7, 0.7],
@@ -810,17 +1215,7 @@ def get_official_eval_result(
         ]
     )
     min_overlaps = np.stack([overlap_0_7, overlap_0_5], axis=0)  # [2, 3, 5]
-    class_to_name = {
-        0: "Car",
-        1: "Pedestrian",
-        2: "Cyclist",
-        3: "Van",
-        4: "Person_sitting",
-        5: "car",
-        6: "tractor",
-        7: "trailer",
-    }
-    name_to_class = {v: n for n, v in class_to_name.items()}
+    name_to_class = {v: n for n, v in OFFICIAL_CLASS_TO_NAME.items()}
     if not isinstance(current_classes, (list, tuple)):
         current_classes = [current_classes]
     current_classes_int = []
@@ -829,16 +1224,31 @@ def get_official_eval_result(
             current_classes_int.append(name_to_class[curcls])
         else:
             current_classes_int.append(curcls)
-    current_classes = current_classes_int
-    min_overlaps = min_overlaps[:, :, current_classes]
+    return current_classes_int, min_overlaps[:, :, current_classes_int]
+
+
+def get_official_eval_result(
+    gt_annos,
+    dt_annos,
+    current_classes,
+    difficultys=[0, 1, 2],
+    return_data=False,
+    iou_backend="auto",
+    session=None,
+):
+    """
+    Args:
+        session: EvalSession of gt_annos and dt_annos (unused then, may
+            be None), pass the same one to get_coco_eval_result to reuse
+            the overlaps.
+    """
+    class_to_name = OFFICIAL_CLASS_TO_NAME
+    current_classes, min_overlaps = official_min_overlaps(current_classes)
+    if session is None:
+        session = EvalSession(gt_annos, dt_annos, iou_backend=iou_backend)
     result = ""
     # check whether alpha is valid
-    compute_aos = False
-    for anno in dt_annos:
-        if anno["alpha"].shape[0] != 0:
-            if anno["alpha"][0] != -10:
-                compute_aos = True
-            break
+    compute_aos = session.dt_table.compute_aos
     mAPbbox, mAPbev, mAP3d, mAPaos = do_eval_v2(
         gt_annos,
         dt_annos,
@@ -846,6 +1256,8 @@ def get_official_eval_result(
         min_overlaps,
         compute_aos,
         difficultys,
+        iou_backend,
+        session,
     )
     for j, curcls in enumerate(current_classes):
         # mAP threshold array: [num_minoverlap, metric, class]
@@ -892,7 +1304,8 @@ def get_official_eval_result(
         return result
 
 
-def get_coco_eval_result(gt_annos, dt_annos, current_classes):
+def get_coco_eval_result(gt_annos, dt_annos, current_classes,
+                         iou_backend="auto", session=None):
     class_to_name = {
         0: 'Car',
         1: 'Pedestrian',
@@ -939,15 +1352,13 @@ def get_coco_eval_result(gt_annos, dt_annos, current_classes):
     for i, curcls in enumerate(current_classes):
         overlap_ranges[:, :, i] = np.array(class_to_range[curcls])[:, np.newaxis]
     result = ''
+    if session is None:
+        session = EvalSession(gt_annos, dt_annos, iou_backend=iou_backend)
     # check whether alpha is valid
-    compute_aos = False
-    for anno in dt_annos:
-        if anno['alpha'].shape[0] != 0:
-            if anno['alpha'][0] != -10:
-                compute_aos = True
-            break
+    compute_aos = session.dt_table.compute_aos
     mAPbbox, mAPbev, mAP3d, mAPaos = do_coco_style_eval(
-        gt_annos, dt_annos, current_classes, overlap_ranges, compute_aos)
+        gt_annos, dt_annos, current_classes, overlap_ranges, compute_aos,
+        iou_backend, session)
     for j, curcls in enumerate(current_classes):
         # mAP threshold array: [num_minoverlap, metric, class]
         # mAP result: [num_class, num_diff, num_minoverlap]
@@ -970,3 +1381,196 @@ def get_coco_eval_result(gt_annos, dt_annos, current_classes):
                                     f"{mAPaos[j, 1]:.2f}, "
                                     f"{mAPaos[j, 2]:.2f}"))
     return result
+
+
+def distance_bin_name(lower, upper=None):
+    if upper is None:
+        return f"{lower:g}m+"
+    return f"{lower:g}-{upper:g}m"
+
+
+def get_distance_eval_result(gt_annos,
+                             dt_annos,
+                             current_classes,
+                             distance_bins=DISTANCE_BINS,
+                             distance="x",
+                             difficultys=[0, 1, 2],
+                             return_data=False,
+                             iou_backend="auto",
+                             kitti_infos=None,
+                             session=None):
+    """official APs of every distance bin and of all boxes, a table per
+    class and min overlap. all bins are evaluated from the overlaps of one
+    session.
+    Args:
+        distance_bins: increasing lower edges of the bins in meters, the
+            last bin is open.
+        distance: see box_distances.
+        kitti_infos: infos of the frames (calibs), used if session is None.
+        session: EvalSession of gt_annos and dt_annos, its GroundTruthTable
+            must have the calibs (from_infos or kitti_infos given).
+    Returns:
+        result str and, if return_data, a dict: bin name ("all" for all
+        boxes) -> mAPbbox, mAPbev, mAP3d, mAPaos of
+        get_official_eval_result, num_valid_gt [num_class, num_diff].
+    """
+    class_to_name = OFFICIAL_CLASS_TO_NAME
+    current_classes, min_overlaps = official_min_overlaps(current_classes)
+    if session is None:
+        session = EvalSession(gt_annos,
+                              dt_annos,
+                              iou_backend=iou_backend,
+                              gt_table=GroundTruthTable(
+                                  gt_annos, kitti_infos))
+    edges = list(distance_bins)
+    if any(lower >= upper for lower, upper in zip(edges, edges[1:])):
+        raise ValueError(
+            "distance bins must be increasing: {}".format(distance_bins))
+    compute_aos = session.dt_table.compute_aos
+    sessions = {
+        distance_bin_name(lower, upper): session.distance_bin(
+            lower, upper, distance)
+        for lower, upper in zip(edges, edges[1:] + [None])
+    }
+    sessions["all"] = session
+    ap_by_bin = {}
+    for name, bin_session in sessions.items():
+        aps = do_eval_v2(None, None, current_classes, min_overlaps,
+                         compute_aos, difficultys, session=bin_session)
+        num_valid_gt = np.array([[
+            bin_session.datas(current_class, difficulty)[-1]
+            for difficulty in difficultys
+        ] for current_class in current_classes])
+        ap_by_bin[name] = (*aps, num_valid_gt)
+    result = ""
+    row = "{:<10}{:<20}{:<24}{:<24}{}"
+
+    def cells(values):
+        return ", ".join("{:.2f}".format(v) for v in values)
+
+    for j, curcls in enumerate(current_classes):
+        for i in range(min_overlaps.shape[0]):
+            result += print_str(
+                f"{class_to_name[curcls]} "
+                "AP@{:.2f}, {:.2f}, {:.2f} by {} distance:".format(
+                    *min_overlaps[i, :, j], distance))
+            result += print_str(
+                row.format("range", "num gt", "bbox AP", "bev AP", "3d AP"))
+            for name, (mAPbbox, mAPbev, mAP3d, _,
+                       num_valid_gt) in ap_by_bin.items():
+                result += print_str(
+                    row.format(
+                        name, ", ".join(str(n) for n in num_valid_gt[j]),
+                        cells(mAPbbox[j, :, i]), cells(mAPbev[j, :, i]),
+                        cells(mAP3d[j, :, i])))
+    if return_data:
+        return result, ap_by_bin
+    return result
+
+
+class StreamingEvaluator:
+    """get_official_eval_result of a split fed one frame at a time.
+
+    update computes the overlaps of every metric and the true positive
+    scores of every (metric, class, difficulty, official min_overlap) of
+    the new frames, only the eval columns of a frame are kept (not its
+    annos, not the parted overlaps). finalize computes the thresholds and
+    APs, identical to the batch eval of all frames:
+        evaluator = StreamingEvaluator(class_names)
+        for gt_anno, dt_anno in ...:
+            evaluator.update(gt_anno, dt_anno)
+        result = evaluator.finalize()
+    """
+
+    def __init__(self,
+                 current_classes,
+                 difficultys=[0, 1, 2],
+                 iou_backend="auto",
+                 chunk_size=16):
+        """
+        Args:
+            chunk_size: frames buffered before they are evaluated, amortizes
+                the kernel launches.
+        """
+        self.current_classes, self.min_overlaps = official_min_overlaps(
+            current_classes)
+        self.difficultys = difficultys
+        self.iou_backend = iou_backend
+        self.chunk_size = chunk_size
+        self.num_frames = 0
+        self.num_dt = 0
+        self._pending = []
+        self._gt_tables = []
+        self._dt_tables = []
+        self._overlaps = {metric: [] for metric in range(3)}
+        self._thresholds = {}
+        self._session = None
+
+    def update(self, gt_anno, dt_anno, info=None):
+        """
+        Args:
+            info: kitti info of the frame, its calib is needed by distance
+                binned evals of the session.
+        """
+        assert self._session is None, "update after finalize"
+        self._pending.append((gt_anno, dt_anno, info))
+        self.num_frames += 1
+        self.num_dt += len(dt_anno["name"])
+        if len(self._pending) >= self.chunk_size:
+            self._flush()
+
+    def _flush(self):
+        if len(self._pending) == 0:
+            return
+        gt_annos, dt_annos, infos = [list(x) for x in zip(*self._pending)]
+        self._pending = []
+        if any(info is None for info in infos):
+            infos = None
+        chunk = EvalSession(gt_annos,
+                            dt_annos,
+                            num_parts=1,
+                            iou_backend=self.iou_backend,
+                            gt_table=GroundTruthTable(gt_annos, infos))
+        self._gt_tables.append(chunk.gt_table)
+        self._dt_tables.append(chunk.dt_table)
+        for metric in range(3):
+            self._overlaps[metric].append(chunk.overlaps(metric))
+            for m, current_class in enumerate(self.current_classes):
+                for difficulty in self.difficultys:
+                    for min_overlap in np.unique(
+                            self.min_overlaps[:, metric, m]):
+                        key = (metric, current_class, difficulty,
+                               float(min_overlap))
+                        self._thresholds.setdefault(key, []).append(
+                            chunk.thresholds(*key))
+
+    @property
+    def session(self):
+        """EvalSession of all frames, for get_coco_eval_result or other
+        settings (computed from the kept columns).
+        """
+        if self._session is None:
+            self._flush()
+            assert self.num_frames > 0, "no frames to evaluate"
+            self._session = EvalSession.from_tables(
+                GroundTruthTable.concatenate(self._gt_tables),
+                DetectionTable.concatenate(self._dt_tables), {
+                    metric: np.concatenate(overlaps)
+                    for metric, overlaps in self._overlaps.items()
+                }, {
+                    key: np.concatenate(thresholds)
+                    for key, thresholds in self._thresholds.items()
+                })
+            self._gt_tables = self._dt_tables = None
+            self._overlaps = self._thresholds = None
+        return self._session
+
+    def finalize(self, return_data=False):
+        """see get_official_eval_result.
+        """
+        return get_official_eval_result(None,
+                                        None,
+                                        self.current_classes,
+                                        self.difficultys,
+                                        return_data,
+                                        session=self.session)
@@ -114,7 +114,9 @@ def save(model_dir,
 def restore(ckpt_path, model):
     if not Path(ckpt_path).is_file():
         raise ValueError("checkpoint {} not exist.".format(ckpt_path))
-    model.load_state_dict(torch.load(ckpt_path))
+    # load_state_dict copies to the model's device, so cpu-only hosts can
+    # restore gpu checkpoints.
+    model.load_state_dict(torch.load(ckpt_path, map_location="cpu"))
     print("Restoring parameters from {}".format(ckpt_path))
 
 